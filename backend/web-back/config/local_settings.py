@@ -16,4 +16,10 @@ DATABASES = {
             'charset': 'utf8mb4'
         }
     }
-}
\ No newline at end of file
+}
+
+# Read replica of the database, used for the dashboard reads when DB_REPLICA_HOST is set
+if os.environ.get('DB_REPLICA_HOST'):
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=os.environ['DB_REPLICA_HOST'],
+                                PORT=os.environ.get('DB_REPLICA_PORT', '3306'),
+                                TEST={'MIRROR': 'default'})
@@ -160,11 +160,94 @@ CORS_ORIGIN_WHITELIST = (
 DEFAULT_AUTO_FIELD='django.db.models.AutoField'
 ASGI_APPLICATION = 'config.asgi.application'
 
+# Group messages reach the consumers of the sending worker directly, and the other workers through Redis, see
+# interface/layers.py. Groups are sharded over the hosts, list several in REDIS_HOSTS, e.g. redis1:6379,redis2:6379.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'interface.layers.HybridChannelLayer',
         'CONFIG': {
-            "hosts": [('redis', 6379)],
+            "hosts": [(host.rpartition(':')[0], int(host.rpartition(':')[2]))
+                      for host in os.environ.get('REDIS_HOSTS', 'redis:6379').replace(' ', '').split(',') if host],
         },
     },
-}
\ No newline at end of file
+}
+
+# Last-known dashboard state shared by the workers, see interface/snapshot.py
+# HOST set to None keeps the snapshot in the process memory instead of Redis.
+SNAPSHOT = {
+    'HOST': ('redis', 6379),
+    'MAX_AGE': 5,
+    'RECENT_TWEETS': 20,
+}
+
+# The ingest worker checkpoints its in-memory state and restores it on startup, see interface/checkpoint.py
+# PATH set to None stores the checkpoint in the snapshot Redis instead of a file, without either it is off.
+CHECKPOINT = {
+    'PATH': os.environ.get('CHECKPOINT_PATH'),
+    'INTERVAL': 30,             # Seconds between checkpoints, one is also written when the worker stops
+    'RESUME_STREAM': True,      # Reconnect the streams that were running at the checkpoint
+}
+
+# Aged tweets are moved to Parquet files by the archivetweets command, see interface/archive.py
+ARCHIVE = {
+    'PATH': os.path.join(BASE_DIR, 'archive'),
+    'RETENTION_DAYS': 7,
+}
+
+# Reads in the dashboard helpers go to the 'replica' database when it is configured, see interface/routers.py
+DATABASE_ROUTERS = ['interface.routers.ReplicaRouter']
+REPLICA = {
+    'ALIAS': 'replica',
+    'MAX_LAG': 5,               # Seconds the replica may lag before reads fall back to the primary
+    'READ_AFTER_WRITE': 10,     # Seconds after a write during which the same context reads from the primary
+    'LAG_CHECK_INTERVAL': 5,
+}
+
+# Twitter API calls are queued and rate limited by interface/ratelimit.py
+RATELIMIT = {
+    'API_URL': None,            # Base url of a fake endpoint to send the API requests to, e.g. 'http://localhost:8080'
+    'CONCURRENCY': 4,           # Calls running at the same time
+    'RETRIES': 3,               # Retries of a call answered with 429
+}
+
+# Cards of the streamed tweets, cached in memory and in the snapshot Redis, see interface/cards.py
+CARDS = {
+    'MAX_SIZE': 1000,
+    'TTL': 3600,
+}
+
+# Event loop watchdog, see interface/monitor.py
+MONITOR = {
+    'INTERVAL': 0.05,           # Seconds between heartbeats of the loop
+    'THRESHOLD': 0.25,          # Seconds the loop may be blocked before the stall is recorded
+}
+
+# Near-duplicate clustering of the streamed tweets, see interface/dedup.py
+DEDUP = {
+    'NUM_PERM': 64,             # Length of the MinHash signatures
+    'BANDS': 16,                # LSH bands, must divide NUM_PERM
+    'THRESHOLD': 0.8,           # Estimated Jaccard similarity of the shingles of a duplicate
+    'TTL': 3600,                # Seconds a cluster is kept after its last tweet
+}
+
+# Tweets with a location are counted per cell of a longitude/latitude grid, see interface/geo.py
+# Changing GRID_DEGREES makes the stored cells incomparable with the new ones.
+GEO = {
+    'GRID_DEGREES': 1.0,
+}
+
+# Workspaces: isolated streams served at ws/tweets/<workspace>, see interface/workspaces.py
+# Each has its own bearer token (a Twitter app allows one filtered stream). Workspaces listed in the WORKSPACES
+# environment variable, comma separated, read their token from TWITTER_BEARER_TOKEN_<NAME>. The STREAM_PROFILE of a
+# workspace picks the fields its stream requests: 'minimal', 'dashboard' (the default) or 'archive'.
+WORKSPACE_LIMITS = {
+    'MAX_TRACKED': 99,              # Tweets polled for engagement
+    'MAX_TWEETS_PER_SECOND': 50,    # Tweets handled from the stream, the excess is dropped (only counted in the cube)
+    'MAX_CLIENTS': 100,             # Websockets per web worker
+    'MAX_PENDING': 32,              # Responses stored at the same time by the ingest worker
+}
+WORKSPACES = {
+    'default': {'BEARER_TOKEN': os.environ.get('TWITTER_BEARER_TOKEN')},
+}
+for name in filter(None, os.environ.get('WORKSPACES', '').lower().replace(' ', '').split(',')):
+    WORKSPACES[name] = {'BEARER_TOKEN': os.environ.get('TWITTER_BEARER_TOKEN_' + name.upper())}
@@ -19,5 +19,6 @@ from interface import views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('', views.index, name='index')
+    path('', views.index, name='index'),
+    path('api/', include('interface.urls')),
 ]
@@ -15,5 +15,6 @@ admin.site.register(Mention)
 admin.site.register(ContextEntity)
 admin.site.register(ContextDomain)
 admin.site.register(TrackedTweet)
+admin.site.register(TweetCube)
 
 # Register your models here.
@@ -0,0 +1,174 @@
+import os
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+
+from .models import ReferencedTweet, Tweet, TweetMetrics, User
+
+
+""" Archive of aged tweets as date partitioned Parquet files, read with pyarrow """
+def archive_path():
+    return settings.ARCHIVE['PATH']
+
+
+def archive_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.string()),
+        ('text', pa.string()),
+        ('author_id', pa.string()),
+        ('author_username', pa.string()),
+        ('author_name', pa.string()),
+        ('author_verified', pa.bool_()),
+        ('conversation_id', pa.string()),
+        ('created_at', pa.timestamp('us', tz='UTC')),
+        ('in_reply_to_user_id', pa.string()),
+        ('lang', pa.string()),
+        ('possibly_sensitive', pa.bool_()),
+        ('reply_settings', pa.string()),
+        ('source', pa.string()),
+        ('filters', pa.string()),
+        ('thread_path', pa.string()),
+        ('cluster_id', pa.string()),
+        ('place_id', pa.string()),
+        ('workspace', pa.string()),
+        ('referenced_tweets', pa.list_(pa.struct([('type', pa.string()), ('id', pa.string())]))),
+        ('hashtags', pa.list_(pa.string())),
+        ('mentions', pa.list_(pa.string())),
+        ('contexts', pa.list_(pa.string())),
+        ('retweet_count', pa.int32()),
+        ('reply_count', pa.int32()),
+        ('like_count', pa.int32()),
+        ('quote_count', pa.int32()),
+        ('metric_samples', pa.int32()),
+        ('date', pa.string()),
+    ])
+
+
+def collect_rows(tweets):
+    """
+    Gets the archive rows of a chunk of tweets, with their references, entities, authors and metric rollups.
+    Each relation is read with one query for the whole chunk.
+    :param tweets: List of Tweet values dictionaries
+    :return: Dictionary of column name -> list of values
+    """
+    ids = [tweet['id'] for tweet in tweets]
+    references = defaultdict(list)
+    for source_id, kind, tweetid in ReferencedTweet.objects.filter(source_id__in=ids).order_by('id').values_list(
+            'source_id', 'type', 'tweetid'):
+        references[source_id].append({'type': kind, 'id': tweetid})
+    hashtags = defaultdict(list)
+    for tweet_id, tag in Tweet.hashtags.through.objects.filter(tweet_id__in=ids).values_list(
+            'tweet_id', 'hashtag__hashtag'):
+        hashtags[tweet_id].append(tag)
+    mentions = defaultdict(list)
+    for tweet_id, name in Tweet.mentions.through.objects.filter(tweet_id__in=ids).values_list(
+            'tweet_id', 'mention__mention'):
+        mentions[tweet_id].append(name)
+    contexts = defaultdict(list)
+    for tweet_id, dom_id, ent_id in Tweet.context.through.objects.filter(tweet_id__in=ids).values_list(
+            'tweet_id', 'contextentity__domain__dom_id', 'contextentity__ent_id'):
+        contexts[tweet_id].append(f'{dom_id}.{ent_id}')
+    users = {user['id']: user for user in User.objects.filter(
+        id__in={tweet['author_id'] for tweet in tweets}).values('id', 'username', 'name', 'verified')}
+    metrics = {metric['tweetid']: metric for metric in TweetMetrics.objects.filter(tweetid__in=ids).values(
+        'tweetid').annotate(retweet_count=Max('retweet_count'), reply_count=Max('reply_count'),
+                            like_count=Max('like_count'), quote_count=Max('quote_count'),
+                            metric_samples=Count('id'))}
+    columns = defaultdict(list)
+    for tweet in tweets:
+        user = users.get(tweet['author_id'], {})
+        metric = metrics.get(tweet['id'], {})
+        for field in ('id', 'text', 'author_id', 'conversation_id', 'created_at', 'in_reply_to_user_id', 'lang',
+                      'possibly_sensitive', 'reply_settings', 'source', 'filters', 'thread_path', 'cluster_id',
+                      'place_id', 'workspace'):
+            columns[field].append(tweet[field])
+        columns['referenced_tweets'].append(references[tweet['id']])
+        columns['author_username'].append(user.get('username'))
+        columns['author_name'].append(user.get('name'))
+        columns['author_verified'].append(user.get('verified'))
+        columns['hashtags'].append(hashtags[tweet['id']])
+        columns['mentions'].append(mentions[tweet['id']])
+        columns['contexts'].append(contexts[tweet['id']])
+        for field in ('retweet_count', 'reply_count', 'like_count', 'quote_count'):
+            columns[field].append(metric.get(field))
+        columns['metric_samples'].append(metric.get('metric_samples', 0))
+        columns['date'].append(tweet['created_at'].date().isoformat())
+    return columns
+
+
+def archive_tweets(before, chunk_size=5000, delete=True, path=None):
+    """
+    Moves the tweets created before a point in time to the archive, one chunk at a time.
+    Each chunk is written to the partitions of its dates first, and only then deleted from the database along with
+    its metrics, tracking, references and entity links, which are archived with it. The all-time entity counts, the
+    users and the places are kept.
+    :param before: Datetime, tweets created before it are archived
+    :param chunk_size: The number of tweets read, written and deleted at a time
+    :param delete: Whether to delete the archived tweets from the database
+    :param path: Directory of the archive, defaults to the ARCHIVE setting
+    :return: The number of tweets archived
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    path = path or archive_path()
+    schema = archive_schema()
+    archived = 0
+    last = None
+    while True:
+        tweets = Tweet.objects.filter(created_at__lt=before).order_by('created_at', 'id')
+        if last is not None and not delete:
+            tweets = tweets.filter(created_at__gte=last[0]).exclude(created_at=last[0], id__lte=last[1])
+        tweets = list(tweets.values()[:chunk_size])
+        if not tweets:
+            break
+        table = pa.Table.from_pydict(collect_rows(tweets), schema=schema)
+        ds.write_dataset(table, path, format='parquet', partitioning=['date'], partitioning_flavor='hive',
+                         basename_template=f"{tweets[0]['id']}-{{i}}.parquet",
+                         existing_data_behavior='overwrite_or_ignore')
+        if delete:
+            with transaction.atomic():
+                Tweet.objects.filter(id__in=[tweet['id'] for tweet in tweets]).delete()
+        last = (tweets[-1]['created_at'], tweets[-1]['id'])
+        archived += len(tweets)
+        print(f'Archived {archived} tweets, up to {last[0]:%Y-%m-%d %H:%M}')
+    return archived
+
+
+def read_archive(start=None, end=None, columns=None, path=None, **equals):
+    """
+    Reads tweets from the archive. Only the partitions between 'start' and 'end' are opened, and the other
+    filters are pushed down to the Parquet row groups.
+    Example: read_archive(start=date(2022, 7, 1), workspace='default', lang='en', columns=['id', 'text'])
+    :param start: Date or datetime, only tweets created from then
+    :param end: Date or datetime, only tweets created before then
+    :param columns: List of columns to read, defaults to all
+    :param path: Directory of the archive, defaults to the ARCHIVE setting
+    :param equals: Column values the tweets must have, e.g. lang='en'
+    :return: pyarrow Table
+    """
+    import pyarrow.dataset as ds
+
+    path = path or archive_path()
+    if not os.path.isdir(path):
+        return archive_schema().empty_table()
+    dataset = ds.dataset(path, format='parquet', schema=archive_schema(), partitioning='hive')
+    expression = None
+    conditions = list()
+    if start is not None:
+        conditions.append(ds.field('date') >= start.strftime('%Y-%m-%d'))
+        if hasattr(start, 'hour'):
+            conditions.append(ds.field('created_at') >= start)
+    if end is not None and hasattr(end, 'hour'):
+        conditions.append(ds.field('date') <= end.strftime('%Y-%m-%d'))
+        conditions.append(ds.field('created_at') < end)
+    elif end is not None:
+        conditions.append(ds.field('date') < end.strftime('%Y-%m-%d'))
+    for field, value in equals.items():
+        conditions.append(ds.field(field) == value)
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
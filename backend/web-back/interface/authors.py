@@ -0,0 +1,106 @@
+import asyncio
+import time
+from datetime import timedelta
+
+from .monitor import sync_to_async
+from django.utils import timezone
+
+from .models import Tweet, User, UserMetrics
+from .ratelimit import PolledEndpoint, ScheduledClient, USERS
+from .routers import replica_reads
+from .workspaces import DEFAULT_WORKSPACE, get_workspace
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+@replica_reads
+def get_recent_author_ids(since, workspace=DEFAULT_WORKSPACE):
+    """
+    Gets the distinct authors of the tweets created since a point in time.
+    :param since: Datetime object
+    :param workspace: The name of the workspace that stored the tweets
+    :return: List of author ids
+    """
+    tweets = Tweet.objects.filter(created_at__gte=since, workspace=workspace)
+    return list(tweets.values_list('author_id', flat=True).distinct())
+
+
+def save_user_metrics(users, timestamp):
+    """
+    Stores the public metrics of users, with one bulk insert for the metrics. Users that are not stored yet
+    (e.g. if their tweet's includes were lost) are inserted first.
+    :param users: List of Tweepy Users with public_metrics
+    :param timestamp: The time the metrics were collected
+    """
+    User.objects.bulk_create([
+        User(id=str(user.id), name=user.name, username=user.username) for user in users
+    ], ignore_conflicts=True)
+    UserMetrics.objects.bulk_create([
+        UserMetrics(
+            user_id_id=str(user.id),
+            time=timestamp,
+            followers_count=user.public_metrics['followers_count'],
+            following_count=user.public_metrics['following_count'],
+            tweet_count=user.public_metrics['tweet_count'],
+            listed_count=user.public_metrics['listed_count']
+        ) for user in users
+    ])
+
+
+class AuthorMetricsCollector(PolledEndpoint):
+    endpoint = 'GET /2/users'
+
+    def __init__(self, bearer_token, workspace=None, window=10, ttl=900):
+        """
+        Collects the public metrics of the authors of recent tweets. Run as a job like the EngagementTracker, with
+        the interval stretched by the remaining quota of the users endpoint (see ratelimit.PolledEndpoint).
+        :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param workspace: The Workspace whose authors are collected, defaults to the default workspace
+        :param window: Minutes back to look for authors
+        :param ttl: Seconds before the metrics of an author are collected again
+        """
+        self.bearer_token = bearer_token
+        self.workspace = workspace or get_workspace(DEFAULT_WORKSPACE)
+        self.window = window
+        self.ttl = ttl
+        self.refreshed = dict()     # author id -> time.monotonic() of the last collection
+
+    def due(self, author_ids):
+        """
+        Gets the authors whose metrics are not fresh, and forgets the authors whose metrics have expired.
+        :param author_ids: List of author ids
+        :return: List of author ids to collect
+        """
+        now = time.monotonic()
+        for author in [a for a, t in self.refreshed.items() if now - t >= self.ttl]:
+            del self.refreshed[author]
+        return [author for author in author_ids if author not in self.refreshed]
+
+    async def collect(self):
+        """
+        Looks up the due authors 100 at a time (the maximum of the users endpoint), and stores all the results with
+        a single bulk insert. The lookups go through the API scheduler, after the rule changes and metric polls.
+        """
+        since = timezone.now() - timedelta(minutes=self.window)
+        authors = self.due(await sync_to_async(get_recent_author_ids)(since, self.workspace.name))
+        if not authors:
+            return
+        client = ScheduledClient(self.bearer_token, priority=USERS)
+
+        async def lookup(ids):
+            response = await client.get_users(ids=ids, user_fields=['public_metrics'])
+            return response.data or []
+
+        batches = [authors[i:i + 100] for i in range(0, len(authors), 100)]
+        self.calls = len(batches)
+        results = await asyncio.gather(*[lookup(batch) for batch in batches], return_exceptions=True)
+        users = list()
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                print(f'User lookup failed: {result!r}')
+                continue
+            users.extend(result)
+            now = time.monotonic()
+            self.refreshed.update((author, now) for author in batch)
+        timestamp = timezone.now()
+        await sync_to_async(save_user_metrics)(users, timestamp)
+        print(f"Metrics of {len(users)} authors updated at {timestamp.strftime('%X')}")
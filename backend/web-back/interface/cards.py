@@ -0,0 +1,112 @@
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .snapshot import SNAPSHOT
+
+
+""" Render payloads ('cards') of the streamed tweets, built at ingest time and cached by tweet id """
+KEY_PREFIX = 'livetweets:card:'
+
+
+def card_setting(name, default=None):
+    return getattr(settings, 'CARDS', {}).get(name, default)
+
+
+def build_card(tweet, includes, filters=''):
+    """
+    Builds the payload a frontend needs to draw a tweet, from the stream response alone (no database reads).
+    :param tweet: The Tweepy Tweet, or the TweetRecord of the stream
+    :param includes: The includes of the response, dictionary of lists of Tweepy Users and Media, or of their records
+    :param filters: The tags of the matching rules, comma separated
+    :return: Dictionary of the card
+    """
+    users = {str(user.id): user for user in includes.get('users', [])}
+    media = {item.media_key: item for item in includes.get('media', [])}
+    author = users.get(str(tweet.author_id))
+    attachments = (tweet.attachments or {}).get('media_keys', [])
+    return {
+        'id': str(tweet.id),
+        'text': tweet.text,
+        'created_at': tweet.created_at.isoformat() if tweet.created_at else None,
+        'lang': tweet.lang,
+        'filters': filters,
+        'conversation_id': str(tweet.conversation_id) if tweet.conversation_id else None,
+        'possibly_sensitive': tweet.possibly_sensitive,
+        'public_metrics': tweet.public_metrics,
+        'referenced_tweets': [{'type': ref['type'], 'id': str(ref['id'])}
+                              for ref in tweet.data.get('referenced_tweets', [])],
+        'author': {
+            'id': str(tweet.author_id),
+            'name': author.name if author else None,
+            'username': author.username if author else None,
+            'profile_image_url': author.profile_image_url if author else None,
+            'verified': author.verified if author else None,
+        },
+        'media': [{
+            'type': media[key].type,
+            'url': media[key].url,
+            'preview_image_url': media[key].preview_image_url,
+        } for key in attachments if key in media],
+    }
+
+
+class CardCache:
+    def __init__(self, max_size=1000, ttl=3600, key_prefix=KEY_PREFIX):
+        """
+        Cache of the tweet cards of a workspace: the most recent 'max_size' in an LRU in this process, and all of them
+        in Redis for 'ttl' seconds, so the other workers (and this one, after eviction) can look them up.
+        Without a Redis host (see SNAPSHOT) only the LRU is used.
+        :param max_size: The number of cards kept in memory
+        :param ttl: Seconds the cards are kept in Redis
+        :param key_prefix: Prefix of the Redis keys, followed by the tweet id
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self.cards = OrderedDict()
+
+    def remember(self, tweet_id, card):
+        self.cards[tweet_id] = card
+        self.cards.move_to_end(tweet_id)
+        while len(self.cards) > self.max_size:
+            self.cards.popitem(last=False)
+
+    async def put(self, card):
+        """
+        Caches a card.
+        :param card: Dictionary from build_card
+        """
+        self.remember(card['id'], card)
+        client = SNAPSHOT.get_client()
+        if client is not None:
+            body = json.dumps(card, separators=(',', ':'))
+            await client.set(self.key_prefix + card['id'], body, ex=self.ttl)
+
+    async def get(self, tweet_id):
+        """
+        Gets a card from memory, or from Redis if it has been evicted or was built by another worker.
+        :param tweet_id: The id of the tweet
+        :return: Dictionary of the card, or None if it is not cached
+        """
+        if tweet_id in self.cards:
+            self.cards.move_to_end(tweet_id)
+            return self.cards[tweet_id]
+        client = SNAPSHOT.get_client()
+        if client is None:
+            return None
+        body = await client.get(self.key_prefix + tweet_id)
+        if body is None:
+            return None
+        card = json.loads(body)
+        self.remember(tweet_id, card)
+        return card
+
+
+def card_cache(key_prefix=KEY_PREFIX):
+    """ :return: A CardCache configured by the CARDS settings """
+    return CardCache(max_size=card_setting('MAX_SIZE', 1000), ttl=card_setting('TTL', 3600), key_prefix=key_prefix)
+
+
+CARDS = card_cache()
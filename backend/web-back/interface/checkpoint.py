@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+import struct
+import time
+
+from django.conf import settings
+
+from .snapshot import SNAPSHOT
+
+
+""" Checkpoints of the in-memory state of the ingest worker, restored when it starts so a restart keeps the dashboards
+populated: per workspace the trending engine, the near-duplicate clusters, the engagement tracker, the recent tweets
+and local snapshot, the co-occurrence graph, and whether the stream and the tracking were running """
+HEADER = struct.Struct('<4sHdI')        # Magic, version, unix time of the checkpoint, number of sections
+MAGIC = b'CKPT'
+VERSION = 1
+KEY = 'livetweets:checkpoint'
+
+
+def checkpoint_setting(name, default=None):
+    return getattr(settings, 'CHECKPOINT', {}).get(name, default)
+
+
+def encode_checkpoint(sections, now=None):
+    """
+    Serializes a checkpoint: a header, then for each section the number of its parts and the parts, each prefixed
+    with its length. The first part of a section is its JSON state, the others are bytes serialized by their owner
+    (e.g. TrendingEngine.to_bytes).
+    :param sections: List of (state dictionary, bytes...) tuples, one per workspace
+    :param now: Unix time of the checkpoint, defaults to now
+    :return: bytes
+    """
+    parts = [HEADER.pack(MAGIC, VERSION, time.time() if now is None else now, len(sections))]
+    for state, *blobs in sections:
+        items = [json.dumps(state, separators=(',', ':')).encode()] + list(blobs)
+        parts.append(struct.pack('<H', len(items)))
+        for item in items:
+            parts.append(struct.pack('<I', len(item)))
+            parts.append(item)
+    return b''.join(parts)
+
+
+def decode_checkpoint(data):
+    """
+    Restores the sections of a checkpoint serialized with encode_checkpoint.
+    :param data: bytes
+    :return: The unix time of the checkpoint, and the list of (state dictionary, bytes...) tuples
+    """
+    if len(data) < HEADER.size:
+        raise ValueError('Not a checkpoint')
+    magic, version, created, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a checkpoint of a supported version')
+    offset = HEADER.size
+    sections = list()
+    for _ in range(count):
+        (items,) = struct.unpack_from('<H', data, offset)
+        offset += 2
+        section = list()
+        for _ in range(items):
+            (length,) = struct.unpack_from('<I', data, offset)
+            offset += 4
+            section.append(data[offset:offset + length])
+            offset += length
+        sections.append((json.loads(section[0]), *section[1:]))
+    return created, sections
+
+
+def write_file(path, data):
+    """ Replaces the file with the data, through a temporary file so a crash never leaves half a checkpoint """
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+class CheckpointStore:
+    def __init__(self, path=None, key=KEY):
+        """
+        Stores the checkpoint in a local file when a PATH is configured, else as a blob in the snapshot Redis, so it
+        survives the container of the worker. Without either checkpoints are off.
+        :param path: The file, defaults to CHECKPOINT['PATH']
+        :param key: The Redis key
+        """
+        self.path = path or checkpoint_setting('PATH')
+        self.key = key
+
+    def enabled(self):
+        return bool(self.path) or SNAPSHOT.get_client() is not None
+
+    async def save(self, data):
+        """ :param data: The checkpoint, from encode_checkpoint """
+        if self.path:
+            await asyncio.get_event_loop().run_in_executor(None, write_file, self.path, data)
+            return
+        await SNAPSHOT.get_client().set(self.key, data)
+
+    async def load(self):
+        """ :return: The stored checkpoint, or None """
+        if self.path:
+            return await asyncio.get_event_loop().run_in_executor(None, read_file, self.path)
+        return await SNAPSHOT.get_client().get(self.key)
+
+
+CHECKPOINTS = CheckpointStore()
@@ -1,77 +1,51 @@
-import asyncio
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
-from os import environ
-from tweepy import TweepyException, StreamRule
-from .models import StreamRules, Tweet
-from .livetweets import LiveStream, EngagementTracker, set_rules_to_inactive
+from .ingest import INGEST_CHANNEL
+from .monitor import MONITOR
+from .workspaces import DEFAULT_WORKSPACE, get_workspace
 
-TWITTER_BEARER_TOKEN = environ['TWITTER_BEARER_TOKEN']
+CONTROL_COMMANDS = ('loadstream', 'startstream', 'stopstream', 'rulelist', 'deleterules')
 
-""" Helper functions for sync_to_async """
-def get_dupe_rule_ids(tag):
-    """
-    Takes in a rule tag and returns the ids of rules with this tag
-    :param tag: The tag attribute of a rule
-    :return: The ids of rules with the provided tag
-    """
-    dupes = StreamRules.objects.filter(tag=tag)
-    ids = [item[0] for item in dupes.values_list('id')]
-    return ids
 
-
-def get_tweet_time(tweetid):
+def timed(event, message):
     """
-    Takes a tweetid and returns the time the tweet was created
-    :param tweetid: A tweetid as a string
-    :return: The 'created_at' attribute of the tweet
+    Passes the unix time a load test event was sent at (see loadtest.py) on to the client.
+    :param event: The message received over the group channel
+    :param message: The message for the websocket
+    :return: The message as a string
     """
-    tweet = Tweet.objects.get(pk=tweetid)
-    time = tweet.created_at
-    return time
+    if 'sent' in event:
+        message['sent'] = event['sent']
+    return json.dumps(message)
 
 
 """ The consumer class for our Websocket"""
 class TweetConsumer(AsyncWebsocketConsumer):
-    def __init__(self, *args, **kwargs):
-        """
-        In addition to the inbuilt functions, we are also giving the consumers variables we need for some of
-        the operations we want to perform.
-        :param args:
-        :param kwargs:
-        """
-        super().__init__(*args, **kwargs)
-        self.STREAM = None
-        self.session = None
-        self.engagement_tracker = EngagementTracker(TWITTER_BEARER_TOKEN)
-
     async def connect(self):
         """
-        Currently only connects to the 'tweet' group. For multiple concurrent connections, the consumer
-        should receive a group through the URL request, and connect to that instead.
-        Accept any incoming connection.
-        """
-        await self.channel_layer.group_add('tweet', self.channel_name)
+        Connects to the group of the workspace in the URL (ws/tweets/<workspace>, ws/tweets for the default
+        workspace). The connection is refused if the workspace is not configured, or already has its MAX_CLIENTS on
+        this worker.
+        Send the last known state of the workspace's stream in a single 'snapshot' message, so the dashboard can be
+        drawn without waiting for the next update.
+        The first connection starts the event loop monitor of this worker.
+        """
+        MONITOR.start()
+        self.workspace = get_workspace(self.scope['url_route']['kwargs'].get('workspace', DEFAULT_WORKSPACE))
+        if self.workspace is None or not self.workspace.join():
+            self.workspace = None
+            await self.close()
+            return
+        await self.channel_layer.group_add(self.workspace.group, self.channel_name)
         await self.accept()
+        await self.send(text_data=await self.workspace.snapshot.get_frame())
 
     async def receive(self, text_data=None, bytes_data=None):
         """
-        Catch incoming messages from the websocket and perform the associated task.
-        The tasks are referred to in the 'task' attribute.
-        We are currently handling the following tasks:
-
-        'loadstream': Initiates the LiveStream instance runs the class' 'update_rules_from_twitter' method,
-        and sends the message "Stream initiated" back to the websocket.
-
-        'startstream': Establishes the connection to twitter, and starts receiving tweets.
-
-        'stopstream': Stops the streaming connection to twitter. Also stops the engagement tracking loop.
-
-        'rulelist': Reads the 'rules' attribute of the message, checks the database for duplicate rules, deletes any
-        duplicate rules from twitter, and finally adds the new rules to the stream.
-
-        'deleterules': Deletes any rules from twitter, and sets them to "inactive" in the database.
+        Catch incoming messages from the websocket and forward the commands to the ingest worker
+        (manage.py ingest), which owns the stream. See IngestController.handle for the commands; 'startstream' takes
+        an optional field 'profile', see ingest.STREAM_PROFILES.
+        Replies to the command come back to this consumer as 'status' or 'rulestatus' messages.
 
         :param text_data: The text_data from the websocket
         :param bytes_data: The bytes_data from the websocket
@@ -79,128 +53,45 @@ class TweetConsumer(AsyncWebsocketConsumer):
         """
         print('Receive: ', text_data)
         data = json.loads(text_data)
-        if data['type'] == 'loadstream':
-            if self.STREAM is not None:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'Stream already initiated'}))
-                return
-            self.STREAM = LiveStream(bearer_token=TWITTER_BEARER_TOKEN)
-            await self.STREAM.update_rules_from_twitter()
-            await self.send(text_data=json.dumps({
-                'type': 'status',
-                'stream': 'Stream initiated'}))
-        if data['type'] == 'startstream':
-            if self.STREAM is None:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'No active stream'}))
-                return
-            try:
-                res = self.STREAM.filter(
-                    tweet_fields=['id', 'text', 'attachments', 'author_id', 'context_annotations', 'conversation_id',
-                                  'created_at', 'entities', 'geo', 'in_reply_to_user_id', 'lang', 'possibly_sensitive',
-                                  'public_metrics', 'referenced_tweets', 'reply_settings', 'source', 'withheld'],
-                    expansions=['entities.mentions.username', 'geo.place_id', 'author_id', 'attachments.media_keys'],
-                    place_fields=['contained_within', 'country', 'country_code', 'full_name', 'name', 'place_type'],
-                    media_fields=['url', 'preview_image_url'])
-                print(res)
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'Stream connecting'}))
-            except TweepyException:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': f'{TweepyException}'}))
-
-        if data['type'] == 'stopstream':
-            if self.STREAM is None:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'No active stream'}))
-                return
-            self.STREAM.disconnect()
-            await self.send(
-                text_data=json.dumps({'type': 'status', 'stream': 'Disconnect signal sent'}))
-            self.engagement_tracker.tracking = False
-
-        if data['type'] == 'rulelist':
-            if self.STREAM is None:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'No active stream'}))
-                return
-            rulelist = list()
-            dupes = list()
-
-            for rule in data['rules']:
-                if rule['value']:
-                    r = StreamRule(
-                        value=rule['value'],
-                        tag=rule['tag'],
-                    )
-                    ids = await sync_to_async(get_dupe_rule_ids)(rule['tag'])
-                    for id in ids:
-                        dupes.append(id)
-                    rulelist.append(r)
-            if dupes:
-                await self.STREAM.delete_rules(dupes)
-            await self.STREAM.add_rules(rulelist)
-            await self.STREAM.update_rules_from_twitter()
-
-        if data['type'] == 'deleterules':
-            if self.STREAM is None:
-                await self.send(text_data=json.dumps({
-                    'type': 'status',
-                    'stream': 'No active stream'}))
-                return
-            ids = list()
-            rules = await self.STREAM.get_rules()
-            if rules[0] is not None:
-                for rule in rules[0]:
-                    ids.append(rule.id)
-                await self.STREAM.delete_rules(ids)
-                rules = await self.STREAM.get_rules()
-            if rules.data is None:
-                await self.send(text_data=json.dumps({
-                    'type': 'rulestatus',
-                    'stream': 'No rules stored in stream'}))
-                await sync_to_async(set_rules_to_inactive)()
+        if data['type'] not in CONTROL_COMMANDS:
+            return
+        await self.channel_layer.send(INGEST_CHANNEL, {
+            'type': 'control',
+            'command': data['type'],
+            'workspace': self.workspace.name,
+            'rules': data.get('rules', []),
+            'profile': data.get('profile'),
+            'reply_channel': self.channel_name
+        })
 
     async def disconnect(self, code):
         """
-        Recieved upon a connection dropping from the websocket.
-        In that case we stop the engagement tracking, disconnect the stream, and unsubscribe from the 'tweet'
-        channel.
+        Recieved upon a connection dropping from the websocket. We unsubscribe from the group of the workspace; the
+        stream keeps running in the ingest worker.
         :param code: The disconnection code received from the websocket
         """
-        self.engagement_tracker.tracking = False
-        if self.STREAM is not None:
-            self.STREAM.disconnect()
-        await self.channel_layer.group_discard('tweet', self.channel_name)
+        if getattr(self, 'workspace', None) is None:
+            return
+        self.workspace.leave()
+        await self.channel_layer.group_discard(self.workspace.group, self.channel_name)
 
     async def tweet(self, event):
         """
-        Upon receiving a tweet over the group_channel sends the tweet ID, the matching filter(s)
-        to the consumers, and starts the engagement tracking if its not already running.
-
-        TODO: Expand this, along with the associated part of the LiveStream on_response method to send the tweet
-        TODO: data needed to draw the tweet, as well as the created_at parameter for the engagement_update function
-
+        Upon receiving a tweet over the group_channel sends the tweet ID, the matching filter(s) and the card with
+        the data needed to draw the tweet (see cards.build_card) to the consumers.
+        The card is kept in the card cache of the workspace in this worker, so the dashboards drawing the trending
+        tweets get it from /api/card without a Redis read.
         :param event: The message received over the group channel.
         """
         print('Tweet: ', event)
-        await self.send(text_data=json.dumps({
+        if event.get('card'):
+            self.workspace.cards.remember(event['id'], event['card'])
+        await self.send(text_data=timed(event, {
             'type': event['type'],
             'id': event['id'],
-            'filters': event['filters']
+            'filters': event['filters'],
+            'card': event.get('card')
         }))
-        if not self.engagement_tracker.tracking:
-            self.engagement_tracker.tracking = True
-            a = asyncio.get_event_loop()
-            starttime = await sync_to_async(get_tweet_time)(event['id'])
-            a.create_task(self.engagement_tracker.periodic_update(30, self.engagement_tracker.engagement_update,
-                                                                  starttime=starttime))
 
     async def status(self, event):
         """
@@ -213,6 +104,16 @@ class TweetConsumer(AsyncWebsocketConsumer):
             'stream': event['message']
         }))
 
+    async def rulestatus(self, event):
+        """
+        When receiving the status of the rules from the ingest worker, forward it over the websocket
+        :param event: The message received from the ingest worker.
+        """
+        await self.send(text_data=json.dumps({
+            'type': event['type'],
+            'stream': event['message']
+        }))
+
     async def rule(self, event):
         """
         When receiving a rule over the group channel, forward it over the websocket
@@ -230,7 +131,7 @@ class TweetConsumer(AsyncWebsocketConsumer):
         When receiving hashtags mentions and contexts, forward them over the websocket.
         :param event: The message received over the group channel.
         """
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=timed(event, {
             'type': event['type'],
             'hashtags': event['hashtags'],
             'mentions': event['mentions'],
@@ -242,8 +143,7 @@ class TweetConsumer(AsyncWebsocketConsumer):
         When receiving tweet metrics, forward them over the websocket.
         :param event: The message received over the group channel.
         """
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=timed(event, {
             'type': event['type'],
             'results': event['results']
         }))
-
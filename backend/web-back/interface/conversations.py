@@ -0,0 +1,74 @@
+from django.db.models import Count
+
+from .models import Tweet, ReferencedTweet
+from .routers import replica_reads
+
+
+""" Helper functions for the reference edges and conversation threads of tweets """
+def thread_path(tweet_id, conversation_id, parent_id=None):
+    """
+    Builds the materialized path of a tweet: the ids from the conversation root down to the tweet, '/' separated.
+    Sorting the tweets of a conversation by their path gives the thread in depth-first order.
+    If the parent has not been stored, it is placed directly below the root.
+    :param tweet_id: The id of the tweet
+    :param conversation_id: The id of the first tweet of the conversation
+    :param parent_id: The id of the tweet replied to, if any
+    :return: The path as a string
+    """
+    if parent_id is None:
+        return tweet_id if tweet_id == conversation_id else f'{conversation_id}/{tweet_id}'
+    parent = Tweet.objects.filter(id=parent_id).values_list('thread_path', flat=True).first()
+    if not parent:
+        parent = thread_path(parent_id, conversation_id)
+    return f'{parent}/{tweet_id}'[:1024]
+
+
+def add_references(tweet, references):
+    """
+    Stores the reference edges of a tweet with one bulk insert.
+    :param tweet: The stored Tweet object
+    :param references: The 'referenced_tweets' list of the tweet data, dictionaries with 'type' and 'id'
+    """
+    ReferencedTweet.objects.bulk_create([
+        ReferencedTweet(
+            tweetid=str(reference['id']),
+            type=reference['type'],
+            source=tweet,
+            conversation_id=tweet.conversation_id,
+            created_at=tweet.created_at
+        ) for reference in references
+    ])
+
+
+@replica_reads
+def get_thread(conversation_id, workspace):
+    """
+    Gets the stored tweets of a conversation in thread order, with one query on the conversation_id index.
+    :param conversation_id: The id of the conversation
+    :param workspace: The name of the workspace the tweets were stored in
+    :return: List of dictionaries with the id, author, text, creation time and depth of the tweets
+    """
+    tweets = Tweet.objects.filter(conversation_id=conversation_id, workspace=workspace).order_by('thread_path').values(
+        'id', 'author_id', 'text', 'created_at', 'thread_path')
+    return [{
+        'id': tweet['id'],
+        'author_id': tweet['author_id'],
+        'text': tweet['text'],
+        'created_at': tweet['created_at'],
+        'depth': tweet['thread_path'].count('/'),
+    } for tweet in tweets]
+
+
+@replica_reads
+def get_top_referenced(since, workspace, type='quoted', n=10):
+    """
+    Gets the tweets referenced most since a point in time, with one query on the (type, created_at) index.
+    :param since: Datetime object
+    :param workspace: The name of the workspace of the referencing tweets
+    :param type: 'quoted', 'replied_to' or 'retweeted'
+    :param n: The number of tweets to return
+    :return: List of dictionaries with the 'id' and 'count' of the referenced tweets, highest first
+    """
+    refs = ReferencedTweet.objects.filter(type=type, created_at__gte=since, source__workspace=workspace).values(
+        'tweetid').annotate(count=Count('id')).order_by('-count')[:n]
+    return [{'id': ref['tweetid'], 'count': ref['count']} for ref in refs]
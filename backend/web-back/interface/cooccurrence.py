@@ -0,0 +1,232 @@
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import combinations
+
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Cooccurrence
+from .routers import replica_reads
+
+
+""" Hashtag and mention co-occurrence graph of each workspace, kept up to date at ingest """
+RETENTION_DAYS = 30                 # Days the stored edges are kept
+
+
+def tweet_nodes(tweet):
+    """
+    Gets the graph nodes of a tweet: its hashtags prefixed with '#' and its mentions prefixed with '@'.
+    :param tweet: The tweet from Tweepy, or its data dictionary
+    :return: Sorted list of unique nodes
+    """
+    entities = tweet['entities'] if 'entities' in tweet else None
+    if not entities:
+        return []
+    nodes = {'#' + hashtag['tag'] for hashtag in entities.get('hashtags', [])}
+    nodes.update('@' + mention['username'] for mention in entities.get('mentions', []))
+    return sorted(nodes)
+
+
+class CooccurrenceGraph:
+    def __init__(self, bucket_seconds=300, window=12, min_weight=2):
+        """
+        A sparse adjacency map: node -> neighbour -> {bucket: count}. Both directions of an edge share the same
+        bucket dictionary, so each co-occurrence is counted once.
+        When a new bucket starts, the buckets older than the window are dropped, the buckets not yet stored are
+        queued for the database, and edges below 'min_weight' within the window are pruned to bound the memory.
+        :param bucket_seconds: The length of a bucket in seconds
+        :param window: The number of buckets kept in memory
+        :param min_weight: Edges with a lower weight in the window are pruned when a bucket closes
+        """
+        self.bucket_seconds = bucket_seconds
+        self.window = window
+        self.min_weight = min_weight
+        self.adjacency = defaultdict(dict)
+        self.current = None
+        self.pending = list()
+
+    def add_tweet(self, tweet, now=None):
+        """
+        Counts every pair of hashtags and mentions in a tweet.
+        :param tweet: The tweet from Tweepy, or its data dictionary
+        :param now: Unix timestamp to count the tweet at, defaults to the current time
+        """
+        nodes = tweet_nodes(tweet)
+        if len(nodes) < 2:
+            return
+        index = int((time.time() if now is None else now) // self.bucket_seconds)
+        if self.current is None:
+            self.current = index
+        if index > self.current:
+            self.rotate(index)
+        for a, b in combinations(nodes, 2):
+            buckets = self.adjacency[a].get(b)
+            if buckets is None:
+                buckets = dict()
+                self.adjacency[a][b] = buckets
+                self.adjacency[b][a] = buckets
+            buckets[index] = buckets.get(index, 0) + 1
+
+    def rotate(self, index):
+        """
+        Starts a new bucket: queues the edges of the closed buckets to be stored, drops the expired buckets and
+        prunes the low weight edges.
+        :param index: The index of the new bucket
+        """
+        oldest = index - self.window + 1
+        for a, neighbours in list(self.adjacency.items()):
+            for b, buckets in list(neighbours.items()):
+                if a > b:
+                    continue
+                for i, count in buckets.items():
+                    if self.current <= i < index:
+                        self.pending.append((i, a, b, count))
+                for i in [i for i in buckets if i < oldest]:
+                    del buckets[i]
+                if sum(buckets.values()) < self.min_weight:
+                    del self.adjacency[a][b]
+                    del self.adjacency[b][a]
+        for node in [node for node, neighbours in self.adjacency.items() if not neighbours]:
+            del self.adjacency[node]
+        self.current = index
+
+    def pop_pending(self):
+        """
+        Takes the queued edges of closed buckets, to be stored with save_cooccurrence.
+        :return: List of (bucket, source, target, weight) tuples
+        """
+        pending, self.pending = self.pending, list()
+        return pending
+
+    def neighbours(self, node, n=10, minutes=60, now=None):
+        """
+        Gets the nodes co-occurring most with a node.
+        :param node: A hashtag prefixed with '#' or a mention prefixed with '@'
+        :param n: How many neighbours to return
+        :param minutes: How far back to count, limited by the window kept in memory
+        :param now: Unix timestamp, defaults to the current time
+        :return: List of (node, weight) tuples, largest first
+        """
+        now = time.time() if now is None else now
+        oldest = int((now - minutes * 60) // self.bucket_seconds) + 1
+        weights = list()
+        for neighbour, buckets in self.adjacency.get(node, {}).items():
+            weight = sum(count for i, count in buckets.items() if i >= oldest)
+            if weight:
+                weights.append((neighbour, weight))
+        return sorted(weights, key=lambda kv: kv[1], reverse=True)[:n]
+
+    def minutes(self):
+        """ :return: The minutes covered by the window kept in memory """
+        return self.window * self.bucket_seconds // 60
+
+    def state(self):
+        """
+        :return: The edges in memory (with the open bucket, which is not stored yet) and the queued edges, to checkpoint
+        """
+        edges = [[a, b, list(buckets.items())] for a, neighbours in self.adjacency.items()
+                 for b, buckets in neighbours.items() if a < b]
+        return {'current': self.current, 'pending': self.pending, 'edges': edges}
+
+    def restore(self, state):
+        """
+        Restores a checkpointed state. The restored open bucket is stored when the next bucket starts, as usual.
+        :param state: Dictionary from state()
+        """
+        self.adjacency = defaultdict(dict)
+        for a, b, buckets in state['edges']:
+            buckets = {i: count for i, count in buckets}
+            self.adjacency[a][b] = buckets
+            self.adjacency[b][a] = buckets
+        self.current = state['current']
+        self.pending = [tuple(edge) for edge in state['pending']]
+
+    def to_adjacency(self):
+        """
+        Exports the graph in memory as a compact adjacency list, summed over the window.
+        :return: Dictionary of node -> list of [neighbour, weight]
+        """
+        return {node: [[b, sum(buckets.values())] for b, buckets in neighbours.items()]
+                for node, neighbours in self.adjacency.items()}
+
+
+COOCCURRENCE = CooccurrenceGraph()
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def save_cooccurrence(edges, bucket_seconds, workspace):
+    """
+    Stores the edges of closed buckets. A bucket is only stored once it is closed, so the rows are never updated.
+    :param edges: List of (bucket, source, target, weight) tuples from CooccurrenceGraph.pop_pending
+    :param bucket_seconds: The length of a bucket in seconds
+    :param workspace: The name of the workspace of the graph
+    """
+    Cooccurrence.objects.bulk_create([
+        Cooccurrence(
+            source=a,
+            target=b,
+            time=datetime.fromtimestamp(i * bucket_seconds, tz=dt_timezone.utc),
+            weight=count,
+            workspace=workspace
+        ) for i, a, b, count in edges
+    ], batch_size=1000)
+
+
+def purge_cooccurrence(now=None, days=RETENTION_DAYS):
+    """
+    Deletes the stored edges older than the retention, run as a job of the ingest worker.
+    :param now: Datetime to compute the retention from, defaults to now
+    :param days: Days the edges are kept
+    """
+    Cooccurrence.objects.filter(time__lt=(now or timezone.now()) - timedelta(days=days)).delete()
+
+
+@replica_reads
+def stored_neighbours(workspace, node, since, n=10):
+    """
+    Gets the nodes co-occurring most with a node from the stored edges, for ranges longer than the window in memory.
+    The bucket still open in the ingest worker is not stored yet.
+    :param workspace: The name of the workspace
+    :param node: A hashtag prefixed with '#' or a mention prefixed with '@'
+    :param since: Datetime, only the edges stored from then
+    :param n: How many neighbours to return
+    :return: List of (node, weight) tuples, largest first
+    """
+    edges = Cooccurrence.objects.filter(workspace=workspace, time__gte=since)
+    weights = Counter()
+    for row in edges.filter(source=node).values('target').annotate(weight=Sum('weight')):
+        weights[row['target']] += row['weight']
+    for row in edges.filter(target=node).values('source').annotate(weight=Sum('weight')):
+        weights[row['source']] += row['weight']
+    return weights.most_common(n)
+
+
+def export_adjacency(out, workspace, since=None):
+    """
+    Writes the stored graph of a workspace as an adjacency list, one node per line: the node, a tab, and its
+    neighbours as space separated neighbour:weight pairs. Each edge is written once, from the node sorting first.
+    :param out: A text file object to write to
+    :param workspace: The name of the workspace
+    :param since: Only count edges stored from this datetime, defaults to all
+    :return: The number of nodes written
+    """
+    edges = Cooccurrence.objects.filter(workspace=workspace)
+    if since is not None:
+        edges = edges.filter(time__gte=since)
+    edges = edges.values('source', 'target').annotate(weight=Sum('weight')).order_by('source')
+    nodes = 0
+    source = None
+    line = list()
+    for edge in edges.iterator():
+        if edge['source'] != source:
+            if line:
+                out.write(f"{source}\t{' '.join(line)}\n")
+                nodes += 1
+            source = edge['source']
+            line = list()
+        line.append(f"{edge['target']}:{edge['weight']}")
+    if line:
+        out.write(f"{source}\t{' '.join(line)}\n")
+        nodes += 1
+    return nodes
@@ -0,0 +1,142 @@
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import TweetCube
+from .routers import replica_reads
+
+
+""" Tweet counts pre-aggregated by time bucket, rule tag, language, source and sensitivity """
+RESOLUTIONS = (60, 3600, 86400)             # Seconds per bucket; the minute counts are rolled up into hours and days
+DIMENSIONS = ('tag', 'lang', 'source', 'possibly_sensitive')
+RETENTION = {60: 2, 3600: 90}               # Days the buckets are kept, the daily buckets are kept forever
+
+
+def tweet_minute(tweet):
+    """
+    :param tweet: The data dictionary of the tweet
+    :return: The unix time of the minute the tweet was created in, or of the current minute without a creation time
+    """
+    created = parse_datetime(tweet['created_at']) if tweet.get('created_at') else None
+    return int((created or timezone.now()).timestamp()) // 60 * 60
+
+
+def roll_up(cells, dimensions):
+    """
+    :param cells: List of (minute, *dimension values, count) tuples, the minute as a unix timestamp
+    :param dimensions: The names of the dimension fields, in the order of the values
+    :return: Counter of the cells at every resolution, as tuples of (field, value) pairs
+    """
+    counts = Counter()
+    for minute, *values, count in cells:
+        for resolution in RESOLUTIONS:
+            bucket = datetime.fromtimestamp(minute // resolution * resolution, tz=dt_timezone.utc)
+            counts[(('resolution', resolution), ('bucket', bucket)) + tuple(zip(dimensions, values))] += count
+    return counts
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def add_counts(model, counts, workspace):
+    """
+    Adds counts to the stored cells, with one upsert per cell.
+    :param model: TweetCube or GeoCube
+    :param counts: Counter of cells, see roll_up
+    :param workspace: The name of the workspace counted
+    """
+    for cell, count in counts.items():
+        cell = dict(cell, workspace=workspace)
+        if model.objects.filter(**cell).update(count=F('count') + count):
+            continue
+        try:
+            with transaction.atomic():
+                model.objects.create(count=count, **cell)
+        except IntegrityError:                  # Created by a concurrent flush
+            model.objects.filter(**cell).update(count=F('count') + count)
+
+
+def save_cube(cells, workspace):
+    """
+    Adds the counts of flushed minute cells to the stored cube, at every resolution.
+    :param cells: List of (minute, tag, lang, source, possibly_sensitive, count) tuples from TweetCounter.flush,
+    the minute as a unix timestamp
+    :param workspace: The name of the workspace whose stream was counted
+    """
+    add_counts(TweetCube, roll_up(cells, DIMENSIONS), workspace)
+
+
+def purge_cube(now=None, model=TweetCube):
+    """
+    Deletes the buckets older than their RETENTION.
+    :param now: Datetime to compute the retention from, defaults to now
+    :param model: TweetCube or GeoCube
+    """
+    now = now or timezone.now()
+    for resolution, days in RETENTION.items():
+        model.objects.filter(resolution=resolution, bucket__lt=now - timedelta(days=days)).delete()
+
+
+@replica_reads
+def query_cube(workspace, resolution=60, start=None, end=None, by=('tag',), **equals):
+    """
+    Gets the tweet counts per bucket, broken down by some of the DIMENSIONS. Reads only the cube, so the cost depends
+    on the number of buckets and not on the number of tweets.
+    :param workspace: The name of the workspace
+    :param resolution: One of RESOLUTIONS
+    :param start: Datetime, only the buckets from the one containing it
+    :param end: Datetime, only buckets before then
+    :param by: The dimensions to break the counts down by, the others are summed
+    :param equals: Values of dimensions to filter on, e.g. tag='hashtagsfilter'
+    :return: List of dictionaries with the 'bucket', the 'by' dimensions and the 'count', in time order
+    """
+    cells = TweetCube.objects.filter(workspace=workspace, resolution=resolution, **equals)
+    if start is not None:
+        start = datetime.fromtimestamp(int(start.timestamp()) // resolution * resolution, tz=dt_timezone.utc)
+        cells = cells.filter(bucket__gte=start)
+    if end is not None:
+        cells = cells.filter(bucket__lt=end)
+    return list(cells.values('bucket', *by).annotate(count=Sum('count')).order_by('bucket', *by))
+
+
+class TweetCounter:
+    def __init__(self):
+        """
+        Counts the streamed tweets of a workspace per minute and cell in memory, until they are flushed to the stored
+        cube. A tweet matching several rules is counted once for each rule tag.
+        """
+        self.pending = Counter()        # (minute, tag, lang, source, possibly_sensitive) -> count
+
+    @staticmethod
+    def cells(tweet, filters=''):
+        """
+        :param tweet: The data dictionary of the tweet
+        :param filters: The tags of the matching rules, comma separated
+        :return: List of the (minute, tag, lang, source, possibly_sensitive) cells the tweet is counted in
+        """
+        minute = tweet_minute(tweet)
+        lang = (tweet.get('lang') or '')[:16]
+        source = (tweet.get('source') or '')[:128]
+        sensitive = bool(tweet.get('possibly_sensitive'))
+        return [(minute, tag[:128], lang, source, sensitive) for tag in (filters.split(', ') if filters else [''])]
+
+    def add_tweet(self, tweet, filters=''):
+        """
+        :param tweet: The data dictionary of the tweet
+        :param filters: The tags of the matching rules, comma separated
+        """
+        self.pending.update(self.cells(tweet, filters))
+
+    def flush(self):
+        """
+        :return: The pending cells as a list of (minute, tag, lang, source, possibly_sensitive, count), to be stored
+        with save_cube
+        """
+        cells = [key + (count,) for key, count in self.pending.items()]
+        self.pending = Counter()
+        return cells
+
+
+CUBE = TweetCounter()
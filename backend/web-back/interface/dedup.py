@@ -0,0 +1,203 @@
+import json
+import re
+import struct
+import time
+from collections import OrderedDict
+from hashlib import blake2b
+
+import numpy as np
+from django.conf import settings
+
+
+""" Near-duplicate clustering of the streamed tweets (retweet spam, copy-paste campaigns) with MinHash LSH """
+PRIME = (1 << 31) - 1               # Hashes and coefficients are below it, so their products fit in 64 bits
+RETWEET_PREFIX = re.compile(r'^rt @\w+:\s*')
+URL = re.compile(r'https?://\S+')
+WHITESPACE = re.compile(r'\s+')
+HEADER = struct.Struct('<4sHIIdd')
+MAGIC = b'DDUP'
+VERSION = 1
+
+
+def dedup_setting(name, default=None):
+    return getattr(settings, 'DEDUP', {}).get(name, default)
+
+
+def normalize(text):
+    """
+    Lowercases the text, and strips the retweet prefix and the urls (t.co links differ between copies of a tweet).
+    :param text: The text of a tweet
+    :return: The normalized text
+    """
+    text = RETWEET_PREFIX.sub('', text.lower())
+    return WHITESPACE.sub(' ', URL.sub('', text)).strip()
+
+
+def shingles(text, k=5):
+    """
+    :param text: Normalized text
+    :param k: Characters per shingle
+    :return: Set of the character k-grams of the text, or the text itself if it is shorter
+    """
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def shingle_hashes(items):
+    """
+    :param items: Set of shingles
+    :return: Array of their 31 bit hashes, stable across processes
+    """
+    return np.array([int.from_bytes(blake2b(item.encode(), digest_size=4).digest(), 'little') % PRIME
+                     for item in items], dtype=np.int64)
+
+
+class MinHash:
+    def __init__(self, num_perm=64, seed=1):
+        """
+        Signatures whose share of equal values estimates the Jaccard similarity of the shingle sets.
+        :param num_perm: Number of hash functions, i.e. the length of the signatures
+        :param seed: Seed of the hash functions; signatures are only comparable with the same seed and num_perm
+        """
+        generator = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = generator.randint(1, PRIME, size=num_perm, dtype=np.int64)
+        self.b = generator.randint(0, PRIME, size=num_perm, dtype=np.int64)
+
+    def signature(self, hashes):
+        """
+        :param hashes: Array of shingle hashes, see shingle_hashes
+        :return: Array of the num_perm minimums
+        """
+        return ((np.outer(hashes, self.a) + self.b) % PRIME).min(axis=0)
+
+
+class DuplicateIndex:
+    def __init__(self, num_perm=64, bands=16, threshold=0.8, ttl=3600):
+        """
+        Assigns every tweet to a cluster of near-duplicates. The signatures are split into bands, and tweets sharing
+        any band are candidates; a candidate is confirmed when the signatures estimate a Jaccard similarity of at least
+        'threshold'. A cluster is named after its first tweet, and forgotten 'ttl' seconds after its last one.
+        :param num_perm: Length of the MinHash signatures
+        :param bands: Number of bands, must divide num_perm. More bands find less similar candidates.
+        :param threshold: Estimated Jaccard similarity of a duplicate
+        :param ttl: Seconds a cluster is kept after its last tweet
+        """
+        self.minhash = MinHash(num_perm)
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.threshold = threshold
+        self.ttl = ttl
+        self.buckets = OrderedDict()        # (band, band bytes) -> (cluster id, last seen), oldest first
+        self.clusters = OrderedDict()       # cluster id -> signature, size, text and last seen, oldest first
+
+    def expire(self, now):
+        horizon = now - self.ttl
+        while self.clusters and next(iter(self.clusters.values()))['last_seen'] < horizon:
+            self.clusters.popitem(last=False)
+        while self.buckets and next(iter(self.buckets.values()))[1] < horizon:
+            self.buckets.popitem(last=False)
+
+    def keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def add(self, tweet_id, text, now=None):
+        """
+        :param tweet_id: The id of the tweet
+        :param text: The text of the tweet
+        :param now: Unix time of the tweet, defaults to now
+        :return: Tuple of the cluster id, and whether the tweet is a duplicate (the cluster has an earlier tweet)
+        """
+        now = now if now is not None else time.time()
+        self.expire(now)
+        hashes = shingle_hashes(shingles(normalize(text)))
+        if not len(hashes):
+            return tweet_id, False
+        signature = self.minhash.signature(hashes)
+        keys = self.keys(signature)
+        best, similarity = None, self.threshold
+        for key in keys:
+            candidate = self.buckets.get(key, (None,))[0]
+            cluster = self.clusters.get(candidate)
+            if cluster is None or candidate == best:
+                continue
+            estimate = float(np.mean(cluster['signature'] == signature))
+            if estimate >= similarity:
+                best, similarity = candidate, estimate
+        cluster_id = best or tweet_id
+        if best is None:
+            self.clusters[cluster_id] = {'signature': signature, 'size': 0, 'text': text, 'first_seen': now}
+        cluster = self.clusters[cluster_id]
+        cluster['size'] += 1
+        cluster['last_seen'] = now
+        self.clusters.move_to_end(cluster_id)
+        for key in keys:                    # Variants of the tweet are matched against the latest one too
+            self.buckets[key] = (cluster_id, now)
+            self.buckets.move_to_end(key)
+        return cluster_id, best is not None
+
+    def top(self, n=10):
+        """
+        :param n: The number of clusters
+        :return: List of the n largest clusters with duplicates: their id (the first tweet), size, text and first and
+        last seen unix times
+        """
+        clusters = sorted(((cluster_id, cluster) for cluster_id, cluster in self.clusters.items()
+                           if cluster['size'] > 1), key=lambda item: item[1]['size'], reverse=True)
+        return [{'id': cluster_id, 'size': cluster['size'], 'text': cluster['text'],
+                 'first_seen': cluster['first_seen'], 'last_seen': cluster['last_seen']}
+                for cluster_id, cluster in clusters[:n]]
+
+    def to_bytes(self):
+        """
+        Serializes the clusters and buckets, e.g. to checkpoint them: a header, the clusters and buckets as JSON, the
+        raw signatures of the clusters and the raw band values of the buckets, oldest first.
+        :return: bytes
+        """
+        clusters, buckets = list(self.clusters.items()), list(self.buckets.items())
+        meta = json.dumps({
+            'clusters': [[cluster_id, cluster['size'], cluster['text'], cluster['first_seen'], cluster['last_seen']]
+                         for cluster_id, cluster in clusters],
+            'buckets': [[band, cluster_id, seen] for (band, _), (cluster_id, seen) in buckets]}).encode()
+        parts = [HEADER.pack(MAGIC, VERSION, self.minhash.num_perm, self.bands, self.threshold, self.ttl),
+                 struct.pack('<I', len(meta)), meta]
+        parts.extend(cluster['signature'].astype(np.int64).tobytes() for _, cluster in clusters)
+        parts.extend(key for (_, key), _ in buckets)
+        return b''.join(parts)
+
+    def load(self, data, now=None):
+        """
+        Replaces the clusters and buckets with ones serialized by to_bytes, in place since the workspace and its
+        stream hold the index. The clusters expired since are dropped.
+        :param data: bytes
+        :param now: Unix time, defaults to now
+        """
+        magic, version, num_perm, bands, _, _ = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or (num_perm, bands) != (self.minhash.num_perm, self.bands):
+            raise ValueError('Not a duplicate index of a supported version and size')
+        offset = HEADER.size
+        (length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        meta = json.loads(data[offset:offset + length])
+        offset += length
+        clusters = OrderedDict()
+        for cluster_id, size, text, first_seen, last_seen in meta['clusters']:
+            clusters[cluster_id] = {'signature': np.frombuffer(data, np.int64, num_perm, offset).copy(), 'size': size,
+                                    'text': text, 'first_seen': first_seen, 'last_seen': last_seen}
+            offset += 8 * num_perm
+        buckets = OrderedDict()
+        for band, cluster_id, seen in meta['buckets']:
+            buckets[(band, bytes(data[offset:offset + 8 * self.rows]))] = (cluster_id, seen)
+            offset += 8 * self.rows
+        self.clusters, self.buckets = clusters, buckets
+        self.expire(time.time() if now is None else now)
+
+
+def duplicate_index():
+    """ :return: A DuplicateIndex configured by the DEDUP settings """
+    return DuplicateIndex(num_perm=dedup_setting('NUM_PERM', 64), bands=dedup_setting('BANDS', 16),
+                          threshold=dedup_setting('THRESHOLD', 0.8), ttl=dedup_setting('TTL', 3600))
+
+
+DEDUP = duplicate_index()
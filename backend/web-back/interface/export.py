@@ -0,0 +1,121 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .models import Tweet, TweetMetrics, Hashtag, Mention, ContextEntity
+from .routers import replica_reads
+
+
+""" Streaming exports of the stored data as NDJSON or CSV """
+EXPORTS = {
+    'tweets': ('id', 'text', 'author_id', 'conversation_id', 'created_at', 'in_reply_to_user_id', 'lang',
+               'possibly_sensitive', 'reply_settings', 'source', 'filters'),
+    'metrics': ('tweetid', 'time', 'retweet_count', 'reply_count', 'like_count', 'quote_count'),
+    'hashtags': ('hashtag', 'count'),
+    'mentions': ('mention', 'count'),
+    'contexts': ('domain__dom_id', 'domain__name', 'ent_id', 'name', 'count'),
+}
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def tag_filter(field, tag):
+    """
+    Matches one tag in a comma separated list of rule tags, without matching tags that merely contain it.
+    :param field: The name of the field holding the tags
+    :param tag: The tag to match
+    :return: Q object
+    """
+    return (Q(**{field: tag}) | Q(**{f'{field}__startswith': tag + ', '}) |
+            Q(**{f'{field}__endswith': ', ' + tag}) | Q(**{f'{field}__contains': ', ' + tag + ', '}))
+
+
+def export_queryset(kind, workspace, start=None, end=None, tag=None, lang=None):
+    """
+    Builds the queryset of an export of a workspace. The time range, rule tag and language filter the tweets and
+    metrics. The entity exports are the all-time counts, and are only filtered by the workspace.
+    :param kind: One of the EXPORTS keys
+    :param workspace: The name of the workspace
+    :param start: Datetime, only rows from then
+    :param end: Datetime, only rows before then
+    :param tag: Rule tag the tweets must have matched
+    :param lang: Language of the tweets
+    :return: QuerySet
+    """
+    if kind == 'tweets':
+        queryset = Tweet.objects.filter(workspace=workspace)
+        time, tweet = 'created_at', ''
+    elif kind == 'metrics':
+        queryset = TweetMetrics.objects.filter(tweetid__workspace=workspace)
+        time, tweet = 'time', 'tweetid__'
+    else:
+        return {'hashtags': Hashtag, 'mentions': Mention, 'contexts': ContextEntity}[kind].objects.filter(
+            workspace=workspace)
+    if start is not None:
+        queryset = queryset.filter(**{f'{time}__gte': start})
+    if end is not None:
+        queryset = queryset.filter(**{f'{time}__lt': end})
+    if tag:
+        queryset = queryset.filter(tag_filter(f'{tweet}filters', tag))
+    if lang:
+        queryset = queryset.filter(**{f'{tweet}lang': lang})
+    return queryset
+
+
+@replica_reads
+def fetch_chunk(queryset, fields, chunk_size):
+    """ Reads one chunk of rows, with the primary key first """
+    return list(queryset.values_list('pk', *fields)[:chunk_size])
+
+
+def iterate_rows(queryset, fields, chunk_size=2000):
+    """
+    Iterates over the rows of a queryset in primary key order, reading one chunk at a time.
+    Every chunk is a separate query continuing after the last key, so the memory used is constant on MySQL as
+    well, where .iterator() still loads the whole result into the client.
+    :param queryset: QuerySet to iterate over
+    :param fields: The fields to read
+    :param chunk_size: Rows read per query
+    :return: Generator of lists of value tuples, one list per chunk
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        rows = fetch_chunk(chunk, fields, chunk_size)
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+class Echo:
+    """ A file-like object returning what is written to it, for csv.writer """
+    def write(self, value):
+        return value
+
+
+def export_chunks(kind, fmt='ndjson', chunk_size=2000, **filters):
+    """
+    Generates an export as text, one chunk of rows at a time.
+    :param kind: One of the EXPORTS keys
+    :param fmt: One of the FORMATS keys
+    :param chunk_size: Rows per chunk
+    :param filters: workspace, start, end, tag and lang, see export_queryset
+    :return: Generator of strings
+    """
+    fields = EXPORTS[kind]
+    queryset = export_queryset(kind, **filters)
+    if fmt == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        for rows in iterate_rows(queryset, fields, chunk_size):
+            yield ''.join(writer.writerow(row) for row in rows)
+    else:
+        encoder = DjangoJSONEncoder(separators=(',', ':'), ensure_ascii=False)
+        for rows in iterate_rows(queryset, fields, chunk_size):
+            yield ''.join(encoder.encode(dict(zip(fields, row))) + '\n' for row in rows)
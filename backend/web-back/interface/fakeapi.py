@@ -0,0 +1,135 @@
+import itertools
+import random
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+
+""" A local fake of the Twitter API endpoints the ingest worker calls, sending the x-rate-limit-* headers, to run the
+API scheduler against (see RATELIMIT['API_URL'] and the fakeapi command) """
+ENDPOINTS = {                   # Calls per window of each endpoint, as in the API's app limits
+    'GET /2/tweets': 300,
+    'GET /2/users': 300,
+    'GET /2/tweets/search/stream/rules': 450,
+    'POST /2/tweets/search/stream/rules': 450,
+}
+TWEET_METRICS = ('retweet_count', 'reply_count', 'like_count', 'quote_count')
+USER_METRICS = ('followers_count', 'following_count', 'tweet_count', 'listed_count')
+
+
+class FakeTwitterApi:
+    def __init__(self, limits=None, window=900, seed=0):
+        """
+        Answers the tweet and user lookups with public metrics growing on every call, and keeps the stream rules.
+        The calls of each endpoint are counted in fixed windows like the API does, and a call over the limit is
+        answered with 429 until its window resets.
+        :param limits: Calls per window of the endpoints, as 'METHOD /route' -> calls, overriding ENDPOINTS
+        :param window: Seconds in a rate limit window
+        :param seed: Seed of the metric increments
+        """
+        self.limits = dict(ENDPOINTS, **(limits or {}))
+        self.window = window
+        self.random = random.Random(seed)
+        self.windows = dict()               # Endpoint -> (unix time the window resets, calls made in it)
+        self.calls = defaultdict(int)       # Endpoint -> calls answered
+        self.rejected = defaultdict(int)    # Endpoint -> calls answered with 429
+        self.metrics = dict()               # Tweet or user id -> public metrics
+        self.rules = dict()                 # Rule id -> rule
+        self.rule_ids = itertools.count(1)
+
+    def rate_limit(self, endpoint, now=None):
+        """
+        Counts a call of an endpoint.
+        :param endpoint: The endpoint, as 'METHOD /route'
+        :param now: Unix time, defaults to now
+        :return: The x-rate-limit-* headers, and whether the call is within the limit
+        """
+        now = time.time() if now is None else now
+        reset, used = self.windows.get(endpoint, (0, 0))
+        if now >= reset:
+            reset, used = int(now) + self.window, 0
+        limit = self.limits[endpoint]
+        allowed = used < limit
+        used += allowed
+        self.windows[endpoint] = (reset, used)
+        self.calls[endpoint] += 1
+        self.rejected[endpoint] += not allowed
+        headers = {'x-rate-limit-limit': str(limit), 'x-rate-limit-remaining': str(limit - used),
+                   'x-rate-limit-reset': str(reset)}
+        return headers, allowed
+
+    def grow(self, id, names):
+        """ :return: The public metrics of a tweet or user, each grown by a random amount since the last call """
+        metrics = self.metrics.setdefault(id, dict.fromkeys(names, 0))
+        for name in names:
+            metrics[name] += self.random.randint(0, 5)
+        return dict(metrics)
+
+    def limited(self, endpoint, handler):
+        """ Wraps a handler, answering with 429 when the endpoint is over its limit """
+        async def wrapper(request):
+            headers, allowed = self.rate_limit(endpoint)
+            if not allowed:
+                return web.json_response({'title': 'Too Many Requests', 'detail': 'Too Many Requests',
+                                          'type': 'about:blank', 'status': 429}, status=429, headers=headers)
+            return web.json_response(await handler(request), headers=headers)
+        return wrapper
+
+    async def get_tweets(self, request):
+        ids = request.query['ids'].split(',')
+        return {'data': [{'id': id, 'text': f'Tweet {id}', 'edit_history_tweet_ids': [id],
+                          'public_metrics': self.grow(id, TWEET_METRICS)} for id in ids]}
+
+    async def get_users(self, request):
+        ids = request.query['ids'].split(',')
+        return {'data': [{'id': id, 'name': f'User {id}', 'username': f'user{id}',
+                          'public_metrics': self.grow(id, USER_METRICS)} for id in ids]}
+
+    async def get_rules(self, request):
+        meta = {'sent': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()), 'result_count': len(self.rules)}
+        if not self.rules:
+            return {'meta': meta}
+        return {'data': list(self.rules.values()), 'meta': meta}
+
+    async def post_rules(self, request):
+        body = await request.json()
+        meta = {'sent': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+        if 'delete' in body:
+            deleted = [id for id in body['delete']['ids'] if self.rules.pop(id, None) is not None]
+            meta['summary'] = {'deleted': len(deleted), 'not_deleted': len(body['delete']['ids']) - len(deleted)}
+            return {'meta': meta}
+        added = list()
+        for rule in body.get('add', []):
+            rule = dict(rule, id=str(next(self.rule_ids)))
+            self.rules[rule['id']] = rule
+            added.append(rule)
+        meta['summary'] = {'created': len(added), 'not_created': 0, 'valid': len(added), 'invalid': 0}
+        return {'data': added, 'meta': meta}
+
+    def app(self):
+        """ :return: The aiohttp web Application serving the endpoints """
+        app = web.Application()
+        app.add_routes([
+            web.get('/2/tweets', self.limited('GET /2/tweets', self.get_tweets)),
+            web.get('/2/users', self.limited('GET /2/users', self.get_users)),
+            web.get('/2/tweets/search/stream/rules',
+                    self.limited('GET /2/tweets/search/stream/rules', self.get_rules)),
+            web.post('/2/tweets/search/stream/rules',
+                     self.limited('POST /2/tweets/search/stream/rules', self.post_rules)),
+        ])
+        return app
+
+    async def start(self, host='localhost', port=0):
+        """
+        Serves the endpoints in the running event loop.
+        :param host: The host to listen on
+        :param port: The port, 0 for a free one
+        :return: The aiohttp AppRunner, to clean up, and the base url to set as RATELIMIT['API_URL']
+        """
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = runner.addresses[0][1]
+        return runner, f'http://{host}:{port}'
@@ -0,0 +1,136 @@
+import math
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Sum
+
+from .cube import add_counts, purge_cube, roll_up, tweet_minute
+from .models import GeoCube
+from .routers import replica_reads
+
+
+""" Tweet counts pre-aggregated by time bucket, rule tag and cell of a fixed longitude/latitude grid, per country and
+place, for maps that must not scan the tweets """
+DIMENSIONS = ('tag', 'cell_x', 'cell_y', 'country_code', 'place')
+GROUPS = {'cell': ('cell_x', 'cell_y'), 'country': ('country_code',), 'place': ('place',), 'tag': ('tag',)}
+
+
+def geo_setting(name, default=None):
+    return getattr(settings, 'GEO', {}).get(name, default)
+
+
+def tweet_point(tweet, places):
+    """
+    :param tweet: The data dictionary of the tweet
+    :param places: Dictionary of place id -> data dictionary of the places included with the tweet
+    :return: The (longitude, latitude) of the exact coordinates of the tweet, else of the center of the bounding box
+    of its place, or None without either
+    """
+    geo = tweet.get('geo') or {}
+    coordinates = (geo.get('coordinates') or {}).get('coordinates')
+    if coordinates:
+        return coordinates[0], coordinates[1]
+    bbox = ((places.get(geo.get('place_id')) or {}).get('geo') or {}).get('bbox')
+    if bbox:
+        return (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+    return None
+
+
+def cell_bounds(cell_x, cell_y, degrees):
+    """ :return: The [west, south, east, north] bounds of a grid cell """
+    return [cell_x * degrees, cell_y * degrees, (cell_x + 1) * degrees, (cell_y + 1) * degrees]
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def save_geo(cells, workspace):
+    """
+    Adds the counts of flushed minute cells to the stored grid, at every resolution.
+    :param cells: List of (minute, tag, cell_x, cell_y, country_code, place, count) tuples from GeoCounter.flush
+    :param workspace: The name of the workspace whose stream was counted
+    """
+    add_counts(GeoCube, roll_up(cells, DIMENSIONS), workspace)
+
+
+def purge_geo(now=None):
+    """ Deletes the grid buckets older than the RETENTION of the cube """
+    purge_cube(now, GeoCube)
+
+
+@replica_reads
+def query_geo(workspace, resolution=60, start=None, end=None, by=('cell',), **equals):
+    """
+    Gets the tweet counts per region, summed over the buckets of a time range. Reads only the grid, so the cost depends
+    on the number of cells and not on the number of tweets.
+    :param workspace: The name of the workspace
+    :param resolution: One of cube.RESOLUTIONS
+    :param start: Datetime, only the buckets from the one containing it
+    :param end: Datetime, only buckets before then
+    :param by: Keys of GROUPS to break the counts down by: grid 'cell', 'country', 'place' or 'tag'
+    :param equals: Values of DIMENSIONS to filter on, e.g. tag='hashtagsfilter' or country_code='NO'
+    :return: List of dictionaries with the fields of 'by' and the 'count', largest first; cells have their 'bounds'
+    """
+    cells = GeoCube.objects.filter(workspace=workspace, resolution=resolution, **equals)
+    if start is not None:
+        start = datetime.fromtimestamp(int(start.timestamp()) // resolution * resolution, tz=dt_timezone.utc)
+        cells = cells.filter(bucket__gte=start)
+    if end is not None:
+        cells = cells.filter(bucket__lt=end)
+    fields = [field for group in by for field in GROUPS[group]]
+    regions = list(cells.values(*fields).annotate(count=Sum('count')).order_by('-count', *fields))
+    if 'cell' in by:
+        degrees = geo_setting('GRID_DEGREES', 1.0)
+        for region in regions:
+            region['bounds'] = cell_bounds(region['cell_x'], region['cell_y'], degrees)
+    return regions
+
+
+class GeoCounter:
+    def __init__(self, degrees=None):
+        """
+        Counts the streamed tweets of a workspace with a location per minute and grid cell in memory, until they are
+        flushed to the stored grid. Like the cube, a tweet matching several rules is counted once for each rule tag.
+        :param degrees: Size of the grid cells in degrees, defaults to GEO['GRID_DEGREES']. The stored cells are only
+        comparable with the same size.
+        """
+        self.degrees = degrees or geo_setting('GRID_DEGREES', 1.0)
+        self.pending = Counter()        # (minute, tag, cell_x, cell_y, country_code, place) -> count
+
+    def cells(self, tweet, places, filters=''):
+        """
+        :param tweet: The data dictionary of the tweet
+        :param places: Dictionary of place id -> data dictionary of the places included with the tweet
+        :param filters: The tags of the matching rules, comma separated
+        :return: List of the (minute, tag, cell_x, cell_y, country_code, place) cells the tweet is counted in, empty
+        if it has no location
+        """
+        point = tweet_point(tweet, places)
+        if point is None:
+            return []
+        cell_x, cell_y = math.floor(point[0] / self.degrees), math.floor(point[1] / self.degrees)
+        place_id = (tweet.get('geo') or {}).get('place_id') or ''
+        country_code = ((places.get(place_id) or {}).get('country_code') or '')[:8]
+        minute = tweet_minute(tweet)
+        return [(minute, tag[:128], cell_x, cell_y, country_code, place_id[:255])
+                for tag in (filters.split(', ') if filters else [''])]
+
+    def add_tweet(self, tweet, places, filters=''):
+        """
+        :param tweet: The data dictionary of the tweet
+        :param places: Dictionary of place id -> data dictionary of the places included with the tweet
+        :param filters: The tags of the matching rules, comma separated
+        """
+        if tweet.get('geo'):
+            self.pending.update(self.cells(tweet, places, filters))
+
+    def flush(self):
+        """
+        :return: The pending cells as a list of (minute, tag, cell_x, cell_y, country_code, place, count), to be
+        stored with save_geo
+        """
+        cells = [key + (count,) for key, count in self.pending.items()]
+        self.pending = Counter()
+        return cells
+
+
+GEO = GeoCounter()
@@ -0,0 +1,395 @@
+import bz2
+import copy
+import gzip
+import json
+import lzma
+import multiprocessing
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import django
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from .conversations import thread_path
+from .cube import TweetCounter, save_cube
+from .geo import GeoCounter, save_geo
+from .models import ContextDomain, ContextEntity, Hashtag, Media, Mention, Place, ReferencedTweet, Tweet, User
+from .workspaces import DEFAULT_WORKSPACE
+
+
+""" Offline bulk import of archived stream responses (compressed NDJSON), for seeding a deployment """
+OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+DEFERRED_INDEXES = (
+    (Tweet, ('conversation_id', 'cluster_id', 'workspace')),
+    (ReferencedTweet, ('tweetid', 'conversation_id')),
+)
+
+
+def open_dump(path):
+    """
+    :param path: Path of an NDJSON file, compressed with gzip, bzip2 or xz if it has their extension
+    :return: The file opened for reading bytes
+    """
+    for extension, opener in OPENERS.items():
+        if path.endswith(extension):
+            return opener(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_chunks(paths, chunk_size=10000):
+    """
+    :param paths: Paths of the dumps
+    :param chunk_size: Lines per chunk
+    :return: Generator of lists of raw lines
+    """
+    for path in paths:
+        with open_dump(path) as dump:
+            lines = list()
+            for line in dump:
+                lines.append(line)
+                if len(lines) >= chunk_size:
+                    yield lines
+                    lines = list()
+            if lines:
+                yield lines
+
+
+def parse_lines(lines, filters_default=''):
+    """
+    Parses a chunk of a dump into rows ready to insert, without querying the database, so it can run in the worker
+    processes.
+    A line is either a stream response ({'data', 'includes', 'matching_rules'}, where 'data' may also be a list of
+    tweets as in search responses) or a bare tweet.
+    :param lines: List of raw lines
+    :param filters_default: The filters of tweets without matching rules
+    :return: Dictionary of the 'tweets' (dictionaries of Tweet column values, plus the 'parent' replied to and the
+    'cube' and 'geo' cells), 'hashtags', 'mentions' and 'contexts' (tuples with the tweet id), 'references', 'users',
+    'media', 'places' and the number of 'errors'
+    """
+    rows = {'tweets': [], 'hashtags': [], 'mentions': [], 'contexts': [], 'references': [], 'users': [],
+            'media': [], 'places': [], 'errors': 0}
+    adapt = connection.ops.adapt_datetimefield_value
+    grid = GeoCounter()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            rows['errors'] += 1
+            continue
+        if 'data' in record:
+            tweets = record['data'] if isinstance(record['data'], list) else [record['data']]
+            includes = record.get('includes') or {}
+            tags = [rule.get('tag') for rule in record.get('matching_rules') or [] if rule.get('tag')]
+            filters = ', '.join(tags) if tags else filters_default
+        else:
+            tweets, includes, filters = [record], {}, filters_default
+        places = {place['id']: place for place in includes.get('places', [])}
+        for tweet in tweets:
+            if 'id' not in tweet or 'created_at' not in tweet:
+                rows['errors'] += 1
+                continue
+            tweet_id = str(tweet['id'])
+            references = tweet.get('referenced_tweets') or []
+            created_at = adapt(parse_datetime(tweet['created_at']))
+            rows['tweets'].append({
+                'id': tweet_id,
+                'text': tweet.get('text', ''),
+                'author_id': str(tweet.get('author_id')),
+                'conversation_id': str(tweet.get('conversation_id', tweet_id)),
+                'created_at': created_at,
+                'in_reply_to_user_id': str(tweet.get('in_reply_to_user_id')),
+                'lang': tweet.get('lang') or '',
+                'possibly_sensitive': bool(tweet.get('possibly_sensitive')),
+                'reply_settings': tweet.get('reply_settings') or '',
+                'source': tweet.get('source') or '',
+                'filters': filters,
+                'place_id': (tweet.get('geo') or {}).get('place_id'),
+                'parent': next((str(ref['id']) for ref in references if ref['type'] == 'replied_to'), None),
+                'cube': TweetCounter.cells(tweet, filters),
+                'geo': grid.cells(tweet, places, filters),
+            })
+            entities = tweet.get('entities') or {}
+            rows['hashtags'].extend((tweet_id, hashtag['tag']) for hashtag in entities.get('hashtags', []))
+            rows['mentions'].extend((tweet_id, mention['username']) for mention in entities.get('mentions', []))
+            rows['contexts'].extend((tweet_id, context['domain']['id'], context['domain']['name'],
+                                     context['entity']['id'], context['entity']['name'])
+                                    for context in tweet.get('context_annotations', []))
+            rows['references'].extend((tweet_id, str(ref['id']), ref['type'], created_at) for ref in references)
+        rows['users'].extend(includes.get('users', []))
+        rows['media'].extend(includes.get('media', []))
+        rows['places'].extend(places.values())
+    return rows
+
+
+@contextmanager
+def deferred_indexes(enabled=True):
+    """
+    Drops the secondary indexes of the tweets and references while the rows are loaded, and builds them again at the
+    end, which is faster than updating them for every insert. The primary keys, foreign keys and unique constraints
+    are kept.
+    :param enabled: Whether to defer the indexes
+    """
+    if not enabled:
+        yield
+        return
+    altered = list()
+    with connection.schema_editor() as editor:
+        for model, names in DEFERRED_INDEXES:
+            for name in names:
+                field = model._meta.get_field(name)
+                unindexed = copy.copy(field)
+                unindexed.db_index = False
+                editor.alter_field(model, field, unindexed)
+                altered.append((model, field, unindexed))
+            for index in model._meta.indexes:
+                editor.remove_index(model, index)
+    try:
+        yield
+    finally:
+        print('Building the deferred indexes')
+        with connection.schema_editor() as editor:
+            for model, names in DEFERRED_INDEXES:
+                for index in model._meta.indexes:
+                    editor.add_index(model, index)
+            for model, field, unindexed in altered:
+                editor.alter_field(model, unindexed, field)
+
+
+class TweetImporter:
+    def __init__(self, workspace=DEFAULT_WORKSPACE, batch_size=5000):
+        """
+        Loads parsed chunks into the database with bulk inserts. The hashtags, mentions and contexts are resolved
+        with in-memory dictionaries of the stored ones, and their counts written once at the end (see finish), so the
+        import must not run alongside the ingest worker of the workspace.
+        Tweets already stored are skipped. The imported tweets are not tracked for engagement.
+        :param workspace: The name of the workspace the tweets are imported into
+        :param batch_size: Rows per insert statement
+        """
+        self.workspace = workspace
+        self.batch_size = batch_size
+        self.hashtags = {tag: [pk, count] for pk, tag, count in Hashtag.objects.filter(
+            workspace=workspace).values_list('id', 'hashtag', 'count')}
+        self.mentions = {name: [pk, count] for pk, name, count in Mention.objects.filter(
+            workspace=workspace).values_list('id', 'mention', 'count')}
+        self.entities = {ent_id: [pk, count] for pk, ent_id, count in ContextEntity.objects.filter(
+            workspace=workspace).values_list('id', 'ent_id', 'count')}
+        self.domains = dict(ContextDomain.objects.values_list('dom_id', 'id'))
+        self.users = set()          # Ids of the users and keys of the media seen, stored or not
+        self.media = set()
+        self.places = set()
+        self.cube = TweetCounter()
+        self.geo = GeoCounter()
+        self.stats = Counter()
+
+    def resolve(self, model, known, field, names):
+        """
+        Creates the entities missing from a dictionary with one bulk insert, and adds them to it.
+        :param model: Hashtag, Mention or ContextEntity
+        :param known: The dictionary of the model, name -> [pk, count]
+        :param field: The name field of the model
+        :param names: The names seen in the chunk, or dictionary of name -> extra fields for ContextEntity
+        """
+        missing = [name for name in names if name not in known]
+        if not missing:
+            return
+        extra = names if isinstance(names, dict) else {}
+        model.objects.bulk_create([model(count=0, workspace=self.workspace, **{field: name}, **extra.get(name, {}))
+                                   for name in missing], batch_size=self.batch_size)
+        for pk, name in model.objects.filter(workspace=self.workspace, **{f'{field}__in': missing}).values_list(
+                'id', field):
+            known.setdefault(name, [pk, 0])
+
+    def load(self, rows):
+        """
+        Stores a parsed chunk in one transaction.
+        :param rows: Dictionary from parse_lines
+        """
+        self.stats['errors'] += rows['errors']
+        tweets = {tweet['id']: tweet for tweet in rows['tweets']}
+        stored = set(Tweet.objects.filter(id__in=list(tweets)).values_list('id', flat=True))
+        self.stats['skipped'] += len(rows['tweets']) - len(tweets) + len(stored)
+        tweets = {tweet_id: tweet for tweet_id, tweet in tweets.items() if tweet_id not in stored}
+        with transaction.atomic():
+            self.load_tweets(tweets)
+            self.load_entities(rows, tweets)
+            self.load_includes(rows)
+        self.stats['tweets'] += len(tweets)
+
+    def insert(self, model, columns, rows):
+        """
+        Inserts rows with executemany, without building model instances (which takes longer than the insert itself).
+        :param model: The model of the table
+        :param columns: The column names
+        :param rows: List of tuples of the values, prepared for the database
+        """
+        if not rows:
+            return
+        quote = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (quote(model._meta.db_table), ', '.join(map(quote, columns)),
+                                                   ', '.join(['%s'] * len(columns)))
+        with connection.cursor() as cursor:
+            for i in range(0, len(rows), self.batch_size):
+                cursor.executemany(sql, rows[i:i + self.batch_size])
+
+    def load_tweets(self, tweets):
+        """
+        Inserts the tweets of a chunk with their thread paths. The paths of the parents are taken from the chunk, or
+        read from the stored tweets with one query, so the memory used does not grow with the import.
+        """
+        parents = {tweet['parent'] for tweet in tweets.values() if tweet['parent'] and tweet['parent'] not in tweets}
+        paths = dict(Tweet.objects.filter(id__in=list(parents)).values_list('id', 'thread_path')) if parents else {}
+        rows = list()
+        for tweet in tweets.values():
+            self.cube.pending.update(tweet['cube'])
+            self.geo.pending.update(tweet['geo'])
+            parent = tweet['parent']
+            if parent is None:
+                path = thread_path(tweet['id'], tweet['conversation_id'])
+            else:
+                path = f"{paths.get(parent) or thread_path(parent, tweet['conversation_id'])}/{tweet['id']}"
+            path = path[:1024]
+            paths[tweet['id']] = path
+            rows.append((tweet['id'], tweet['text'], tweet['author_id'], tweet['conversation_id'],
+                         tweet['created_at'], tweet['in_reply_to_user_id'], tweet['lang'],
+                         tweet['possibly_sensitive'], tweet['reply_settings'], tweet['source'], tweet['filters'],
+                         path, tweet['id'], self.workspace, tweet['place_id']))
+        self.insert(Tweet, ('id', 'text', 'author_id', 'conversation_id', 'created_at', 'in_reply_to_user_id', 'lang',
+                            'possibly_sensitive', 'reply_settings', 'source', 'filters', 'thread_path', 'cluster_id',
+                            'workspace', 'place_id'), rows)
+
+    def load_entities(self, rows, tweets):
+        hashtags = [(tweet_id, tag) for tweet_id, tag in rows['hashtags'] if tweet_id in tweets]
+        mentions = [(tweet_id, name) for tweet_id, name in rows['mentions'] if tweet_id in tweets]
+        contexts = [context for context in rows['contexts'] if context[0] in tweets]
+        self.resolve(Hashtag, self.hashtags, 'hashtag', {tag for _, tag in hashtags})
+        self.resolve(Mention, self.mentions, 'mention', {name for _, name in mentions})
+        domains = {dom_id: name for _, dom_id, name, _, _ in contexts if dom_id not in self.domains}
+        if domains:
+            ContextDomain.objects.bulk_create([ContextDomain(dom_id=dom_id, name=name)
+                                               for dom_id, name in domains.items()])
+            self.domains.update(ContextDomain.objects.filter(dom_id__in=list(domains)).values_list('dom_id', 'id'))
+        self.resolve(ContextEntity, self.entities, 'ent_id', {
+            ent_id: {'name': name, 'domain_id': self.domains[dom_id]} for _, dom_id, _, ent_id, name in contexts})
+
+        links = (
+            (Tweet.hashtags.through, 'hashtag_id', self.hashtags, hashtags),
+            (Tweet.mentions.through, 'mention_id', self.mentions, mentions),
+            (Tweet.context.through, 'contextentity_id', self.entities, [(c[0], c[3]) for c in contexts]),
+        )
+        for through, column, known, pairs in links:
+            linked = set()
+            for tweet_id, name in pairs:
+                entry = known[name]
+                if (tweet_id, entry[0]) not in linked:
+                    entry[1] += 1
+                    linked.add((tweet_id, entry[0]))
+            self.insert(through, ('tweet_id', column), list(linked))
+
+        self.insert(ReferencedTweet, ('tweetid', 'type', 'source_id', 'conversation_id', 'created_at'), [
+            (ref_id, type, tweet_id, tweets[tweet_id]['conversation_id'], created_at)
+            for tweet_id, ref_id, type, created_at in rows['references'] if tweet_id in tweets
+        ])
+
+    def load_includes(self, rows):
+        """ Stores the users, media and places not stored yet. The ones already stored are kept as they are. """
+        users = {str(user['id']): user for user in rows['users'] if str(user['id']) not in self.users}
+        stored = set(User.objects.filter(id__in=list(users)).values_list('id', flat=True))
+        adapt = connection.ops.adapt_datetimefield_value
+        self.insert(User, ('id', 'name', 'username', 'created_at', 'description', 'location', 'pinned_tweet_id',
+                           'profile_image_url', 'protected', 'url', 'verified'), [(
+                               user_id,
+                               user.get('name', ''),
+                               user.get('username', ''),
+                               adapt(parse_datetime(user['created_at'])) if user.get('created_at') else None,
+                               (user.get('description') or '')[:255] or None,
+                               (user.get('location') or '')[:255] or None,
+                               user.get('pinned_tweet_id'),
+                               user.get('profile_image_url'),
+                               user.get('protected'),
+                               user.get('url'),
+                               user.get('verified'),
+                           ) for user_id, user in users.items() if user_id not in stored])
+        self.users.update(users)
+        self.stats['users'] += len(users) - len(stored)
+        media = {item['media_key']: item for item in rows['media'] if item['media_key'] not in self.media}
+        stored = set(Media.objects.filter(media_key__in=list(media)).values_list('media_key', flat=True))
+        self.insert(Media, ('media_key', 'type', 'url', 'duration_ms', 'height', 'preview_image_url', 'width',
+                            'alt_text'), [(
+                                key,
+                                item.get('type', ''),
+                                item.get('url'),
+                                item.get('duration_ms'),
+                                item.get('height'),
+                                item.get('preview_image_url'),
+                                item.get('width'),
+                                item.get('alt_text'),
+                            ) for key, item in media.items() if key not in stored])
+        self.media.update(media)
+        self.stats['media'] += len(media) - len(stored)
+        places = {place['id']: place for place in rows['places'] if place['id'] not in self.places}
+        stored = set(Place.objects.filter(id__in=list(places)).values_list('id', flat=True))
+        bounds = {place_id: (place.get('geo') or {}).get('bbox') or [None] * 4 for place_id, place in places.items()}
+        self.insert(Place, ('id', 'full_name', 'name', 'country', 'country_code', 'place_type', 'west', 'south',
+                            'east', 'north'), [(
+                                place_id,
+                                place.get('full_name', ''),
+                                place.get('name'),
+                                place.get('country'),
+                                place.get('country_code'),
+                                place.get('place_type'),
+                                *bounds[place_id],
+                            ) for place_id, place in places.items() if place_id not in stored])
+        self.places.update(places)
+
+    def finish(self):
+        """ Writes the entity counts, and adds the imported tweets to the cube and the geo grid """
+        for model, known in ((Hashtag, self.hashtags), (Mention, self.mentions), (ContextEntity, self.entities)):
+            model.objects.bulk_update([model(id=pk, count=count) for pk, count in known.values()], ['count'],
+                                      batch_size=self.batch_size)
+        save_cube(self.cube.flush(), self.workspace)
+        save_geo(self.geo.flush(), self.workspace)
+
+
+def import_dumps(paths, workspace=DEFAULT_WORKSPACE, workers=None, chunk_size=10000, batch_size=5000,
+                 defer_indexes=True, filters=''):
+    """
+    Imports dumps of stream responses. The chunks are parsed by a process pool while the previous ones are loaded,
+    and the progress is printed after each chunk.
+    :param paths: Paths of the NDJSON dumps, optionally compressed
+    :param workspace: The name of the workspace to import into
+    :param workers: Number of parsing processes, defaults to the number of cores
+    :param chunk_size: Lines parsed per task, and loaded per transaction
+    :param batch_size: Rows per insert statement
+    :param defer_indexes: Whether to build the secondary indexes at the end, see deferred_indexes
+    :param filters: The filters of tweets without matching rules
+    :return: Counter of the imported 'tweets', 'users' and 'media', the 'skipped' tweets (already stored or repeated)
+    and the lines or tweets that could not be parsed ('errors')
+    """
+    importer = TweetImporter(workspace, batch_size)
+    start = time.monotonic()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=django.setup) as executor:
+        pending = deque()
+        limit = 2 * (workers or multiprocessing.cpu_count())
+
+        def load_next():
+            importer.load(pending.popleft().result())
+            elapsed = time.monotonic() - start
+            print(f"Imported {importer.stats['tweets']} tweets in {elapsed:.0f}s "
+                  f"({importer.stats['tweets'] / max(elapsed, 1e-6):.0f} tweets/s)")
+
+        with deferred_indexes(defer_indexes):
+            for lines in read_chunks(paths, chunk_size):
+                pending.append(executor.submit(parse_lines, lines, filters))
+                if len(pending) >= limit:
+                    load_next()
+            while pending:
+                load_next()
+            importer.finish()
+    return importer.stats
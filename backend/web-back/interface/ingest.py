@@ -0,0 +1,414 @@
+import asyncio
+import multiprocessing
+import struct
+import time
+from datetime import datetime, timezone as dt_timezone
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from channels.layers import get_channel_layer
+from django.db import connections
+from tweepy import TweepyException
+
+from .authors import AuthorMetricsCollector
+from .cooccurrence import purge_cooccurrence
+from .checkpoint import CHECKPOINTS, checkpoint_setting, decode_checkpoint, encode_checkpoint
+from .cube import save_cube, purge_cube
+from .geo import save_geo, purge_geo
+from .jobs import JOBS
+from .livetweets import LiveStream, EngagementTracker, delete_old_metrics
+from .monitor import MONITOR, sample_profile
+from .ratelimit import SCHEDULER
+from .rules import RuleManager
+from .scoring import INTERVALS
+from .trending import TrendingEngine
+from .workspaces import DEFAULT_WORKSPACE, get_workspace, workspace_setting, workspace_stats
+
+
+""" The ingest worker: owns the streams and engagement trackers of the workspaces, controlled over the channel layer """
+INGEST_CHANNEL = 'ingest'
+
+""" The fields requested by a stream: 'minimal' has what is stored and counted, 'dashboard' adds what the cards and
+the map draw (the metrics, the author, the media and the place), 'archive' everything the tables and the archive can
+hold """
+MINIMAL_FIELDS = ['author_id', 'context_annotations', 'conversation_id', 'created_at', 'entities', 'lang',
+                  'possibly_sensitive', 'referenced_tweets', 'reply_settings', 'source']
+STREAM_PROFILES = {
+    'minimal': dict(tweet_fields=MINIMAL_FIELDS),
+    'dashboard': dict(
+        tweet_fields=MINIMAL_FIELDS + ['attachments', 'geo', 'in_reply_to_user_id', 'public_metrics'],
+        expansions=['author_id', 'attachments.media_keys', 'geo.place_id'],
+        place_fields=['country_code', 'full_name', 'geo'],
+        media_fields=['url', 'preview_image_url'],
+        user_fields=['profile_image_url', 'verified'],
+    ),
+    'archive': dict(
+        tweet_fields=['id', 'text', 'attachments', 'author_id', 'context_annotations', 'conversation_id',
+                      'created_at', 'entities', 'geo', 'in_reply_to_user_id', 'lang', 'possibly_sensitive',
+                      'public_metrics', 'referenced_tweets', 'reply_settings', 'source', 'withheld'],
+        expansions=['entities.mentions.username', 'geo.place_id', 'author_id', 'attachments.media_keys'],
+        place_fields=['contained_within', 'country', 'country_code', 'full_name', 'geo', 'name', 'place_type'],
+        media_fields=['url', 'preview_image_url'],
+        user_fields=['created_at', 'description', 'location', 'pinned_tweet_id', 'profile_image_url', 'protected',
+                     'url', 'verified'],
+    ),
+}
+DEFAULT_PROFILE = 'dashboard'
+
+
+class IngestStream(LiveStream):
+    def __init__(self, bearer_token, executor, controller, workspace, max_pending=32):
+        """
+        A LiveStream handing its database work to a process pool. Each response is handled in its own task, so the
+        stream keeps reading while up to 'max_pending' responses are being stored.
+        :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param executor: The ProcessPoolExecutor to run the ORM helpers in
+        :param controller: The StreamController, told about every stored tweet
+        :param workspace: The Workspace of the stream
+        :param max_pending: The maximum number of responses handled at the same time
+        """
+        super().__init__(bearer_token, workspace)
+        self.executor = executor
+        self.controller = controller
+        self.pending = asyncio.Semaphore(max_pending)
+
+    async def store(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def on_response(self, response):
+        """
+        Starts handling a response in a new task, waiting first if too many responses are already being handled.
+        :param response: The response object from Tweepy
+        """
+        await self.pending.acquire()
+        task = asyncio.ensure_future(self.handle_response(response))
+        task.add_done_callback(lambda t: self.pending.release())
+
+    async def handle_response(self, response):
+        try:
+            await super().on_response(response)
+            if response.data:
+                self.controller.tweet_stored(response.data)
+        except Exception as e:
+            print(f'Failed to handle response: {e!r}')
+
+
+class StreamController:
+    def __init__(self, ingest, workspace):
+        """
+        Owns the stream, the rules, the engagement tracker and the author metrics of one workspace, with the
+        workspace's bearer token. Its jobs are named after the workspace, e.g. 'engagement:default'.
+        :param ingest: The IngestController, whose process pool stores the tweets
+        :param workspace: The Workspace
+        """
+        self.ingest = ingest
+        self.workspace = workspace
+        self.STREAM = None
+        self.rules = None
+        self.profile = None             # The field profile of the running stream
+        self.tracking_since = None      # The creation time of the first tweet tracked
+        self.engagement_tracker = EngagementTracker(workspace.bearer_token, workspace)
+        self.author_metrics = AuthorMetricsCollector(workspace.bearer_token, workspace)
+        JOBS.add(self.job('trending'), self.publish_trending, 5)
+        JOBS.add(self.job('clusters'), self.publish_clusters, 5)
+
+    def job(self, name):
+        return f'{name}:{self.workspace.name}'
+
+    async def handle(self, message):
+        """
+        Performs a command for the workspace, see IngestController.handle.
+        :param message: The message received on the INGEST_CHANNEL
+        """
+        command = message['command']
+        reply = self.ingest.reply
+        if command == 'loadstream':
+            if self.STREAM is not None:
+                await reply(message, 'Stream already initiated')
+                return
+            if not self.workspace.bearer_token:
+                await reply(message, 'No bearer token configured for the workspace')
+                return
+            self.STREAM = IngestStream(self.workspace.bearer_token, self.ingest.executor, self, self.workspace,
+                                       max_pending=self.workspace.limits['MAX_PENDING'] or 32)
+            self.rules = RuleManager(self.STREAM, reply)
+            await self.rules.load()
+            await reply(message, 'Stream initiated')
+            return
+        if self.STREAM is None:
+            await reply(message, 'No active stream')
+            return
+
+        if command == 'startstream':
+            profile = message.get('profile') or workspace_setting(self.workspace.name, 'STREAM_PROFILE',
+                                                                  DEFAULT_PROFILE)
+            if profile not in STREAM_PROFILES:
+                await reply(message, f"Unknown field profile {profile}, use one of {', '.join(STREAM_PROFILES)}")
+                return
+            try:
+                self.STREAM.filter(**STREAM_PROFILES[profile])
+                self.profile = profile
+                await reply(message, 'Stream connecting')
+            except TweepyException as e:
+                await reply(message, f'{e}')
+
+        if command == 'stopstream':
+            self.STREAM.disconnect()
+            JOBS.remove(self.job('engagement'))
+            JOBS.remove(self.job('authors'))
+            self.profile, self.tracking_since = None, None
+            await reply(message, 'Disconnect signal sent')
+
+        if command in ('rulelist', 'deleterules'):
+            await self.rules.submit(message)
+
+    async def publish_trending(self):
+        await self.workspace.snapshot.publish('trending', self.workspace.trending.results())
+
+    async def publish_clusters(self):
+        await self.workspace.snapshot.publish('clusters', self.workspace.dedup.top(10))
+
+    def tweet_stored(self, tweet):
+        """
+        Starts the engagement tracking from the first tweet stored, if it is not already running.
+        :param tweet: The TweetRecord that was stored
+        """
+        if self.job('engagement') not in JOBS:
+            self.track(tweet.created_at)
+
+    def track(self, since):
+        """
+        Starts the engagement tracking of the tweets created since a time, and the collection of author metrics
+        along with it.
+        :param since: Datetime of the first tweet tracked
+        """
+        self.tracking_since = since
+        if self.job('engagement') not in JOBS:
+            tracker = self.engagement_tracker
+            JOBS.add(self.job('engagement'), tracker.engagement_update, partial(tracker.interval, 30),
+                     args=(since,), timeout=120)
+        if self.job('authors') not in JOBS:
+            JOBS.add(self.job('authors'), self.author_metrics.collect, partial(self.author_metrics.interval, 60),
+                     jitter=5, timeout=300)
+
+    def checkpoint(self):
+        """
+        :return: The state of the workspace to checkpoint: a dictionary with the running stream and tracking, the
+        engagement tracker, the snapshot and the co-occurrence graph, and the trending engine and duplicate index as
+        bytes
+        """
+        workspace = self.workspace
+        state = {'workspace': workspace.name, 'profile': self.profile,
+                 'tracking_since': self.tracking_since.timestamp() if self.tracking_since else None,
+                 'tracker': self.engagement_tracker.state(), 'snapshot': workspace.snapshot.state(),
+                 'cooccurrence': workspace.cooccurrence.state()}
+        return state, workspace.trending.to_bytes(), workspace.dedup.to_bytes()
+
+    async def restore(self, state, trending, dedup):
+        """
+        Restores the state from a checkpoint, and publishes the trending and clusters snapshots at once. The tracking
+        is resumed, and so is the stream if it was running (unless CHECKPOINT['RESUME_STREAM'] is off).
+        :param state: The dictionary from checkpoint()
+        :param trending: The trending engine as bytes
+        :param dedup: The duplicate index as bytes
+        """
+        workspace = self.workspace
+        workspace.trending.merge(TrendingEngine.from_bytes(trending))
+        workspace.dedup.load(dedup)
+        self.engagement_tracker.restore(state['tracker'])
+        await workspace.snapshot.restore(state['snapshot'])
+        if 'cooccurrence' in state:
+            workspace.cooccurrence.restore(state['cooccurrence'])
+        await self.publish_trending()
+        await self.publish_clusters()
+        if state['tracking_since'] is not None:
+            self.track(datetime.fromtimestamp(state['tracking_since'], tz=dt_timezone.utc))
+        if state['profile'] is None:
+            return
+        if checkpoint_setting('RESUME_STREAM', True):
+            await self.handle({'command': 'loadstream'})
+            await self.handle({'command': 'startstream', 'profile': state['profile']})
+        else:
+            await workspace.snapshot.publish('status', {'stream': 'Stream disconnected'})
+
+    def stop(self):
+        if self.STREAM is not None:
+            self.STREAM.disconnect()
+
+
+class IngestController:
+    def __init__(self, workers=None):
+        """
+        Runs the stream controller of every workspace used, and performs the commands the consumers send over the
+        channel layer. The workspaces share the process pool, each limited to the MAX_PENDING responses of its
+        stream, so a busy workspace does not hold up the others.
+        :param workers: Number of processes parsing and storing tweets, defaults to the number of cores
+        """
+        self.workers = workers
+        self.executor = None
+        self.controllers = dict()       # Workspace name -> StreamController
+
+    async def run(self):
+        """
+        Receives commands from the INGEST_CHANNEL until cancelled. A failing command is reported and does not stop
+        the worker.
+        The recurring work runs as jobs: the cube and geo grid flushes, the retention of the metrics, the cube, the
+        grid and the co-occurrence edges, the checkpoint, and for each workspace its trending and clusters snapshots.
+        The engagement and author metrics jobs of a workspace are added by the first tweet it stores.
+        The workspaces of the last checkpoint are restored first, and the checkpoint is written again when the worker
+        stops, see checkpoint.py.
+        """
+        connections.close_all()
+        MONITOR.start()
+        # Each process of the pool sets up Django and opens its own database connection
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=django.setup)
+        JOBS.add('cube', self.flush_cube, 10, jitter=1)
+        JOBS.add('geo', self.flush_geo, 10, jitter=1)
+        JOBS.add('metrics-retention', self.retain_metrics, 60, jitter=5, timeout=60)
+        JOBS.add('cube-retention', self.store, 3600, args=(purge_cube,), delay=60, timeout=600)
+        JOBS.add('geo-retention', self.store, 3600, args=(purge_geo,), delay=120, timeout=600)
+        JOBS.add('cooccurrence-retention', self.store, 3600, args=(purge_cooccurrence,), delay=180, timeout=600)
+        if CHECKPOINTS.enabled():
+            await self.restore()
+            interval = checkpoint_setting('INTERVAL', 30)
+            JOBS.add('checkpoint', self.checkpoint, interval, delay=interval, timeout=60)
+        channel_layer = get_channel_layer()
+        print(f'Ingest worker listening on "{INGEST_CHANNEL}"')
+        try:
+            while True:
+                message = await channel_layer.receive(INGEST_CHANNEL)
+                try:
+                    await self.handle(message)
+                except Exception as e:
+                    print(f"Command {message.get('command')} failed: {e!r}")
+                    await self.reply(message, f"Command failed: {e}")
+        finally:
+            JOBS.stop()
+            if CHECKPOINTS.enabled():
+                await self.checkpoint()
+            for controller in self.controllers.values():
+                controller.stop()
+            await SCHEDULER.close()
+            self.executor.shutdown(wait=True)
+
+    async def reply(self, message, text, type='status'):
+        """
+        Sends a status message to the consumer the command came from.
+        :param message: The command message
+        :param text: The status text
+        :param type: The message type, 'status' or 'rulestatus'
+        """
+        if message.get('reply_channel'):
+            await get_channel_layer().send(message['reply_channel'], {'type': type, 'message': text})
+
+    async def handle(self, message):
+        """
+        Performs a command. The commands are the ones the websocket used to handle itself, for the 'workspace' of
+        the message (the default workspace if it has none):
+
+        'loadstream': Initiates the stream and sends its rules to the dashboards.
+
+        'startstream': Establishes the connection to twitter, and starts receiving tweets, with the fields of the
+        'profile' of the message, or else of the STREAM_PROFILE of the workspace (see STREAM_PROFILES).
+
+        'stopstream': Stops the streaming connection to twitter. Also stops the engagement tracking and author
+        metrics jobs.
+
+        'profile': Samples the stacks of this worker for 'seconds', and sends them with the monitor stats to the
+        'reply_channel'. Not forwarded from the websocket, see views.profile.
+
+        'neighbours': Sends the 'n' nodes co-occurring most with a 'node' in the last 'minutes' to the
+        'reply_channel', from the graph of the workspace in memory. Not forwarded from the websocket, see
+        views.cooccurrence.
+
+        'rulelist': Replaces the rules with the same tags as the 'rules' of the message with the new rules.
+
+        'deleterules': Deletes any rules from twitter, and sets them to "inactive" in the database.
+
+        The rule commands are merged with the ones from other dashboards and applied as one diff, see RuleManager.
+
+        :param message: The message received on the INGEST_CHANNEL
+        """
+        command = message['command']
+        print('Command: ', command)
+        if command == 'profile':
+            asyncio.ensure_future(self.profile(message))
+            return
+        if command == 'neighbours':
+            graph = get_workspace(message.get('workspace', DEFAULT_WORKSPACE)).cooccurrence
+            neighbours = graph.neighbours(message['node'], message.get('n', 10), message.get('minutes', 60))
+            await get_channel_layer().send(message['reply_channel'], {'type': 'neighbours', 'neighbours': neighbours})
+            return
+        name = message.get('workspace') or DEFAULT_WORKSPACE
+        if name not in self.controllers:
+            workspace = get_workspace(name)
+            if workspace is None:
+                await self.reply(message, f'Unknown workspace {name}')
+                return
+            self.controllers[name] = StreamController(self, workspace)
+        await self.controllers[name].handle(message)
+
+    async def store(self, func, *args):
+        """ Runs an ORM helper function in the process pool """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def retain_metrics(self):
+        """
+        Deletes the stored metrics too old to rank. The longest interval needs an update from that long ago, so while
+        a tracker's ticks are stretched the metrics are kept for the interval plus two of its ticks.
+        """
+        ticks = [controller.engagement_tracker.interval(30) for controller in self.controllers.values()]
+        seconds = max(INTERVALS.values()) + 2 * max(ticks, default=30)
+        await self.store(delete_old_metrics, max(seconds / 60, 4))
+
+    async def checkpoint(self):
+        """ Stores the state of every workspace used, see StreamController.checkpoint """
+        data = encode_checkpoint([controller.checkpoint() for controller in self.controllers.values()])
+        await CHECKPOINTS.save(data)
+
+    async def restore(self):
+        """
+        Restores the workspaces of the stored checkpoint, see StreamController.restore. A checkpoint that cannot be
+        read is reported and skipped, and so is a workspace failing to restore.
+        """
+        data = await CHECKPOINTS.load()
+        if not data:
+            return
+        try:
+            created, sections = decode_checkpoint(data)
+        except (ValueError, struct.error) as e:
+            print(f'Checkpoint skipped: {e!r}')
+            return
+        for state, *blobs in sections:
+            workspace = get_workspace(state['workspace'])
+            if workspace is None:
+                continue
+            if workspace.name not in self.controllers:
+                self.controllers[workspace.name] = StreamController(self, workspace)
+            try:
+                await self.controllers[workspace.name].restore(state, *blobs)
+            except Exception as e:
+                print(f'Failed to restore workspace {workspace.name}: {e!r}')
+        print(f'Restored {len(sections)} workspaces from the checkpoint of {time.time() - created:.0f}s ago')
+
+    async def flush_cube(self):
+        for name, controller in list(self.controllers.items()):
+            await self.store(save_cube, controller.workspace.cube.flush(), name)
+
+    async def flush_geo(self):
+        for name, controller in list(self.controllers.items()):
+            await self.store(save_geo, controller.workspace.geo.flush(), name)
+
+    async def profile(self, message):
+        """
+        Samples this worker in a thread, so the event loop keeps running (and is sampled) meanwhile.
+        :param message: The 'profile' command message
+        """
+        folded = await asyncio.get_event_loop().run_in_executor(None, sample_profile, message.get('seconds', 5))
+        await get_channel_layer().send(message['reply_channel'], {
+            'type': 'profile',
+            'folded': folded,
+            'stats': dict(MONITOR.stats(), jobs=JOBS.stats(), workspaces=workspace_stats())
+        })
@@ -0,0 +1,182 @@
+import asyncio
+import random
+import time
+
+
+""" Process-level scheduler for the recurring work of a worker """
+class Job:
+    def __init__(self, name, func, interval, args=(), timeout=None, jitter=0.0, catch_up=False):
+        """
+        A recurring coroutine function. The runs are due on a grid of monotonic deadlines, 'interval' seconds apart,
+        so a slow run does not make the following ones drift.
+        :param name: Unique name of the job
+        :param func: Coroutine function to run
+        :param interval: Seconds between runs, or a function returning them (evaluated for every run)
+        :param args: Arguments for the function
+        :param timeout: Seconds a run may take before it is cancelled, None for no limit
+        :param jitter: Up to this many seconds are added at random to each start, to spread out jobs with the same
+        interval
+        :param catch_up: Whether runs missed (e.g. while a run overran) are made up back to back. Otherwise they are
+        skipped, and the job continues on the grid.
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.args = args
+        self.timeout = timeout
+        self.jitter = jitter
+        self.catch_up = catch_up
+        self.deadline = time.monotonic()
+        self.start_at = self.deadline
+        self.task = None
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.last_lateness = None
+        self.max_lateness = 0.0
+        self.last_error = None
+
+    def period(self):
+        return self.interval() if callable(self.interval) else self.interval
+
+    def advance(self, now):
+        """ Moves the deadline to the next point on the grid, skipping the missed ones unless catching up """
+        period = self.period()
+        self.deadline += period
+        if now > self.deadline and not self.catch_up:
+            missed = int((now - self.deadline) // period) + 1
+            self.skipped += missed
+            self.deadline += missed * period
+        self.start_at = self.deadline + random.uniform(0, self.jitter)
+
+    def stats(self):
+        return {
+            'interval': round(self.period(), 3),
+            'running': self.task is not None,
+            'runs': self.runs,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'max_duration': round(self.max_duration, 4),
+            'last_lateness': self.last_lateness,
+            'max_lateness': round(self.max_lateness, 4),
+            'last_error': self.last_error,
+        }
+
+
+class JobScheduler:
+    def __init__(self):
+        """
+        Runs the jobs of a process on its event loop. A job never overlaps itself: when a run is still going at its
+        next deadline, that deadline counts as skipped (or is made up later, with catch_up). Failing runs are
+        recorded and reported, and do not stop the job. Jobs are stopped by removing them.
+        """
+        self.jobs = dict()
+        self.loop = None
+        self.task = None
+        self.wake = None
+
+    def __contains__(self, name):
+        return name in self.jobs
+
+    def start(self):
+        """ Starts the scheduler in the running event loop, if it is not running there already """
+        loop = asyncio.get_event_loop()
+        if self.loop is loop and self.task is not None and not self.task.done():
+            return
+        self.loop = loop
+        self.wake = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run_loop())
+
+    def add(self, name, func, interval, args=(), delay=0.0, **options):
+        """
+        Adds a job, unless a job with the name already exists.
+        :param name: Unique name of the job
+        :param func: Coroutine function to run
+        :param interval: Seconds between runs, or a function returning them
+        :param args: Arguments for the function
+        :param delay: Seconds until the first run
+        :param options: timeout, jitter and catch_up, see Job
+        :return: The Job
+        """
+        self.start()
+        if name in self.jobs:
+            return self.jobs[name]
+        job = Job(name, func, interval, args, **options)
+        job.deadline = time.monotonic() + delay
+        job.start_at = job.deadline + random.uniform(0, job.jitter)
+        self.jobs[name] = job
+        self.wake.set()
+        return job
+
+    def remove(self, name):
+        """ Removes a job, cancelling its run if one is going """
+        job = self.jobs.pop(name, None)
+        if job is not None and job.task is not None:
+            job.task.cancel()
+
+    def stop(self):
+        """ Removes all the jobs, and stops the scheduler """
+        for name in list(self.jobs):
+            self.remove(name)
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run_loop(self):
+        while True:
+            self.wake.clear()
+            now = time.monotonic()
+            for job in list(self.jobs.values()):
+                if job.start_at > now:
+                    continue
+                if job.task is not None:
+                    if not job.catch_up:       # Still running at its next deadline
+                        job.skipped += 1
+                        job.advance(now)
+                    continue
+                lateness = now - job.deadline
+                job.last_lateness = round(lateness, 4)
+                job.max_lateness = max(job.max_lateness, lateness)
+                job.task = asyncio.ensure_future(self.run(job))
+                job.advance(now)
+            waiting = [job.start_at for job in self.jobs.values() if job.task is None or not job.catch_up]
+            delay = max(min(waiting) - time.monotonic(), 0) if waiting else None
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, job):
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(job.func(*job.args), job.timeout)
+        except asyncio.TimeoutError:
+            job.timeouts += 1
+            job.last_error = f'Timed out after {job.timeout}s'
+            print(f'Job {job.name} timed out after {job.timeout}s')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.failures += 1
+            job.last_error = repr(e)
+            print(f'Job {job.name} failed: {e!r}')
+        finally:
+            duration = time.monotonic() - start
+            job.runs += 1
+            job.last_duration = round(duration, 4)
+            job.max_duration = max(job.max_duration, duration)
+            job.task = None
+            if self.wake is not None:
+                self.wake.set()
+
+    def stats(self):
+        """ :return: Dictionary of the run counts, durations and lateness of each job """
+        return {name: job.stats() for name, job in self.jobs.items()}
+
+
+JOBS = JobScheduler()
@@ -0,0 +1,277 @@
+import asyncio
+import bisect
+import uuid
+from collections import Counter, defaultdict
+from hashlib import blake2b
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from channels_redis.utils import create_pool, decode_hosts
+from redis import asyncio as aioredis
+
+
+""" Channel layer delivering to the consumers of the same worker directly, and to the other workers through Redis """
+
+
+def ring_hash(key):
+    return int.from_bytes(blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=160):
+        """
+        Consistent hashing of keys to nodes. Every node has 'replicas' points on the ring and owns the keys hashed
+        just before them, so adding a node only moves the keys it takes over, about 1/n of them.
+        :param nodes: List of the names of the nodes, the points depend on the names and not on the order
+        :param replicas: Points per node, more spread the keys more evenly
+        """
+        points = sorted((ring_hash(f'{name}#{replica}'), node) for node, name in enumerate(nodes)
+                        for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key):
+        """
+        :param key: A string, e.g. a group name
+        :return: The index of the node owning the key
+        """
+        if len(set(self.nodes)) == 1:
+            return self.nodes[0]
+        return self.nodes[bisect.bisect(self.hashes, ring_hash(key)) % len(self.hashes)]
+
+
+class LoopState:
+    def __init__(self, layer):
+        """
+        The connections, local channels and group members of one event loop, i.e. of one worker.
+        :param layer: The HybridChannelLayer
+        """
+        self.layer = layer
+        self.instance = uuid.uuid4().hex
+        self.clients = [aioredis.Redis(connection_pool=create_pool(host)) for host in layer.hosts]
+        self.pubsubs = {}                   # shard -> PubSub
+        self.readers = {}                   # shard -> task reading the PubSub
+        self.subscribed = {}                # Redis channel -> (kind, name), kind is 'inbox', 'group' or 'join'
+        self.channels = {}                  # local channel -> Queue
+        self.groups = defaultdict(set)      # group -> local channels
+        self.alone = set()                  # groups without members in other workers, until one joins
+        self.counts = Counter()
+
+    def shard(self, key):
+        return self.layer.ring.node(key)
+
+    def key(self, kind, name):
+        return f'{self.layer.prefix}:{kind}:{name}'
+
+    async def subscribe(self, kind, name):
+        """
+        Subscribes to a Redis channel on the shard of the name, and starts reading the shard.
+        :param kind: 'inbox' for the channels of an instance, 'group' for the messages of a group, 'join' for the
+        instances joining a group
+        :param name: The instance or the group
+        """
+        channel = self.key(kind, name)
+        if channel in self.subscribed:
+            return
+        self.subscribed[channel] = (kind, name)
+        shard = self.shard(name)
+        if shard not in self.pubsubs:
+            self.pubsubs[shard] = self.clients[shard].pubsub()
+        await self.pubsubs[shard].subscribe(channel)
+        if shard not in self.readers:
+            self.readers[shard] = asyncio.ensure_future(self.read(shard))
+
+    async def unsubscribe(self, kind, name):
+        channel = self.key(kind, name)
+        if self.subscribed.pop(channel, None):
+            await self.pubsubs[self.shard(name)].unsubscribe(channel)
+
+    async def read(self, shard):
+        """ Dispatches the messages of the subscribed Redis channels of a shard, until none is left """
+        try:
+            async for message in self.pubsubs[shard].listen():
+                if message['type'] != 'message':
+                    continue
+                kind, name = self.subscribed.get(message['channel'].decode(), (None, None))
+                payload = msgpack.unpackb(message['data'], raw=False)
+                if kind == 'inbox':
+                    self.deliver(*payload)
+                elif kind == 'group' and payload[0] != self.instance:
+                    for channel in list(self.groups.get(name, ())):
+                        self.deliver(channel, payload[1])
+                elif kind == 'join' and payload != self.instance:
+                    self.alone.discard(name)
+        finally:
+            self.readers.pop(shard, None)
+
+    def deliver(self, channel, message):
+        """ Puts a message in a local channel, dropping it if the channel is full or gone """
+        queue = self.channels.get(channel)
+        if queue is None or queue.full():
+            self.counts['dropped'] += 1
+            return
+        queue.put_nowait(message)
+        self.counts['delivered'] += 1
+
+    async def new_channel(self, prefix='specific'):
+        channel = f'{prefix}.{self.instance}!{uuid.uuid4().hex}'
+        self.channels[channel] = asyncio.Queue(maxsize=self.layer.get_capacity(channel))
+        await self.subscribe('inbox', self.instance)
+        return channel
+
+    async def send(self, channel, message):
+        instance = self.layer.instance_of(channel)
+        if instance == self.instance:
+            if channel in self.channels and self.channels[channel].full():
+                raise ChannelFull(channel)
+            self.deliver(channel, message)
+        elif instance:
+            await self.clients[self.shard(instance)].publish(self.key('inbox', instance),
+                                                             msgpack.packb([channel, message]))
+        else:
+            key, client = self.key('list', channel), self.clients[self.shard(channel)]
+            if await client.llen(key) >= self.layer.get_capacity(channel):
+                raise ChannelFull(channel)
+            await client.pipeline(transaction=False).rpush(key, msgpack.packb(message)) \
+                .expire(key, self.layer.expiry).execute()
+
+    async def receive(self, channel):
+        if self.layer.instance_of(channel):
+            queue = self.channels.setdefault(channel, asyncio.Queue(maxsize=self.layer.get_capacity(channel)))
+            try:
+                return await queue.get()
+            except asyncio.CancelledError:      # The consumer is gone
+                self.channels.pop(channel, None)
+                raise
+        key, client = self.key('list', channel), self.clients[self.shard(channel)]
+        while True:
+            item = await client.blpop(key, timeout=5)
+            if item:
+                return msgpack.unpackb(item[1], raw=False)
+
+    async def group_add(self, group, channel):
+        members = self.groups[group]
+        first = not members
+        members.add(channel)
+        if first:
+            await self.subscribe('group', group)
+            await self.clients[self.shard(group)].publish(self.key('join', group), msgpack.packb(self.instance))
+
+    async def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.groups[group]
+            await self.unsubscribe('group', group)
+
+    async def group_send(self, group, message):
+        """
+        Delivers to the members of the group in this worker, and publishes to Redis only while other workers have
+        members. Whether they have is learnt from the number of receivers of the last publish, and forgotten when a
+        worker announces that it joined the group.
+        """
+        for channel in list(self.groups.get(group, ())):
+            self.deliver(channel, message)
+        if group in self.alone:
+            self.counts['skipped'] += 1
+            return
+        await self.subscribe('join', group)            # Before publishing, so no join after it is missed
+        receivers = await self.clients[self.shard(group)].publish(self.key('group', group),
+                                                                  msgpack.packb([self.instance, message]))
+        self.counts['published'] += 1
+        if receivers - (group in self.groups) <= 0:
+            self.alone.add(group)
+
+    async def flush(self):
+        for task in self.readers.values():
+            task.cancel()
+        for pubsub in self.pubsubs.values():
+            await pubsub.reset()
+        for client in self.clients:
+            async for key in client.scan_iter(match=self.key('list', '*')):
+                await client.delete(key)
+            await client.connection_pool.disconnect()
+        self.readers, self.pubsubs, self.subscribed = {}, {}, {}
+        self.channels, self.groups, self.alone = {}, defaultdict(set), set()
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, prefix='asgi', expiry=60, capacity=100, channel_capacity=None, replicas=160):
+        """
+        Channel layer for workers running their consumers in one event loop. Group messages reach the consumers of
+        the sending worker without leaving the process, and are published to Redis only while other workers have
+        members in the group. Groups and workers are sharded over the Redis hosts by consistent hashing, so each host
+        carries the broadcasts of its share of the groups.
+        Every group message of this app is sent by the ingest worker (or the loadtest command), which has no
+        consumers, so it always takes the Redis path: one publish per message, fanned out to the local members by
+        each web worker. The local path only serves producers running in the web workers, of which there are none
+        yet.
+        Messages delivered in the worker are not copied, so consumers must not modify them. Named channels without
+        '!' (e.g. the 'ingest' channel) are Redis lists, received by one worker.
+        :param hosts: List of the Redis hosts, as for channels_redis: (host, port) tuples, urls or dictionaries
+        :param prefix: Prefix of the Redis keys and channels
+        :param expiry: Seconds a message waits in a named channel
+        :param capacity: Messages a channel holds, further sends raise ChannelFull and group messages are dropped
+        :param channel_capacity: Capacities of channels matching patterns, as for the other layers
+        :param replicas: Points of each host on the hash ring
+        """
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.hosts = decode_hosts(hosts)
+        self.prefix = prefix
+        self.ring = HashRing([host.get('address') or f"{host.get('host')}:{host.get('port')}" for host in self.hosts],
+                             replicas)
+        self.states = {}                    # event loop -> LoopState, of the loops not closed yet
+        self.evicted = Counter()            # Counts of the LoopStates of closed loops
+
+    @staticmethod
+    def instance_of(channel):
+        """ :return: The instance of a process specific channel (prefix.instance!id), or None for named channels """
+        if '!' not in channel:
+            return None
+        return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+    def state(self):
+        """
+        :return: The LoopState of the running event loop. The states of closed loops (e.g. of async_to_sync calls)
+        are dropped when a new one is created, keeping their counts.
+        """
+        loop = asyncio.get_event_loop()
+        if loop not in self.states:
+            for closed in [other for other in self.states if other.is_closed()]:
+                self.evicted.update(self.states.pop(closed).counts)
+            self.states[loop] = LoopState(self)
+        return self.states[loop]
+
+    async def send(self, channel, message):
+        await self.state().send(channel, message)
+
+    async def receive(self, channel):
+        return await self.state().receive(channel)
+
+    async def new_channel(self, prefix='specific'):
+        return await self.state().new_channel(prefix)
+
+    async def group_add(self, group, channel):
+        await self.state().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self.state().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await self.state().group_send(group, message)
+
+    async def flush(self):
+        await self.state().flush()
+
+    def stats(self):
+        """ :return: The messages 'delivered' to local channels, 'dropped', 'published' and 'skipped' (group sends
+        without members in other workers) by this worker """
+        counts = Counter(self.evicted)
+        for state in self.states.values():
+            counts.update(state.counts)
+        return dict(counts)
@@ -1,29 +1,55 @@
 import asyncio
 
-from tweepy.asynchronous import AsyncClient, AsyncStreamingClient
+from tweepy import Tweet as TweepyTweet, Media as TweepyMedia, Place as TweepyPlace, User as TweepyUser
+from tweepy.asynchronous import AsyncStreamingClient
 from .models import *
-from asgiref.sync import sync_to_async
+from .cards import build_card
+from .cooccurrence import save_cooccurrence
+from .cube import save_cube
+from .records import parse_response
+from .workspaces import DEFAULT_WORKSPACE, get_workspace
+from .scoring import rank_engagement
+from .conversations import thread_path, add_references
+from .routers import primary_reads, replica_reads
+from .ratelimit import PolledEndpoint, ScheduledRequests, ScheduledClient, RULES, METRICS
+from .monitor import sync_to_async
 from channels.layers import get_channel_layer
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.utils import timezone
-from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 
 
 """ Helper functions for Django ORM - to be fed into sync_to_async in async loops """
-def set_rules_to_inactive():
+def set_rules_to_inactive(workspace=DEFAULT_WORKSPACE):
     """
-    Sets the "active" attribute of all the StreamRules objects to False.
+    Sets the "active" attribute of all the StreamRules objects of a workspace to False.
+    :param workspace: The name of the workspace
     """
-    StreamRules.objects.filter(active=True).update(active=False)
+    StreamRules.objects.filter(active=True, workspace=workspace).update(active=False)
 
 
-def add_tweet_to_db(tweet):
+def add_tweet_to_db(tweet, filters='', cluster_id=None, workspace=DEFAULT_WORKSPACE):
     """
     Takes a tweet, creates a Tweet object of it. Also adds it as a TrackedTweet.
-    Also stores the Hashtags, Mentions and Contexts of the tweet or increments the ones stored.
+    Also stores the Hashtags, Mentions and Contexts of the tweet or increments the ones stored, and the tweets it
+    references. Its place in the conversation thread is stored as a materialized path (see thread_path), and it is
+    linked to the place of its geo.place_id, if any.
+    A near-duplicate of an earlier tweet (cluster_id is not its own id) is stored with its references and linked to
+    its entities, but it is not tracked, and its entities are not counted again.
+    The entities are counted per workspace. A tweet already stored by another workspace is kept as it is, and only
+    tracked and counted for this one.
     :param tweet:
+    :param filters: The tags of the rules matching the tweet, comma separated
+    :param cluster_id: The id of the first tweet of its near-duplicate cluster, defaults to its own id
+    :param workspace: The name of the workspace whose stream received the tweet
     """
-    tw = Tweet.objects.create(
+    cluster_id = cluster_id or str(tweet.id)
+    references = tweet.data.get('referenced_tweets') or []
+    parent = next((str(ref['id']) for ref in references if ref['type'] == 'replied_to'), None)
+    try:
+        with transaction.atomic():
+            tw = Tweet.objects.create(
                 id=str(tweet.id),
                 text=tweet.text,
                 author_id=str(tweet.author_id),
@@ -33,29 +59,45 @@ def add_tweet_to_db(tweet):
                 lang=tweet.lang,
                 possibly_sensitive=tweet.possibly_sensitive,
                 reply_settings=tweet.reply_settings,
-                source=tweet.source
+                source=tweet.source,
+                filters=filters,
+                thread_path=thread_path(str(tweet.id), str(tweet.conversation_id), parent),
+                cluster_id=cluster_id,
+                workspace=workspace,
+                place_id=(tweet.data.get('geo') or {}).get('place_id')
             )
-    TrackedTweet.objects.create(
-        tweetid=tw,
-        created_at=tweet.created_at,
-        metrics_per_update=0
-    )
+        if references:
+            add_references(tw, references)
+    except IntegrityError:
+        tw = Tweet.objects.get(id=str(tweet.id))
+        if tw.workspace == workspace:
+            raise
+    counted = cluster_id == tw.id
+    if counted:
+        TrackedTweet.objects.create(
+            tweetid=tw,
+            created_at=tweet.created_at,
+            metrics_per_update=0,
+            workspace=workspace
+        )
     if tweet['entities']:
         if 'hashtags' in tweet['entities']:
             for hashtag in tweet['entities']['hashtags']:
                 tag = hashtag['tag']
                 h = None
                 try:
-                    h = Hashtag.objects.get(hashtag=tag)
-                    h.count += 1
-                    h.save()
+                    h = Hashtag.objects.get(hashtag=tag, workspace=workspace)
+                    if counted:
+                        Hashtag.objects.filter(pk=h.pk).update(count=F('count') + 1)
                 except Hashtag.DoesNotExist:
                     h = Hashtag.objects.create(
                         hashtag=tag,
-                        count=1
+                        count=int(counted),
+                        workspace=workspace
                     )
                 except Hashtag.MultipleObjectsReturned:
                     print('Multiple hashtags found')
+                    h = Hashtag.objects.filter(hashtag=tag, workspace=workspace).first()
                 tw.hashtags.add(h)
 
         if 'mentions' in tweet['entities']:
@@ -63,16 +105,18 @@ def add_tweet_to_db(tweet):
                 name = mention['username']
                 m = None
                 try:
-                    m = Mention.objects.get(mention=name)
-                    m.count += 1
-                    m.save()
+                    m = Mention.objects.get(mention=name, workspace=workspace)
+                    if counted:
+                        Mention.objects.filter(pk=m.pk).update(count=F('count') + 1)
                 except Mention.DoesNotExist:
                     m = Mention.objects.create(
                         mention=name,
-                        count=1
+                        count=int(counted),
+                        workspace=workspace
                     )
                 except Mention.MultipleObjectsReturned:
                     print('Multiple mentions found')
+                    m = Mention.objects.filter(mention=name, workspace=workspace).first()
                 tw.mentions.add(m)
 
     if 'context_annotations' in tweet:
@@ -88,67 +132,136 @@ def add_tweet_to_db(tweet):
                 d.save()
             except ContextDomain.MultipleObjectsReturned:
                 print('Multiple Domains returned')
+                d = ContextDomain.objects.filter(dom_id=context['domain']['id']).first()
             try:
-                e = ContextEntity.objects.get(ent_id=context['entity']['id'])
-                e.count += 1
-                e.save()
+                e = ContextEntity.objects.get(ent_id=context['entity']['id'], workspace=workspace)
+                if counted:
+                    ContextEntity.objects.filter(pk=e.pk).update(count=F('count') + 1)
             except ContextEntity.DoesNotExist:
                 e = ContextEntity(
                     name=context['entity']['name'],
                     ent_id=context['entity']['id'],
                     domain=d,
-                    count=1
+                    count=int(counted),
+                    workspace=workspace
                     )
                 e.save()
+            except ContextEntity.MultipleObjectsReturned:
+                print('Multiple Entities returned')
+                e = ContextEntity.objects.filter(ent_id=context['entity']['id'], workspace=workspace).first()
             tw.context.add(e)
 
 
-def update_metrics(tweetid, timestamp, retweet_count, reply_count, like_count, quote_count):
+def store_tweet(data, filters='', cluster_id=None, workspace=DEFAULT_WORKSPACE):
     """
-    Takes in the tweetid, timestamp and engagements of a tweet and stores it to the database
-    :param tweetid: The tweetid of the tweet to store
-    :param timestamp: The timestamp of when the tweet was checked
-    :param retweet_count: The amount of retweets at the time of checking
-    :param reply_count: The amount of replies at the time of checking
-    :param like_count: The amount of likes at the time of checking
-    :param quote_count: The amount of quotes at the time of checking
+    Rebuilds a tweet from its data dictionary and stores it with add_tweet_to_db.
+    The dictionary can be sent to the process pool of the ingest worker, which Tweepy's objects can not.
+    :param data: The 'data' dictionary of a Tweepy Tweet
+    :param filters: The tags of the rules matching the tweet, comma separated
+    :param cluster_id: The id of the first tweet of its near-duplicate cluster
+    :param workspace: The name of the workspace whose stream received the tweet
     """
-    TweetMetrics.objects.create(
-        tweetid=Tweet.objects.get(id=tweetid),
-        time=timestamp,
-        retweet_count=retweet_count,
-        reply_count=reply_count,
-        like_count=like_count,
-        quote_count=quote_count
-    )
+    add_tweet_to_db(TweepyTweet(data), filters, cluster_id, workspace)
 
 
-def get_tracked_tweets(starttime):
+def add_includes_to_db(media_list, user_list, place_list=()):
+    """
+    Stores the media, users and places included with a tweet. A place already stored is updated.
+    :param media_list: List of the 'data' dictionaries of Tweepy Media
+    :param user_list: List of the 'data' dictionaries of Tweepy Users
+    :param place_list: List of the 'data' dictionaries of Tweepy Places
+    """
+    for place in map(TweepyPlace, place_list):
+        west, south, east, north = (place.geo or {}).get('bbox') or (None, None, None, None)
+        Place(
+            id=place.id,
+            full_name=place.full_name,
+            name=place.name,
+            country=place.country,
+            country_code=place.country_code,
+            place_type=place.place_type,
+            west=west,
+            south=south,
+            east=east,
+            north=north
+        ).save()
+    for media in map(TweepyMedia, media_list):
+        Media(
+            media_key=media.media_key,
+            type=media.type,
+            url=media.url,
+            duration_ms=media.duration_ms,
+            height=media.height,
+            preview_image_url=media.preview_image_url,
+            width=media.width,
+            alt_text=media.alt_text
+        ).save()
+    for user in map(TweepyUser, user_list):
+        User(
+            id=user.id,
+            name=user.name,
+            username=user.username,
+            created_at=user.created_at,
+            description=user.description,
+            location=user.location,
+            pinned_tweet_id=user.pinned_tweet_id,
+            profile_image_url=user.profile_image_url,
+            protected=user.protected,
+            url=user.url,
+            verified=user.verified
+        ).save()
+
+
+def save_metrics(tweets, timestamp):
+    """
+    Stores the engagement of the checked tweets with a single insert. Tweets no longer in the database are skipped.
+    :param tweets: List of Tweepy Tweets with their public_metrics
+    :param timestamp: The timestamp of when the tweets were checked
+    """
+    stored = set(Tweet.objects.filter(id__in=[str(tweet.id) for tweet in tweets]).values_list('id', flat=True))
+    TweetMetrics.objects.bulk_create([
+        TweetMetrics(
+            tweetid_id=str(tweet.id),
+            time=timestamp,
+            retweet_count=tweet.data['public_metrics']['retweet_count'],
+            reply_count=tweet.data['public_metrics']['reply_count'],
+            like_count=tweet.data['public_metrics']['like_count'],
+            quote_count=tweet.data['public_metrics']['quote_count']
+        ) for tweet in tweets if str(tweet.id) in stored
+    ])
+
+
+@replica_reads
+def get_tracked_tweets(starttime, workspace=DEFAULT_WORKSPACE, limit=99):
     """
     Gets the tweets to check for engagement.
-    Currently only gets the 100 most recent tweets.
+    Currently only gets the 'limit' most recent tweets of the workspace.
 
     TODO: More advanced filtering of the tweets to track:
     TODO: Get tweet count, remove (old) unliked tweets and tweets with too low likes/update
     TODO: (likes/update should probably look at more instances than just one update and rank by age)
 
     :param starttime: Datetime object of when the tracking was started
+    :param workspace: The name of the workspace
+    :param limit: The number of tweets, the MAX_TRACKED of the workspace
     :return: The IDs of the tweets to check the engagement of.
     """
-    tweets = TrackedTweet.objects.filter(created_at__gte=starttime).order_by("-created_at")[:99]
+    tweets = TrackedTweet.objects.filter(created_at__gte=starttime, workspace=workspace).order_by("-created_at")[:limit]
     ids = list(tweets.values_list('tweetid', flat=True))
     return ids
 
 
-def get_10_popular_h_m_c():
+@replica_reads
+def get_10_popular_h_m_c(workspace=DEFAULT_WORKSPACE):
     """
     Gets the 10 most popular hashtags, mentions and contexts stored in the database, that is not already being tracked
     with a filter.
+    :param workspace: The name of the workspace, whose counts and rules are used
     :return: list of hashtags, list of mentions, dictionary of contexts and the occurrence of contexts.
     """
-    hashtags = list(Hashtag.objects.order_by("-count").values('hashtag', 'count'))
-    mentions = Mention.objects.order_by("-count").values('mention', 'count')
-    rules = StreamRules.objects.filter(active=True)
+    hashtags = list(Hashtag.objects.filter(workspace=workspace).order_by("-count").values('hashtag', 'count'))
+    mentions = Mention.objects.filter(workspace=workspace).order_by("-count").values('mention', 'count')
+    rules = StreamRules.objects.filter(active=True, workspace=workspace)
     ruletext = ''
     for rule in rules.values('value'):
         ruletext += ' ' + rule['value']
@@ -157,7 +270,7 @@ def get_10_popular_h_m_c():
     ctracked = [part[8:] for part in ruletext.replace('(', '').replace(')', '').split() if part.startswith('context:')]
     htags = [tag for tag in hashtags if tag['hashtag'] not in htracked]
     mnames = [name for name in mentions if name['mention'] not in mtracked]
-    cents = ContextEntity.objects.order_by("-count")
+    cents = ContextEntity.objects.filter(workspace=workspace).order_by("-count")
     contexts = []
     for context in cents:
         c = dict()
@@ -169,28 +282,62 @@ def get_10_popular_h_m_c():
     return htags[:10], mnames[:10], conts[:10]
 
 
+@primary_reads
+def get_popular_after_store(workspace=DEFAULT_WORKSPACE):
+    """
+    get_10_popular_h_m_c for right after storing a tweet, read from the primary: the ingest worker stores the tweet
+    in another process of its pool, so the replica may not have its counts yet.
+    :param workspace: The name of the workspace
+    """
+    return get_10_popular_h_m_c(workspace)
+
+
 """ The Filtered Stream class, an instance of Tweepy's asynchronous streaming client """
-class LiveStream(AsyncStreamingClient):
+class LiveStream(ScheduledRequests, AsyncStreamingClient):
+    priority = RULES            # The rule requests go through the API scheduler before the metric polls
+
+    def __init__(self, bearer_token, workspace=None, **kwargs):
+        """
+        :param bearer_token: Twitter API 2.0 Bearer Token of the workspace.
+        :param workspace: The Workspace whose groups, snapshot, trending and duplicates the stream feeds, defaults to
+        the default workspace
+        """
+        super().__init__(bearer_token, **kwargs)
+        self.workspace = workspace or get_workspace(DEFAULT_WORKSPACE)
+
+    async def store(self, func, *args):
+        """
+        Runs one of the ORM helper functions without blocking the event loop.
+        The ingest worker overrides this to run them in its process pool, so the arguments must be picklable.
+        :param func: The helper function
+        :param args: Arguments for the function
+        :return: The return value of the function
+        """
+        return await sync_to_async(func)(*args)
 
     async def update_rules_from_twitter(self):
         """
         Gets the rules from twitter, sets existing rules to inactive, adds the rules received from twitter
         to the database, and sends them to the channel group, to be forwarded by the consumer.
+        The active rules are also stored in the snapshot.
+        :return: List of the active Tweepy StreamRules
         """
         rules = await self.get_rules()
         print('Rules: ', rules)
         channel_layer = get_channel_layer()
-        await sync_to_async(set_rules_to_inactive)()
+        await sync_to_async(set_rules_to_inactive)(self.workspace.name)
+        active = list()
         try:
             for rule in rules[0]:
                 rule = StreamRules(
                     id=rule.id,
                     value=rule.value,
                     tag=rule.tag,
-                    active=True
+                    active=True,
+                    workspace=self.workspace.name
                 )
                 await channel_layer.group_send(
-                    'tweet',
+                    self.workspace.group,
                     {
                         "type": "rule",
                         "id": str(rule.id),
@@ -199,81 +346,109 @@ class LiveStream(AsyncStreamingClient):
                     }
                 )
                 await sync_to_async(rule.save)()
+                active.append({'id': str(rule.id), 'filter': str(rule.value), 'tag': str(rule.tag)})
         except TypeError:
             pass
+        await self.workspace.snapshot.publish('rules', active)
+        return rules[0] or []
+
+    async def on_data(self, raw_data):
+        """
+        Decodes a line of the stream into the slotted records of records.py, instead of building Tweepy's Tweet, User
+        and Media objects for fields that are mostly thrown away, and hands the response to on_response.
+        :param raw_data: A line of the stream
+        """
+        response = parse_response(raw_data)
+        if response.errors:
+            await self.on_errors(response.errors)
+        await self.on_response(response)
 
     async def on_response(self, response):
         """
         Method for handling the data received from twitter:
         In case of tweet (response.data):
-            Send the tweetid to the channel group (to be handled by the consumer)
-            Add the tweet to the database
-            Get the most popular hashtags mentions and contexts from the database
-            Send the hashtags, mentions and contexts to the channel group.
-
-            TODO: Also send the Username, UserID, Tweet text, creation time and any other fields needed to manually
-            TODO: create a tweet in a frontend.
+            Count the tweet in the cube by rule tag, language, source and sensitivity, and in the geo grid if it has
+            a location.
+            Drop the tweet if the workspace is over its MAX_TWEETS_PER_SECOND: it is not queued, and only counted in
+            the cube and the geo grid.
+            Find the cluster of near-duplicates the tweet belongs to (see dedup.DuplicateIndex).
+            If it is a duplicate, only store it with its cluster id: it is not broadcast, tracked or counted in the
+            popular entities, trending and co-occurrence.
+            Otherwise handle it with handle_tweet.
+        The trending snapshot and the cube are stored by jobs of the ingest worker.
 
         Generally all tweets will also include the user. If they have media content this will be included in the
-        "includes" along with the user. This method goes on to add any media and the user to the database.
+        "includes" along with the user, and the place of a tweet with a location. This method goes on to add any media,
+        the user and the places to the database.
 
-        :param response: The response object from Tweepy
+        :param response: The StreamResponse, of records from on_data
         """
         if response.data:
             tweet = response.data
-            matching_rules = response.matching_rules
-            channel_layer = get_channel_layer()
-            await channel_layer.group_send(
-                'tweet',
-                {
-                    "type": "tweet",
-                    "id": str(tweet.id),
-                    "filters": ', '.join([rule.tag for rule in matching_rules])
-                }
-            )
-            await sync_to_async(add_tweet_to_db)(tweet)
-            hashtags, mentions, contexts = await sync_to_async(get_10_popular_h_m_c)()
-            await channel_layer.group_send(
-                'tweet',
-                {
-                    "type": "hmc",
-                    "hashtags": hashtags,
-                    "mentions": mentions,
-                    "contexts": contexts
-                }
-            )
+            filters = ', '.join([rule.tag for rule in response.matching_rules])
+            places = {place['id']: place for place in (response.includes or {}).get('places', [])}
+            self.workspace.cube.add_tweet(tweet.data, filters)
+            self.workspace.geo.add_tweet(tweet.data, places, filters)
+            if not self.workspace.admit():
+                return
+            cluster_id, duplicate = self.workspace.dedup.add(str(tweet.id), tweet.text)
+            if duplicate:
+                await self.store(store_tweet, tweet.data, filters, cluster_id, self.workspace.name)
+            else:
+                await self.handle_tweet(tweet, response.includes or {}, filters)
 
         if response.includes:
             includes = response.includes
-            if 'media' in includes.keys():
-                for media in includes['media']:
-                    m = Media(
-                        media_key=media.media_key,
-                        type=media.type,
-                        url=media.url,
-                        duration_ms=media.duration_ms,
-                        height=media.height,
-                        preview_image_url=media.preview_image_url,
-                        width=media.width,
-                        alt_text=media.alt_text
-                    )
-                    await sync_to_async(m.save)()
-            if 'users' in includes.keys():
-                for user in includes['users']:
-                    u = User(
-                        id=user.id,
-                        name=user.name,
-                        username=user.username,
-                        created_at=user.created_at,
-                        description=user.description,
-                        location=user.location,
-                        pinned_tweet_id=user.pinned_tweet_id,
-                        profile_image_url=user.profile_image_url,
-                        protected=user.protected,
-                        url=user.url,
-                        verified=user.verified
-                    )
-                    await sync_to_async(u.save)()
+            await self.store(add_includes_to_db, [media.data for media in includes.get('media', [])],
+                             [user.data for user in includes.get('users', [])], includes.get('places', []))
+
+    async def handle_tweet(self, tweet, includes, filters):
+        """
+        Handles the first tweet of a cluster:
+            Build the card of the tweet (the author, text, creation time, media etc. needed to draw it) from the
+            response, and send it to the channel group (to be handled by the consumer)
+            Cache the card by tweet id
+            Add the tweet to the database
+            Get the most popular hashtags mentions and contexts from the database
+            Send the hashtags, mentions and contexts to the channel group.
+            Store the tweet and the hashtags, mentions and contexts in the snapshot.
+            Count the hashtags and mentions in the trending engine.
+            Add the hashtags and mentions to the co-occurrence graph, and store the buckets it has closed.
+        :param tweet: The TweetRecord
+        :param includes: The includes of the response
+        :param filters: The tags of the matching rules, comma separated
+        """
+        channel_layer = get_channel_layer()
+        workspace = self.workspace
+        card = build_card(tweet, includes, filters)
+        await channel_layer.group_send(
+            workspace.group,
+            {
+                "type": "tweet",
+                "id": str(tweet.id),
+                "filters": filters,
+                "card": card
+            }
+        )
+        await workspace.cards.put(card)
+        await workspace.snapshot.push_tweet(card)
+        await self.store(store_tweet, tweet.data, filters, None, workspace.name)
+        hashtags, mentions, contexts = await self.store(get_popular_after_store, workspace.name)
+        await channel_layer.group_send(
+            workspace.group,
+            {
+                "type": "hmc",
+                "hashtags": hashtags,
+                "mentions": mentions,
+                "contexts": contexts
+            }
+        )
+        await workspace.snapshot.publish('hmc', {'hashtags': hashtags, 'mentions': mentions, 'contexts': contexts})
+        workspace.trending.add_tweet(tweet)
+        workspace.cooccurrence.add_tweet(tweet)
+        edges = workspace.cooccurrence.pop_pending()
+        if edges:
+            await self.store(save_cooccurrence, edges, workspace.cooccurrence.bucket_seconds, workspace.name)
 
     async def on_errors(self, errors):
         """
@@ -282,59 +457,48 @@ class LiveStream(AsyncStreamingClient):
         """
         print(errors)
 
-    async def on_closed(self, resp):
+    async def send_status(self, message):
         """
-        If we lose the streaming connection, we send a message to the group channel to be handled by the consumer.
-        :param resp: response (aiohttp.ClientResponse) – The response from Twitter
+        Sends a status message to the group channel to be handled by the consumer, and stores it in the snapshot.
+        :param message: The status message
         """
         channel_layer = get_channel_layer()
         await channel_layer.group_send(
-            'tweet',
+            self.workspace.group,
             {
                 "type": "status",
-                "message": "Stream connection closed by Twitter"
+                "message": message
             }
         )
+        await self.workspace.snapshot.publish('status', {'stream': message})
+
+    async def on_closed(self, resp):
+        """
+        If we lose the streaming connection, we send a message to the group channel to be handled by the consumer.
+        :param resp: response (aiohttp.ClientResponse) – The response from Twitter
+        """
+        await self.send_status("Stream connection closed by Twitter")
 
     async def on_connect(self):
         """
         Upon connecting to Twitter, we send a message to the group channel to be handled by the consumer.
         """
-        channel_layer = get_channel_layer()
         print('Connected to Twitter')
-        await channel_layer.group_send(
-            'tweet',
-            {
-                "type": "status",
-                "message": "Streaming"
-            }
-        )
+        await self.send_status("Streaming")
 
     async def on_connection_error(self):
         """
         If we cannot connect, we send a message to the group channel to be handled by the consumer.
         """
-        channel_layer = get_channel_layer()
-        await channel_layer.group_send(
-            'tweet',
-            {
-                "type": "status",
-                "message": "Stream connection has errored or timed out"
-            }
-        )
+        await self.send_status("Stream connection has errored or timed out")
 
     async def on_disconnect(self):
         """
-        Upon disconnecting, we send a message to the group channel to be handled by the consumer.
+        Upon disconnecting, we send a message to the group channel to be handled by the consumer, and flush the
+        counts of the cube.
         """
-        channel_layer = get_channel_layer()
-        await channel_layer.group_send(
-            'tweet',
-            {
-                "type": "status",
-                "message": "Stream disconnected"
-            }
-        )
+        await self.send_status("Stream disconnected")
+        await self.store(save_cube, self.workspace.cube.flush(), self.workspace.name)
 
     async def on_request_error(self, status_code):
         """
@@ -342,150 +506,121 @@ class LiveStream(AsyncStreamingClient):
         This message contains the status code received
         :param status_code: The HTTP status code encountered
         """
-        channel_layer = get_channel_layer()
-        await channel_layer.group_send(
-            'tweet',
-            {
-                "type": "status",
-                "message": f'Stream encountered HTTP Error: {status_code}'
-            }
-        )
+        await self.send_status(f'Stream encountered HTTP Error: {status_code}')
+
 
+class EngagementTracker(PolledEndpoint):
+    endpoint = 'GET /2/tweets'  # The endpoint polled, its remaining quota sets the time between updates
 
-class EngagementTracker:
-    def __init__(self, bearer_token):
+    def __init__(self, bearer_token, workspace=None):
         """
-        Upon initiating the engagement tracker, store the bearer token and set its tracking status to False.
+        Upon initiating the engagement tracker, store the bearer token. The updates are run as a job of the ingest
+        worker (see jobs.JobScheduler), every 'interval' seconds.
         :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param workspace: The Workspace whose tweets are tracked, defaults to the default workspace
         """
-        self.tracking = False
         self.bearer_token = bearer_token
+        self.workspace = workspace or get_workspace(DEFAULT_WORKSPACE)
+        self.engagement = dict()    # tweetid -> (summed engagement, time) of the last update
+        self.velocity = dict()      # tweetid -> engagements per minute between the last two updates
 
     async def engagement_update(self, starttime):
         """
         Method to handle each update of the metrics.
 
-        Each time it is called, it collects the tweets to track from the database, initiates the Tweepy Client,
-        gets the tweets from the Twitter API, along with their public_metrics. It then sends the metrics, tweetid and
-        a timestamp of the current time to the update_metrics function.
+        Each time it is called, it collects the tweets to track from the database, and gets them from the Twitter API
+        along with their public_metrics, 100 at a time. The calls go through the API scheduler, the batch with the
+        fastest growing tweets first. It then sends the metrics, tweetid and a timestamp of the current time to the
+        save_metrics function.
 
         Following this it collects metrics statistics from the database through the get_tweet_metrics function
-        before sending these metrics to the group channel to be handled by the consumer.
+        before sending these metrics to the group channel to be handled by the consumer, and storing them in the
+        snapshot.
 
         :param starttime: Datetime object of when the tracking was started.
         """
-        tweetids = await sync_to_async(get_tracked_tweets)(starttime)
-        client = AsyncClient(self.bearer_token)
-        tweets = await client.get_tweets(tweetids, tweet_fields=['public_metrics'])
+        workspace = self.workspace
+        tweetids = await sync_to_async(get_tracked_tweets)(starttime, workspace.name, workspace.limits['MAX_TRACKED'])
+        tweetids.sort(key=lambda tweetid: -self.velocity.get(tweetid, 0))
+        batches = [tweetids[i:i + 100] for i in range(0, len(tweetids), 100)]
+        self.calls = max(len(batches), 1)
+        clients = [ScheduledClient(self.bearer_token, priority=METRICS + 1 / (1 + self.velocity.get(batch[0], 0)))
+                   for batch in batches]
+        responses = await asyncio.gather(*[
+            client.get_tweets(batch, tweet_fields=['public_metrics']) for client, batch in zip(clients, batches)
+        ])
+        tweets = [tweet for response in responses for tweet in response.data or []]
         timestamp = timezone.now()
         print(f"Engagement updated at {timestamp.strftime('%X')}")
-        for tweet in tweets[0]:                                         # Probably inefficient
-            await sync_to_async(update_metrics)(
-                tweetid=tweet.id,
-                timestamp=timestamp,
-                retweet_count=tweet.data['public_metrics']['retweet_count'],
-                reply_count=tweet.data['public_metrics']['reply_count'],
-                like_count=tweet.data['public_metrics']['like_count'],
-                quote_count=tweet.data['public_metrics']['quote_count']
-            )
+        self.track_velocity(tweets, timestamp)
+        await sync_to_async(save_metrics)(tweets, timestamp)
         results = await sync_to_async(get_tweet_metrics)(timestamp, tweetids)
         channel_layer = get_channel_layer()
         await channel_layer.group_send(
-            'tweet',
+            workspace.group,
             {
                 "type": "tweetmetrics",
                 "results": results
             }
         )
+        await workspace.snapshot.publish('tweetmetrics', results)
 
-    async def periodic_update(self, __seconds: float, func, *args, **kwargs):
+    def track_velocity(self, tweets, timestamp):
         """
-        Function to periodically update the tweet metrics.
-        :param __seconds: Int of how often we want the metrics to update
-        :param func: The function to call
-        :param args: Arguments for the function
-        :param kwargs: Keyword arguments for the function
-        """
-        while True:
-            if not self.tracking:
-                break
-            await asyncio.gather(
-                asyncio.sleep(__seconds),
-                func(*args, **kwargs)
-            )
+        Updates the engagement velocity of the tweets, used to poll the fastest growing tweets first.
+        :param tweets: The Tweepy Tweets with public_metrics
+        :param timestamp: The time of the update
+        """
+        engagement = dict()
+        for tweet in tweets:
+            total = sum(tweet.data['public_metrics'][k] for k in ('retweet_count', 'reply_count', 'like_count',
+                                                                   'quote_count'))
+            tweetid = str(tweet.id)
+            engagement[tweetid] = (total, timestamp)
+            if tweetid in self.engagement:
+                before, then = self.engagement[tweetid]
+                minutes = max((timestamp - then).total_seconds() / 60, 1 / 60)
+                self.velocity[tweetid] = max(total - before, 0) / minutes
+        self.engagement = engagement
+        self.velocity = {tweetid: v for tweetid, v in self.velocity.items() if tweetid in engagement}
+
+    def state(self):
+        """ :return: The engagement and velocity of the tracked tweets, to checkpoint """
+        engagement = {tweetid: [total, then.timestamp()] for tweetid, (total, then) in self.engagement.items()}
+        return {'engagement': engagement, 'velocity': self.velocity}
+
+    def restore(self, state):
+        """
+        Restores a checkpointed state, so the velocities are known from the first update after a restart.
+        :param state: Dictionary from state()
+        """
+        self.engagement = {tweetid: (total, datetime.fromtimestamp(then, tz=dt_timezone.utc))
+                           for tweetid, (total, then) in state['engagement'].items()}
+        self.velocity = dict(state['velocity'])
 
 
-def get_tweet_metrics(timestamp, tweetids):
+def delete_old_metrics(minutes=4):
     """
-    Function to collect metric statistics of the tweets.
+    Deletes the metrics older than the longest interval ranked (with a margin), run as a job of the ingest worker,
+    which keeps them longer while the trackers' ticks are stretched (see IngestController.retain_metrics).
+    :param minutes: The age of the metrics to delete
+    """
+    TweetMetrics.objects.filter(time__lte=timezone.now() - timedelta(minutes=minutes)).delete()
 
-    It first deletes the metrics older than (currently) 4 minutes
-    It then grabs all stored metrics sorted by tweetid and time
 
-    It then goes through the results and adds the metrics for our tracked tweets to a dictionary, before checking
-    if we have enough updates for our tracked tweets to gather stats. If there are, the relevant statistics is added
-    to the dictionary.
+@primary_reads
+def get_tweet_metrics(timestamp, tweetids):
+    """
+    Function to collect metric statistics of the tweets.
 
-    Upon adding stats to any tracked tweets, we add the metrics to our result dictionary.
-    We then sort the metrics for each interval, before we finally add the 5 top results to a sorted list for each
-    interval in the res_sorted dictionary.
+    The metrics were just stored, so they are read from the primary.
+    It ranks the tracked tweets with rank_engagement, which loads their stored metrics into NumPy arrays and
+    for each interval compares the latest update with the update nearest 30, 60 or 180 seconds before it.
+    Along with the intervals it ranks the tweets by their trending score (see scoring.engagement_scores).
 
     :param timestamp: datetime object of the time the EngagementTracker.engagement_update method was called
     :param tweetids: The tweetids that are being tracked.
-    :return: Dictionary of lists for each interval
-    """
-    old = TweetMetrics.objects.filter(time__lte=timestamp-timedelta(minutes=4))
-    old.delete()
-    metrics = TweetMetrics.objects.all().order_by('tweetid', '-time')
-    tweetdict = defaultdict(list)
-    res = dict()
-    res_sorted = dict()
-    res['30'] = dict()
-    res['60'] = dict()
-    res['180'] = dict()
-    tweetmetrics = dict()
-    for metric in metrics:
-        if metric.tweetid.id not in tweetids:
-            continue
-        tweetdict[metric.tweetid.id].append(metric)
-    for tweet in tweetdict:
-        tweetmetric = dict()
-        if len(tweetdict[tweet]) < 2:
-            continue
-        if len(tweetdict[tweet]) >= 2:
-            tweetmetric['30'] = metric_count(tweetdict[tweet][0])-metric_count(tweetdict[tweet][1])
-        if len(tweetdict[tweet]) >= 3:
-            tweetmetric['60'] = metric_count(tweetdict[tweet][0])-metric_count(tweetdict[tweet][2])
-        if len(tweetdict[tweet]) >= 7:
-            tweetmetric['180'] = metric_count(tweetdict[tweet][0])-metric_count(tweetdict[tweet][6])
-        if len(tweetmetric) > 0:
-            tweetmetrics[tweet] = tweetmetric
-    for tweet in tweetmetrics:
-        if tweetmetrics[tweet]['30'] > 0:
-            res['30'][tweet] = tweetmetrics[tweet]['30']
-        if '60' in tweetmetrics[tweet].keys():
-            if tweetmetrics[tweet]['60'] > 0:
-                res['60'][tweet] = tweetmetrics[tweet]['60']
-        if '180' in tweetmetrics[tweet].keys():
-            if tweetmetrics[tweet]['180'] > 0:
-                res['180'][tweet] = tweetmetrics[tweet]['180']
-    for interval in res:
-        res_sorted[interval] = list()
-        r = ({k: v for k, v in sorted(res[interval].items(), key=lambda item: item[1], reverse=True)})
-        i = 0
-        for kp in r:
-            if i >= 5:
-                break
-            res_sorted[interval].append({'id': kp, 'count': r[kp]})
-            i += 1
-
-    return res_sorted
-
-
-def metric_count(count):
+    :return: Dictionary of lists of the 5 top tweets for each interval and for 'trending'
     """
-    Method to sum the engagement metrics collected from twitter
-    :param count: TweetMetrics instance
-    :return: Summed metric counts.
-    """
-    return count.retweet_count+count.reply_count+count.like_count+count.quote_count
+    return rank_engagement(timestamp, tweetids)
+
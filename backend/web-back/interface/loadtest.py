@@ -0,0 +1,254 @@
+import asyncio
+import json
+import math
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import aiohttp
+from channels.layers import get_channel_layer
+
+
+""" Load test of the websocket fanout: synthetic group events sent by a producer, timed at the websocket clients """
+EVENTS = ('tweet', 'hmc', 'tweetmetrics')
+PRECISION = 1.01                    # Ratio between the histogram buckets, i.e. percentiles are within 1%
+PERCENTILES = (50, 99, 99.9)
+
+
+class LatencyHistogram:
+    def __init__(self, counts=None):
+        """
+        Histogram of latencies with logarithmic buckets, so its size does not grow with the number of samples, and
+        the histograms of several client processes can be merged.
+        :param counts: Dictionary of bucket -> count, e.g. from another histogram
+        """
+        self.counts = Counter(counts or {})
+
+    def record(self, seconds):
+        """ :param seconds: A latency, the buckets start at 1 microsecond """
+        self.counts[int(math.log(max(seconds, 1e-6) * 1e6, PRECISION))] += 1
+
+    def merge(self, counts):
+        self.counts.update(counts)
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, q):
+        """
+        :param q: The percentile, e.g. 99.9
+        :return: The upper bound of the bucket holding the percentile in seconds, or None without samples
+        """
+        total = self.total()
+        if not total:
+            return None
+        rank, seen = math.ceil(round(q / 100 * total, 9)), 0     # Rounded, or 99.9% of 1000 would be 999.0000001
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return PRECISION ** (bucket + 1) / 1e6
+        return None
+
+
+def synthetic_event(kind, seq, size=10):
+    """
+    Builds a group event shaped like the ones of the ingest worker, see LiveStream.handle_tweet and
+    EngagementTracker.track.
+    :param kind: One of EVENTS
+    :param seq: Sequence number of the event
+    :param size: Entries in the lists of hmc and tweetmetrics events
+    :return: Dictionary of the event, without the 'sent' timestamp
+    """
+    if kind == 'tweet':
+        return {'type': 'tweet', 'id': str(seq), 'filters': 'loadtest', 'card': {
+            'id': str(seq), 'text': 'Load test tweet ' + 'x' * 200, 'created_at': None, 'lang': 'en',
+            'filters': 'loadtest', 'conversation_id': str(seq), 'possibly_sensitive': False,
+            'public_metrics': {'retweet_count': 0, 'reply_count': 0, 'like_count': 0, 'quote_count': 0},
+            'referenced_tweets': [], 'media': [],
+            'author': {'id': '1', 'name': 'Load test', 'username': 'loadtest', 'profile_image_url': None,
+                       'verified': False}}}
+    if kind == 'hmc':
+        return {'type': 'hmc',
+                'hashtags': [{'hashtag': f'tag{i}', 'count': seq + i} for i in range(size)],
+                'mentions': [{'mention': f'user{i}', 'count': seq + i} for i in range(size)],
+                'contexts': [{'name': f'Domain: Entity {i}', 'id': f'{i}.{i}', 'count': seq + i} for i in range(size)]}
+    return {'type': 'tweetmetrics', 'results': [
+        {'tweetid': str(i), 'retweet_count': seq, 'reply_count': seq, 'like_count': seq, 'quote_count': seq}
+        for i in range(size)]}
+
+
+async def produce(group, rates, start, duration):
+    """
+    Sends the synthetic events to the group at fixed rates, each with the unix time it was sent. Sends are scheduled
+    on absolute times, so a slow group_send is reported as 'late' instead of lowering the rate.
+    :param group: The channel layer group of the workspace
+    :param rates: Dictionary of event type -> events per second
+    :param start: Unix time to start sending at
+    :param duration: Seconds to send for
+    :return: Dictionary of event type -> events sent, and the number of 'late' sends
+    """
+    channel_layer = get_channel_layer()
+    sent = Counter()
+
+    async def send(kind, rate):
+        for seq in range(int(duration * rate)):
+            delay = start + seq / rate - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -1 / rate:
+                sent['late'] += 1
+            event = synthetic_event(kind, seq)
+            event['sent'] = time.time()
+            await channel_layer.group_send(group, event)
+            sent[kind] += 1
+
+    await asyncio.gather(*[send(kind, rate) for kind, rate in rates.items() if rate > 0])
+    return sent
+
+
+async def listen(session, url, start, end, histograms, received, errors):
+    """
+    One websocket client: connects at 'start', times the load test events until 'end', then disconnects.
+    :param session: The aiohttp ClientSession
+    :param url: The websocket url
+    :param start: Unix time to connect at
+    :param end: Unix time to disconnect at
+    :param histograms: Dictionary of event type -> LatencyHistogram, shared by the clients of the process
+    :param received: Counter of event type -> events received, shared
+    :param errors: Counter of 'refused', 'failed' and 'closed' connections, shared
+    """
+    await asyncio.sleep(max(start - time.time(), 0))
+    try:
+        async with session.ws_connect(url, heartbeat=None) as socket:
+            while True:
+                try:
+                    message = await socket.receive(timeout=max(end - time.time(), 0))
+                except asyncio.TimeoutError:
+                    return
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    if message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED):
+                        errors['closed'] += 1
+                    return
+                data = json.loads(message.data)
+                if 'sent' in data:
+                    histograms[data['type']].record(time.time() - data['sent'])
+                    received[data['type']] += 1
+                elif data.get('type') == 'snapshot':
+                    received['snapshot'] += 1
+    except aiohttp.WSServerHandshakeError:        # The consumer refused the connection, e.g. over MAX_CLIENTS
+        errors['refused'] += 1
+    except (aiohttp.ClientError, OSError):
+        errors['failed'] += 1
+
+
+def run_clients(url, clients, ramp_start, ramp, end):
+    """
+    Runs websocket clients in this process, connecting them evenly over the ramp. Runs in the worker processes.
+    :param url: The websocket url
+    :param clients: Number of clients
+    :param ramp_start: Unix time to start connecting at
+    :param ramp: Seconds to connect the clients over
+    :param end: Unix time to disconnect at
+    :return: Dictionary of the histogram counts per event type, the events 'received', the connection 'errors' and
+    the 'cpu' seconds used by the process
+    """
+    histograms = {kind: LatencyHistogram() for kind in EVENTS}
+    received, errors = Counter(), Counter()
+
+    async def main():
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*[listen(session, url, ramp_start + ramp * i / max(clients, 1), end, histograms,
+                                          received, errors) for i in range(clients)])
+
+    cpu = sum(os.times()[:2])
+    asyncio.new_event_loop().run_until_complete(main())
+    return {'histograms': {kind: dict(histogram.counts) for kind, histogram in histograms.items()},
+            'received': dict(received), 'errors': dict(errors), 'cpu': sum(os.times()[:2]) - cpu}
+
+
+def server_pids(match):
+    """
+    :param match: Text in the command line of the server processes, e.g. 'config.asgi'
+    :return: List of the pids of the matching processes (Linux only, an empty list elsewhere)
+    """
+    pids = []
+    if not os.path.isdir('/proc'):
+        return pids
+    for pid in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as file:
+                cmdline = file.read().replace(b'\0', b' ').decode(errors='replace')
+        except OSError:
+            continue
+        if match in cmdline and int(pid) != os.getpid() and 'loadtest' not in cmdline:
+            pids.append(int(pid))
+    return pids
+
+
+def cpu_seconds(pid):
+    """
+    :param pid: A process id
+    :return: User and system CPU seconds of the process, or None if it is gone
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def load_test(url, group, clients, processes, rates, duration, ramp=10, drain=5, match='config.asgi'):
+    """
+    Opens the websocket clients, sends the synthetic events once all are connected, and reports the producer to
+    client latency per event type, the events dropped (expected deliveries that never arrived) and the CPU used by
+    every server process.
+    :param url: The websocket url of the workspace, e.g. ws://localhost:8000/ws/tweets
+    :param group: The channel layer group of the same workspace
+    :param clients: Total number of websocket clients
+    :param processes: Number of client processes the clients are spread over
+    :param rates: Dictionary of event type -> events per second
+    :param duration: Seconds to send events for
+    :param ramp: Seconds to connect the clients over
+    :param drain: Seconds to wait for the last events after sending
+    :param match: Text in the command line of the server processes to report the CPU of
+    :return: Dictionary of the report
+    """
+    ramp_start = time.time() + 2                # Time to start the client processes
+    start = ramp_start + ramp + 1
+    end = start + duration + drain
+    per_process = [clients // processes + (i < clients % processes) for i in range(processes)]
+    pids = server_pids(match)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn')) as executor:
+        futures = [executor.submit(run_clients, url, count, ramp_start, ramp, end) for count in per_process if count]
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(asyncio.sleep(max(start - time.time(), 0)))
+        cpu_start = {pid: cpu_seconds(pid) for pid in pids}
+        sent = loop.run_until_complete(produce(group, rates, start, duration))
+        cpu_end = {pid: cpu_seconds(pid) for pid in pids}
+        elapsed = time.time() - start
+        results = [future.result() for future in futures]
+    histograms = {kind: LatencyHistogram() for kind in EVENTS}
+    received, errors = Counter(), Counter()
+    for result in results:
+        for kind, counts in result['histograms'].items():
+            histograms[kind].merge(counts)
+        received.update(result['received'])
+        errors.update(result['errors'])
+    connected = received['snapshot']
+    events = {}
+    for kind in EVENTS:
+        if not sent[kind]:
+            continue
+        histogram = histograms[kind]
+        events[kind] = {'sent': sent[kind], 'received': received[kind],
+                        'dropped': max(sent[kind] * connected - received[kind], 0),
+                        **{f'p{q:g}': histogram.percentile(q) for q in PERCENTILES + (100,)}}
+    return {'clients': clients, 'connected': connected, 'errors': dict(errors), 'late': sent['late'],
+            'events': events,
+            'server_cpu': {pid: round((cpu_end[pid] - cpu_start[pid]) / elapsed * 100, 1)
+                           for pid in pids if cpu_start[pid] is not None and cpu_end[pid] is not None},
+            'client_cpu': round(sum(result['cpu'] for result in results) / (end - ramp_start) * 100, 1)}
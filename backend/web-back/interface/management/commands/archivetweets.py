@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from interface.archive import archive_tweets
+
+
+class Command(BaseCommand):
+    help = 'Moves tweets older than the retention horizon from the database to the Parquet archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.ARCHIVE['RETENTION_DAYS'],
+                            help='Archive tweets older than DAYS days')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Tweets archived per batch')
+        parser.add_argument('--keep', action='store_true', help='Write the archive without deleting the tweets')
+        parser.add_argument('--path', default=None, help='Directory of the archive')
+
+    def handle(self, *args, **options):
+        try:
+            import pyarrow
+        except ImportError:
+            raise CommandError('The archive requires pyarrow, install it with "pip install pyarrow"')
+        before = timezone.now() - timedelta(days=options['days'])
+        archived = archive_tweets(before, chunk_size=options['chunk_size'], delete=not options['keep'],
+                                  path=options['path'])
+        self.stdout.write(f'Archived {archived} tweets created before {before:%Y-%m-%d %H:%M}')
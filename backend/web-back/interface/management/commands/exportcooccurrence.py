@@ -0,0 +1,29 @@
+import sys
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from interface.cooccurrence import export_adjacency
+from interface.workspaces import DEFAULT_WORKSPACE
+
+
+class Command(BaseCommand):
+    help = 'Exports the hashtag and mention co-occurrence graph as an adjacency list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workspace', default=DEFAULT_WORKSPACE, help='The workspace to export')
+        parser.add_argument('--hours', type=int, default=None,
+                            help='Only include co-occurrences from the last HOURS hours')
+        parser.add_argument('-o', '--output', default=None, help='File to write to, defaults to stdout')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['hours'] is not None:
+            since = timezone.now() - timedelta(hours=options['hours'])
+        if options['output'] is None:
+            nodes = export_adjacency(sys.stdout, options['workspace'], since)
+        else:
+            with open(options['output'], 'w') as out:
+                nodes = export_adjacency(out, options['workspace'], since)
+        self.stderr.write(f'Exported {nodes} nodes')
@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from interface.export import EXPORTS, FORMATS, export_chunks
+from interface.views import parse_time
+from interface.workspaces import DEFAULT_WORKSPACE
+
+
+class Command(BaseCommand):
+    help = 'Exports tweets, metrics or entity counts as NDJSON or CSV, without loading them all into memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--workspace', default=DEFAULT_WORKSPACE, help='The workspace to export')
+        parser.add_argument('--start', help='Only rows from this ISO date or datetime')
+        parser.add_argument('--end', help='Only rows before this ISO date or datetime')
+        parser.add_argument('--tag', help='Only tweets matching the rule with this tag')
+        parser.add_argument('--lang', help='Only tweets in this language')
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows read per query')
+        parser.add_argument('-o', '--output', default=None, help='File to write to, defaults to stdout')
+
+    def handle(self, *args, **options):
+        try:
+            start = parse_time(options['start'])
+            end = parse_time(options['end'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        chunks = export_chunks(options['kind'], options['format'], options['chunk_size'],
+                               workspace=options['workspace'], start=start, end=end, tag=options['tag'],
+                               lang=options['lang'])
+        out = sys.stdout if options['output'] is None else open(options['output'], 'w', newline='')
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,29 @@
+from aiohttp import web
+from django.core.management.base import BaseCommand
+
+from interface.fakeapi import ENDPOINTS, FakeTwitterApi
+
+
+def limit(value):
+    """ :param value: 'METHOD /route=calls', e.g. 'GET /2/tweets=10' """
+    endpoint, _, calls = value.rpartition('=')
+    if endpoint not in ENDPOINTS:
+        raise ValueError(value)
+    return endpoint, int(calls)
+
+
+class Command(BaseCommand):
+    help = 'Serves a local fake of the Twitter API endpoints the ingest worker calls, with rate limit headers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost', help='Host to listen on')
+        parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+        parser.add_argument('--limit', type=limit, action='append', default=[],
+                            help="Calls per window of an endpoint as 'METHOD /route=CALLS', e.g. "
+                                 "--limit 'GET /2/tweets=10'")
+        parser.add_argument('--window', type=int, default=900, help='Seconds in a rate limit window')
+
+    def handle(self, *args, **options):
+        api = FakeTwitterApi(limits=dict(options['limit']), window=options['window'])
+        self.stdout.write(f"Set RATELIMIT['API_URL'] to 'http://{options['host']}:{options['port']}'")
+        web.run_app(api.app(), host=options['host'], port=options['port'], print=None)
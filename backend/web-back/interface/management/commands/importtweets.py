@@ -0,0 +1,34 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from interface.importer import import_dumps
+from interface.workspaces import DEFAULT_WORKSPACE, get_workspace
+
+
+class Command(BaseCommand):
+    help = ('Imports archived stream responses from NDJSON dumps (gzip, bzip2 or xz compressed) with bulk inserts. '
+            'Run it with the ingest worker stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='The dumps, one response or tweet per line')
+        parser.add_argument('--workspace', default=DEFAULT_WORKSPACE, help='Workspace to import the tweets into')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes parsing the dumps, defaults to the number of cores')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Lines parsed and loaded at a time')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per insert statement')
+        parser.add_argument('--filters', default='', help='Filters of the tweets without matching rules')
+        parser.add_argument('--keep-indexes', action='store_true',
+                            help='Update the indexes on every insert, instead of building them at the end')
+
+    def handle(self, *args, **options):
+        missing = [path for path in options['paths'] if not os.path.isfile(path)]
+        if missing:
+            raise CommandError(f"No such file: {', '.join(missing)}")
+        if get_workspace(options['workspace']) is None:
+            raise CommandError(f"Unknown workspace {options['workspace']}")
+        stats = import_dumps(options['paths'], workspace=options['workspace'], workers=options['workers'],
+                             chunk_size=options['chunk_size'], batch_size=options['batch_size'],
+                             defer_indexes=not options['keep_indexes'], filters=options['filters'])
+        self.stdout.write(f"Imported {stats['tweets']} tweets, {stats['users']} users and {stats['media']} media. "
+                          f"Skipped {stats['skipped']} tweets already stored, and {stats['errors']} unreadable.")
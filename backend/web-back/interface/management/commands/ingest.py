@@ -0,0 +1,35 @@
+import asyncio
+import signal
+
+from django.core.management.base import BaseCommand
+
+from interface.ingest import IngestController
+
+
+class Command(BaseCommand):
+    help = 'Runs the ingest worker, which owns the streams of the workspaces and stores the tweets in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Processes parsing and storing tweets, defaults to the number of cores')
+
+    def handle(self, *args, **options):
+        asyncio.run(self.serve(IngestController(workers=options['workers'])))
+
+    async def serve(self, controller):
+        """
+        Runs the controller until SIGTERM (e.g. docker stop) or SIGINT, which cancel it so that it stops its streams
+        and writes its checkpoint before exiting.
+        :param controller: The IngestController
+        """
+        task = asyncio.ensure_future(controller.run())
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            self.stdout.write('Ingest worker stopped')
+        finally:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
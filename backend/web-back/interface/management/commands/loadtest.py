@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from interface.loadtest import EVENTS, PERCENTILES, load_test
+from interface.workspaces import DEFAULT_WORKSPACE, get_workspace
+
+
+def rate(value):
+    """ :param value: 'event=rate', e.g. 'tweet=50' """
+    kind, _, per_second = value.partition('=')
+    if kind not in EVENTS:
+        raise ValueError(value)
+    return kind, float(per_second)
+
+
+class Command(BaseCommand):
+    help = 'Opens many websocket clients against a running server and times the fanout of synthetic group events'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='ws://localhost:8000/ws/tweets',
+                            help='Websocket url, without the workspace')
+        parser.add_argument('--workspace', default=DEFAULT_WORKSPACE, help='Workspace to connect to and send to')
+        parser.add_argument('--clients', type=int, default=1000, help='Websocket clients')
+        parser.add_argument('--processes', type=int, default=4, help='Processes running the clients')
+        parser.add_argument('--rate', type=rate, action='append', default=[],
+                            help='Events per second as EVENT=RATE, e.g. --rate tweet=50 (default tweet=20, hmc=1 '
+                                 'and tweetmetrics=0.2)')
+        parser.add_argument('--duration', type=float, default=60, help='Seconds to send events for')
+        parser.add_argument('--ramp', type=float, default=10, help='Seconds to connect the clients over')
+        parser.add_argument('--drain', type=float, default=5, help='Seconds to wait for the last events')
+        parser.add_argument('--server-match', default='config.asgi',
+                            help='Text in the command line of the server processes to report the CPU of')
+
+    def handle(self, *args, **options):
+        workspace = get_workspace(options['workspace'])
+        if workspace is None:
+            raise CommandError(f"Unknown workspace {options['workspace']}, add it to WORKSPACES")
+        url = options['url'].rstrip('/')
+        if workspace.name != DEFAULT_WORKSPACE:
+            url += f'/{workspace.name}'
+        rates = {'tweet': 20, 'hmc': 1, 'tweetmetrics': 0.2}
+        rates.update(options['rate'])
+        self.stdout.write(f"Connecting {options['clients']} clients to {url}, sending {rates} for "
+                          f"{options['duration']:g}s")
+        report = load_test(url, workspace.group, options['clients'], options['processes'], rates,
+                           options['duration'], ramp=options['ramp'], drain=options['drain'],
+                           match=options['server_match'])
+        self.stdout.write(f"Connected {report['connected']} of {report['clients']} clients, errors: "
+                          f"{report['errors'] or 'none'}, late sends: {report['late']}")
+        for kind, stats in report['events'].items():
+            latencies = ', '.join(f'p{q:g} {stats[f"p{q:g}"] * 1000:.1f}ms' if stats[f'p{q:g}'] is not None
+                                  else f'p{q:g} -' for q in PERCENTILES + (100,))
+            self.stdout.write(f"{kind}: sent {stats['sent']}, received {stats['received']}, "
+                              f"dropped {stats['dropped']}, {latencies}")
+        for pid, cpu in report['server_cpu'].items():
+            self.stdout.write(f'Server process {pid}: {cpu}% CPU')
+        self.stdout.write(f"Client processes: {report['client_cpu']}% CPU")
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cooccurrence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=281)),
+                ('target', models.CharField(max_length=281)),
+                ('time', models.DateTimeField(db_index=True)),
+                ('weight', models.IntegerField()),
+            ],
+        ),
+    ]
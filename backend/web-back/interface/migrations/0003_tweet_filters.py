@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0002_cooccurrence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='filters',
+            field=models.CharField(default='', max_length=512),
+        ),
+    ]
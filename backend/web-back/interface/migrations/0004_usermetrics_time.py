@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0003_tweet_filters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usermetrics',
+            name='time',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0004_usermetrics_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referencedtweet',
+            name='conversation_id',
+            field=models.CharField(db_index=True, default=None, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='referencedtweet',
+            name='created_at',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='referencedtweet',
+            name='source',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='references', to='interface.tweet'),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='thread_path',
+            field=models.CharField(default='', max_length=1024),
+        ),
+        migrations.AlterField(
+            model_name='referencedtweet',
+            name='tweetid',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='tweet',
+            name='conversation_id',
+            field=models.CharField(db_index=True, default=None, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='referencedtweet',
+            index=models.Index(fields=['type', 'created_at'], name='interface_r_type_cf9038_idx'),
+        ),
+    ]
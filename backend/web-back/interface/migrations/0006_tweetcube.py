@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0005_referenced_tweets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TweetCube',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('tag', models.CharField(max_length=128)),
+                ('lang', models.CharField(max_length=16)),
+                ('source', models.CharField(max_length=128)),
+                ('possibly_sensitive', models.BooleanField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='tweetcube',
+            constraint=models.UniqueConstraint(fields=('resolution', 'bucket', 'tag', 'lang', 'source', 'possibly_sensitive'), name='unique_cube_cell'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0006_tweetcube'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tweet',
+            name='cluster_id',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0007_tweet_cluster_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contextentity',
+            name='workspace',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='hashtag',
+            name='workspace',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='mention',
+            name='workspace',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='streamrules',
+            name='workspace',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='trackedtweet',
+            name='workspace',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='workspace',
+            field=models.CharField(db_index=True, default='default', max_length=32),
+        ),
+    ]
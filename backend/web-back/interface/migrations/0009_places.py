@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0008_workspaces'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeoCube',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.IntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('tag', models.CharField(max_length=128)),
+                ('cell_x', models.IntegerField()),
+                ('cell_y', models.IntegerField()),
+                ('country_code', models.CharField(max_length=8)),
+                ('place', models.CharField(max_length=255)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Place',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('full_name', models.CharField(max_length=255)),
+                ('name', models.CharField(default=None, max_length=255, null=True)),
+                ('country', models.CharField(default=None, max_length=255, null=True)),
+                ('country_code', models.CharField(default=None, max_length=8, null=True)),
+                ('place_type', models.CharField(default=None, max_length=32, null=True)),
+                ('west', models.FloatField(default=None, null=True)),
+                ('south', models.FloatField(default=None, null=True)),
+                ('east', models.FloatField(default=None, null=True)),
+                ('north', models.FloatField(default=None, null=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='geocube',
+            constraint=models.UniqueConstraint(fields=('resolution', 'bucket', 'tag', 'cell_x', 'cell_y', 'country_code', 'place'), name='unique_geo_cell'),
+        ),
+        migrations.AddField(
+            model_name='tweet',
+            name='place',
+            field=models.ForeignKey(db_constraint=False, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, to='interface.place'),
+        ),
+    ]
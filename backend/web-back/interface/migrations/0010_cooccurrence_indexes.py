@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-19 13:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0009_places'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cooccurrence',
+            index=models.Index(fields=['source', 'time'], name='interface_c_source_c99a90_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cooccurrence',
+            index=models.Index(fields=['target', 'time'], name='interface_c_target_9fa7c7_idx'),
+        ),
+    ]
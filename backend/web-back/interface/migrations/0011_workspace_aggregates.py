@@ -0,0 +1,60 @@
+# Generated by Django 4.2.30 on 2026-10-19 13:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('interface', '0010_cooccurrence_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='geocube',
+            name='unique_geo_cell',
+        ),
+        migrations.RemoveConstraint(
+            model_name='tweetcube',
+            name='unique_cube_cell',
+        ),
+        migrations.RemoveIndex(
+            model_name='cooccurrence',
+            name='interface_c_source_c99a90_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='cooccurrence',
+            name='interface_c_target_9fa7c7_idx',
+        ),
+        migrations.AddField(
+            model_name='cooccurrence',
+            name='workspace',
+            field=models.CharField(default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='geocube',
+            name='workspace',
+            field=models.CharField(default='default', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='tweetcube',
+            name='workspace',
+            field=models.CharField(default='default', max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='cooccurrence',
+            index=models.Index(fields=['workspace', 'source', 'time'], name='interface_c_workspa_d08d3c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cooccurrence',
+            index=models.Index(fields=['workspace', 'target', 'time'], name='interface_c_workspa_ff3909_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='geocube',
+            constraint=models.UniqueConstraint(fields=('workspace', 'resolution', 'bucket', 'tag', 'cell_x', 'cell_y', 'country_code', 'place'), name='unique_geo_cell'),
+        ),
+        migrations.AddConstraint(
+            model_name='tweetcube',
+            constraint=models.UniqueConstraint(fields=('workspace', 'resolution', 'bucket', 'tag', 'lang', 'source', 'possibly_sensitive'), name='unique_cube_cell'),
+        ),
+    ]
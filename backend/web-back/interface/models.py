@@ -6,11 +6,13 @@ class StreamRules(models.Model):
     value = models.CharField(max_length=512)
     tag = models.CharField(max_length=255, default=None, null=True)
     active = models.BooleanField(default=None)
+    workspace = models.CharField(default='default', max_length=32, db_index=True)  # See interface/workspaces.py
 
 
 class Hashtag(models.Model):
     hashtag = models.CharField(max_length=280)
     count = models.IntegerField(default=0)
+    workspace = models.CharField(default='default', max_length=32, db_index=True)  # See interface/workspaces.py
 
     def __str__(self):
         return self.hashtag
@@ -19,6 +21,7 @@ class Hashtag(models.Model):
 class Mention(models.Model):
     mention = models.CharField(max_length=280)
     count = models.IntegerField(default=0)
+    workspace = models.CharField(default='default', max_length=32, db_index=True)  # See interface/workspaces.py
 
     def __str__(self):
         return self.mention
@@ -37,6 +40,7 @@ class ContextEntity(models.Model):
     name = models.CharField(max_length=200)
     domain = models.ForeignKey(ContextDomain, on_delete=models.SET_NULL, null=True)
     count = models.IntegerField(default=0)
+    workspace = models.CharField(default='default', max_length=32, db_index=True)  # See interface/workspaces.py
 
     def __str__(self):
         return self.name
@@ -48,7 +52,7 @@ class Tweet(models.Model):
     # attachements = dict | None
     author_id = models.CharField(default=None, max_length=255)
     # context_annotations = list # Moved to the context field
-    conversation_id = models.CharField(default=None, max_length=255)
+    conversation_id = models.CharField(default=None, max_length=255, db_index=True)
     created_at = models.DateTimeField(default=None)
     # entities = dict | None # Split into the hashtags and mention fields
     # geo = dict | None
@@ -59,10 +63,16 @@ class Tweet(models.Model):
     possibly_sensitive = models.BooleanField(default=None)
     # promoted_metrics = dict | None  # Only available for publishing user
     # public_metrics = dict | None  # Handled by the TweetMetrics model
-    # referenced_tweets = list[ReferencedTweet] | None
+    # referenced_tweets = list[ReferencedTweet] | None  # Stored in the ReferencedTweet model
     reply_settings = models.CharField(default=None, max_length=255)
     source = models.CharField(default=None, max_length=255)
     # withheld = dict | None  # Dict from JSON of the reason for a tweet being withheld
+    filters = models.CharField(default='', max_length=512)  # Tags of the matching rules, comma separated
+    thread_path = models.CharField(default='', max_length=1024)  # Ids from the conversation root, '/' separated
+    cluster_id = models.CharField(default='', max_length=255, db_index=True)  # First tweet of its near-duplicates
+    workspace = models.CharField(default='default', max_length=32, db_index=True)  # The first that stored it
+    # The place of geo.place_id, stored from the includes after the tweet, so without a database constraint
+    place = models.ForeignKey('Place', on_delete=models.SET_NULL, null=True, default=None, db_constraint=False)
     hashtags = models.ManyToManyField(Hashtag)
     mentions = models.ManyToManyField(Mention)
     context = models.ManyToManyField(ContextEntity)
@@ -81,8 +91,14 @@ class TweetMetrics(models.Model):
 
 
 class ReferencedTweet(models.Model):
-    tweetid = models.CharField(max_length=255)
-    type = models.CharField(max_length=255)
+    tweetid = models.CharField(max_length=255, db_index=True)  # The referenced tweet
+    type = models.CharField(max_length=255)  # replied_to, quoted or retweeted
+    source = models.ForeignKey(Tweet, on_delete=models.CASCADE, related_name='references', null=True)
+    conversation_id = models.CharField(default=None, max_length=255, null=True, db_index=True)
+    created_at = models.DateTimeField(default=None, null=True)  # When the referencing tweet was created
+
+    class Meta:
+        indexes = [models.Index(fields=['type', 'created_at'])]
 
 
 class User(models.Model):
@@ -107,6 +123,7 @@ class User(models.Model):
 
 class UserMetrics(models.Model):
     user_id = models.ForeignKey(User, on_delete=models.CASCADE)
+    time = models.DateTimeField(default=None, null=True)
     followers_count = models.IntegerField()
     following_count = models.IntegerField()
     tweet_count = models.IntegerField()
@@ -131,6 +148,23 @@ class Media(models.Model):
         return self.media_key
 
 
+class Place(models.Model):
+    id = models.CharField(max_length=255, primary_key=True)
+    full_name = models.CharField(max_length=255)
+    name = models.CharField(default=None, max_length=255, null=True)
+    country = models.CharField(default=None, max_length=255, null=True)
+    country_code = models.CharField(default=None, max_length=8, null=True)
+    place_type = models.CharField(default=None, max_length=32, null=True)
+    # Bounding box of the place, from the bbox of its geo
+    west = models.FloatField(default=None, null=True)
+    south = models.FloatField(default=None, null=True)
+    east = models.FloatField(default=None, null=True)
+    north = models.FloatField(default=None, null=True)
+
+    def __str__(self):
+        return self.full_name
+
+
 class MediaMetrics(models.Model):
     media_key = models.ForeignKey(Media, on_delete=models.CASCADE)
     view_count = models.IntegerField()
@@ -140,7 +174,51 @@ class TrackedTweet(models.Model):
     tweetid = models.ForeignKey(Tweet, on_delete=models.CASCADE)
     created_at = models.DateTimeField()
     metrics_per_update = models.IntegerField()
+    workspace = models.CharField(default='default', max_length=32, db_index=True)  # See interface/workspaces.py
+
+
+class Cooccurrence(models.Model):
+    source = models.CharField(max_length=281)
+    target = models.CharField(max_length=281)
+    time = models.DateTimeField(db_index=True)
+    weight = models.IntegerField()
+    workspace = models.CharField(default='default', max_length=32)  # See interface/workspaces.py
 
+    class Meta:
+        indexes = [models.Index(fields=['workspace', 'source', 'time']),
+                   models.Index(fields=['workspace', 'target', 'time'])]
 
 
+class TweetCube(models.Model):
+    """ Tweet counts per time bucket, rule tag, language, source and sensitivity, maintained by interface/cube.py """
+    resolution = models.IntegerField()  # Seconds per bucket: 60, 3600 or 86400
+    bucket = models.DateTimeField()
+    tag = models.CharField(max_length=128)
+    lang = models.CharField(max_length=16)
+    source = models.CharField(max_length=128)
+    possibly_sensitive = models.BooleanField()
+    count = models.IntegerField(default=0)
+    workspace = models.CharField(default='default', max_length=32)  # See interface/workspaces.py
+
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=['workspace', 'resolution', 'bucket', 'tag', 'lang', 'source', 'possibly_sensitive'],
+            name='unique_cube_cell')]
+
+
+class GeoCube(models.Model):
+    """ Tweet counts per time bucket, rule tag, grid cell, country and place, maintained by interface/geo.py """
+    resolution = models.IntegerField()  # Seconds per bucket: 60, 3600 or 86400
+    bucket = models.DateTimeField()
+    tag = models.CharField(max_length=128)
+    cell_x = models.IntegerField()  # Column of the grid cell, floor(longitude / GEO['GRID_DEGREES'])
+    cell_y = models.IntegerField()  # Row of the grid cell, floor(latitude / GEO['GRID_DEGREES'])
+    country_code = models.CharField(max_length=8)
+    place = models.CharField(max_length=255)  # Id of the place, '' for exact coordinates without a place
+    count = models.IntegerField(default=0)
+    workspace = models.CharField(default='default', max_length=32)  # See interface/workspaces.py
 
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=['workspace', 'resolution', 'bucket', 'tag', 'cell_x', 'cell_y', 'country_code', 'place'],
+            name='unique_geo_cell')]
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from functools import wraps
+
+from asgiref.sync import sync_to_async as asgiref_sync_to_async
+from django.conf import settings
+
+
+""" Event loop watchdog and sampling profiler, for finding what stalls a worker """
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+MONITOR_FILE = os.path.abspath(__file__)
+
+
+def monitor_setting(name, default=None):
+    return getattr(settings, 'MONITOR', {}).get(name, default)
+
+
+def describe(frame):
+    """
+    :param frame: A frame object
+    :return: The function name and location of the frame, e.g. 'LiveStream.on_response (livetweets.py:290)'
+    """
+    name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+    return f'{name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})'
+
+
+def culprit(frame):
+    """
+    Finds what a blocked thread is running.
+    :param frame: The current frame of the thread
+    :return: The outermost frame of this app, i.e. the consumer handler or LiveStream callback that was called by the
+    loop, and the innermost frame, i.e. the blocking call. Both as strings, the first is None outside the app.
+    """
+    frames = list()
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    handler = next((f for f in reversed(frames) if f.f_code.co_filename.startswith(PACKAGE_DIR)
+                    and f.f_code.co_filename != MONITOR_FILE), None)
+    return (describe(handler) if handler is not None else None), describe(frames[0])
+
+
+def sample_profile(seconds, interval=0.005, thread_id=None):
+    """
+    Samples the stacks of the running threads, and counts how often each stack was seen.
+    :param seconds: How long to sample for
+    :param interval: Seconds between samples
+    :param thread_id: Only sample this thread, e.g. the event loop's
+    :return: The stacks in the folded format of flame graph tools, one 'thread;outer;...;inner count' per line,
+    most frequent first
+    """
+    counts = Counter()
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me or (thread_id is not None and ident != thread_id):
+                continue
+            stack = list()
+            while frame is not None:
+                stack.append(describe(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return '\n'.join(f'{stack} {count}' for stack, count in counts.most_common())
+
+
+class LoopMonitor:
+    def __init__(self, interval=0.05, threshold=0.25, history=100):
+        """
+        Measures the lag of the event loop with a heartbeat task, which should wake up every 'interval' seconds.
+        A watchdog thread checks the heartbeat, and when the loop has been blocked for more than 'threshold' seconds
+        it records the stall along with the handler and the call blocking it.
+        :param interval: Seconds between heartbeats
+        :param threshold: Seconds the loop may be blocked before it is flagged
+        :param history: The number of lag samples and stalls kept
+        """
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = deque(maxlen=history)        # (unix time, seconds late) of the heartbeats
+        self.stalls = deque(maxlen=history)
+        self.waits = dict()                     # function name -> [calls, total wait, max wait] of sync_to_async
+        self.loop = None
+        self.loop_thread = None
+        self.beat = time.monotonic()
+        self.task = None
+        self.watchdog = None
+
+    def start(self):
+        """ Starts monitoring the running event loop, if it is not monitored already """
+        loop = asyncio.get_event_loop()
+        if self.loop is loop and self.task is not None and not self.task.done():
+            return
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.task = asyncio.ensure_future(self.heartbeat())
+        if self.watchdog is None or not self.watchdog.is_alive():
+            self.watchdog = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+            self.watchdog.start()
+
+    def stop(self):
+        """ Stops the heartbeat, and the watchdog after its next check, e.g. before the loop is closed """
+        if self.task is not None:
+            self.task.cancel()
+        self.task = None
+
+    async def heartbeat(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.beat = time.monotonic()
+            self.lag.append((time.time(), self.beat - start - self.interval))
+
+    def watch(self):
+        stalled = None          # The heartbeat the current stall started after
+        while self.task is not None:
+            time.sleep(self.interval)
+            beat = self.beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            if stalled == beat:
+                self.stalls[-1]['duration'] = round(blocked, 3)
+                continue
+            stalled = beat
+            handler, call = culprit(frame)
+            self.stalls.append({'time': time.time(), 'duration': round(blocked, 3), 'handler': handler, 'call': call})
+            print(f'Event loop blocked for {blocked:.2f}s in {handler}, at {call}')
+
+    def record_wait(self, name, seconds):
+        """
+        Records how long a sync_to_async call waited for its thread.
+        :param name: The name of the function called
+        :param seconds: The wait
+        """
+        stats = self.waits.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def stats(self):
+        """
+        :return: Dictionary of the recent lag (last, mean and max), the recent stalls, and the sync_to_async waits
+        (calls, mean and max) for each function
+        """
+        lag = [seconds for _, seconds in self.lag]
+        return {
+            'lag': {
+                'last': round(lag[-1], 4) if lag else None,
+                'mean': round(sum(lag) / len(lag), 4) if lag else None,
+                'max': round(max(lag), 4) if lag else None,
+            },
+            'stalls': list(self.stalls),
+            'waits': {name: {'calls': calls, 'mean': round(total / calls, 4), 'max': round(longest, 4)}
+                      for name, (calls, total, longest) in self.waits.items()},
+        }
+
+
+MONITOR = LoopMonitor(interval=monitor_setting('INTERVAL', 0.05), threshold=monitor_setting('THRESHOLD', 0.25))
+
+
+def sync_to_async(func, **kwargs):
+    """
+    asgiref's sync_to_async, recording how long each call waits for the thread it runs in.
+    The ORM helpers share a single thread, so a long wait means the helpers are queueing behind each other.
+    """
+    name = getattr(func, '__qualname__', repr(func))
+
+    @wraps(func)
+    async def wrapper(*args, **kw):
+        submitted = time.monotonic()
+
+        def timed():
+            MONITOR.record_wait(name, time.monotonic() - submitted)
+            return func(*args, **kw)
+        return await asgiref_sync_to_async(timed, **kwargs)()
+    return wrapper
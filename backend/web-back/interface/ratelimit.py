@@ -0,0 +1,298 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import time
+from collections import defaultdict
+
+import aiohttp
+from django.conf import settings
+from tweepy import TooManyRequests
+from tweepy.asynchronous import AsyncClient
+from yarl import URL
+
+
+""" Scheduler for the Twitter API calls, keeping to the rate limits reported by the API """
+TWITTER_API = 'https://api.twitter.com'
+RULES = 0           # Priorities of the calls, lower goes first
+METRICS = 10        # Tweet metric polls get METRICS plus up to 1, the hottest tweets first
+USERS = 20
+
+
+def ratelimit_setting(name, default=None):
+    return getattr(settings, 'RATELIMIT', {}).get(name, default)
+
+
+def limit_key(endpoint, bearer_token):
+    """
+    The rate limits are counted per app, so the calls of workspaces with different bearer tokens (see
+    workspaces.Workspace) are limited separately.
+    :param endpoint: The endpoint, as 'METHOD /route'
+    :param bearer_token: The bearer token of the app making the calls
+    :return: The key of the endpoint's RateLimit in the scheduler
+    """
+    if not bearer_token:
+        return endpoint
+    return f'{endpoint} {hashlib.sha1(bearer_token.encode()).hexdigest()[:8]}'
+
+
+def api_session(api_url):
+    """
+    Creates an aiohttp session sending the requests for the Twitter API to another base url, e.g. a local fake endpoint.
+    :param api_url: The base url, e.g. 'http://localhost:8080'
+    :return: aiohttp ClientSession
+    """
+    class ApiRequest(aiohttp.ClientRequest):
+        def __init__(self, method, url, *args, **kwargs):
+            if str(url).startswith(TWITTER_API):
+                url = URL(api_url.rstrip('/') + str(url)[len(TWITTER_API):], encoded=True)
+            super().__init__(method, url, *args, **kwargs)
+    return aiohttp.ClientSession(request_class=ApiRequest)
+
+
+class RateLimit:
+    def __init__(self, window=900):
+        """
+        Token bucket of one endpoint. The API counts the calls in fixed windows (15 minutes), so the bucket is refilled
+        when the window resets, and the tokens are corrected from the x-rate-limit-* headers of every response.
+        Until the first response the limit is unknown, and calls are not held back.
+        :param window: Seconds in a rate limit window, used until the API reports when the window resets
+        """
+        self.window = window
+        self.limit = None
+        self.tokens = None
+        self.reset = 0.0            # Unix time the window resets
+
+    def refill(self, now):
+        if now >= self.reset:
+            self.tokens = self.limit
+            if self.limit is not None:
+                self.reset = now + self.window
+
+    def wait(self, now):
+        """
+        :param now: Unix time
+        :return: Seconds until a call can be made
+        """
+        self.refill(now)
+        if self.tokens is None or self.tokens >= 1:
+            return 0.0
+        return max(self.reset - now, 0.0)
+
+    def take(self):
+        if self.tokens is not None:
+            self.tokens -= 1
+
+    def update(self, headers):
+        """
+        Sets the bucket to the limits reported in the headers of a response.
+        :param headers: The response headers
+        """
+        if 'x-rate-limit-limit' in headers:
+            self.limit = int(headers['x-rate-limit-limit'])
+        if 'x-rate-limit-remaining' in headers:
+            self.tokens = int(headers['x-rate-limit-remaining'])
+        if 'x-rate-limit-reset' in headers:
+            self.reset = float(headers['x-rate-limit-reset'])
+
+    def exhausted(self, headers, now):
+        """
+        Empties the bucket after a 429 response. Without a reset header, the calls are held back for a minute.
+        :param headers: The response headers
+        :param now: Unix time
+        """
+        self.update(headers)
+        self.tokens = 0
+        if 'x-rate-limit-reset' not in headers:
+            self.reset = now + 60
+
+    def interval(self, minimum, calls, now):
+        """
+        Gets the time between ticks of a loop making 'calls' calls per tick, spreading the remaining calls over the
+        rest of the window.
+        :param minimum: The shortest interval in seconds
+        :param calls: Calls made per tick
+        :param now: Unix time
+        :return: Interval in seconds
+        """
+        self.refill(now)
+        if self.tokens is None:
+            return minimum
+        return max(minimum, calls * max(self.reset - now, 0.0) / max(self.tokens, 1))
+
+
+class ApiScheduler:
+    def __init__(self, concurrency=4, retries=3):
+        """
+        Queues the API calls, and runs them in priority order as their endpoint's rate limit allows.
+        A call answered with 429 is queued again, up to 'retries' times, to run when the window resets.
+        :param concurrency: The maximum number of calls running at the same time
+        :param retries: The number of times a rate limited call is retried
+        """
+        self.concurrency = concurrency
+        self.retries = retries
+        self.limits = defaultdict(RateLimit)     # 'METHOD /route app' -> RateLimit, see limit_key
+        self.queue = list()                     # Heap of (priority, order, endpoint, func, args, future, attempt)
+        self.order = itertools.count()
+        self.running = 0
+        self.loop = None
+        self.wake = None
+        self.dispatcher = None
+        self.session = None
+
+    def start(self):
+        """ Starts the dispatcher in the running event loop, if it is not running there already """
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = list()
+            self.running = 0
+            self.session = None
+            self.dispatcher = None
+        if self.dispatcher is None or self.dispatcher.done():
+            self.wake = asyncio.Event()
+            self.dispatcher = asyncio.ensure_future(self.dispatch_loop())
+
+    async def call(self, endpoint, priority, func, *args):
+        """
+        Queues an API call and waits for its result.
+        :param endpoint: The rate limited endpoint, as 'METHOD /route'
+        :param priority: Lower goes first, see RULES, METRICS and USERS
+        :param func: Coroutine function making the request, returning the aiohttp response
+        :param args: Arguments for the function
+        :return: The return value of the function
+        """
+        self.start()
+        future = self.loop.create_future()
+        heapq.heappush(self.queue, (priority, next(self.order), endpoint, func, args, future, 0))
+        self.wake.set()
+        return await future
+
+    def dispatch(self):
+        """
+        Starts the queued calls whose endpoint has a token, highest priority first, while there are free slots.
+        :return: Seconds until a held back call can be made, or None to wait for a new or finished call
+        """
+        now = time.time()
+        delay = None
+        held = list()
+        while self.queue and self.running < self.concurrency:
+            entry = heapq.heappop(self.queue)
+            if entry[5].done():                 # Cancelled by the caller
+                continue
+            limit = self.limits[entry[2]]
+            wait = limit.wait(now)
+            if wait > 0:
+                held.append(entry)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            limit.take()
+            self.running += 1
+            asyncio.ensure_future(self.run(entry))
+        for entry in held:
+            heapq.heappush(self.queue, entry)
+        return delay
+
+    async def dispatch_loop(self):
+        while True:
+            self.wake.clear()
+            delay = self.dispatch()
+            try:
+                await asyncio.wait_for(self.wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, entry):
+        priority, order, endpoint, func, args, future, attempt = entry
+        try:
+            response = await func(*args)
+            self.limits[endpoint].update(response.headers)
+            if not future.done():
+                future.set_result(response)
+        except TooManyRequests as e:
+            self.limits[endpoint].exhausted(e.response.headers, time.time())
+            if attempt < self.retries:
+                print(f'Rate limited on {endpoint}, retrying after the reset')
+                heapq.heappush(self.queue, (priority, order, endpoint, func, args, future, attempt + 1))
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self.running -= 1
+            self.wake.set()
+
+    def interval(self, endpoint, minimum, calls=1):
+        """
+        Gets the tick size of a polling loop, growing as the remaining quota of its endpoint shrinks.
+        :param endpoint: The endpoint polled, as 'METHOD /route'
+        :param minimum: The tick size when the quota allows it, in seconds
+        :param calls: Calls made per tick
+        :return: Seconds until the next tick
+        """
+        return self.limits[endpoint].interval(minimum, calls, time.time())
+
+    async def get_session(self):
+        """ Gets the session for the fake endpoint in RATELIMIT['API_URL'], or None to use the Twitter API """
+        api_url = ratelimit_setting('API_URL')
+        if not api_url:
+            return None
+        self.start()
+        if self.session is None or self.session.closed:
+            self.session = api_session(api_url)
+        return self.session
+
+    async def close(self):
+        if self.dispatcher is not None:
+            self.dispatcher.cancel()
+            self.dispatcher = None
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+SCHEDULER = ApiScheduler(concurrency=ratelimit_setting('CONCURRENCY', 4), retries=ratelimit_setting('RETRIES', 3))
+
+
+class ScheduledRequests:
+    """
+    Mixin for the Tweepy clients, sending every API request through the scheduler with the client's priority.
+    """
+    scheduler = SCHEDULER
+    priority = METRICS
+
+    async def request(self, method, route, params=None, json=None, user_auth=False):
+        if self.session is None:
+            self.session = await self.scheduler.get_session()
+        return await self.scheduler.call(limit_key(f'{method} {route}', self.bearer_token), self.priority,
+                                         super().request, method, route, params, json, user_auth)
+
+
+class ScheduledClient(ScheduledRequests, AsyncClient):
+    def __init__(self, bearer_token, priority=METRICS, **kwargs):
+        """
+        A Tweepy AsyncClient whose requests are rate limited by the scheduler.
+        :param bearer_token: Twitter API 2.0 Bearer Token.
+        :param priority: Priority of the client's calls, lower goes first
+        """
+        super().__init__(bearer_token, **kwargs)
+        self.priority = priority
+
+
+class PolledEndpoint:
+    """
+    Mixin for the loops polling an endpoint as a job, whose interval is stretched by the remaining quota of the
+    endpoint. The class needs a 'bearer_token', and sets 'calls' to the calls made by its last run.
+    """
+    endpoint = None             # The endpoint polled, as 'METHOD /route'
+    calls = 1                   # Calls made per run
+
+    def interval(self, minimum):
+        """
+        Gets the time between runs: 'minimum' seconds, stretched when the remaining quota of the endpoint would
+        not last until the rate limit window resets.
+        :param minimum: Seconds between runs when the quota allows it
+        :return: Seconds until the next run
+        """
+        return SCHEDULER.interval(limit_key(self.endpoint, self.bearer_token), minimum, self.calls)
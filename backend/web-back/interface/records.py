@@ -0,0 +1,99 @@
+from datetime import datetime
+
+from tweepy import StreamResponse, StreamRule
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+
+""" Lightweight records for the lines of the filtered stream, decoded without building Tweepy's objects """
+
+
+def parse_created(value):
+    """
+    :param value: A timestamp of the API, e.g. '2022-07-04T10:03:00.000Z'
+    :return: The aware datetime, or None
+    """
+    return datetime.fromisoformat(value.replace('Z', '+00:00')) if value else None
+
+
+def to_int(value):
+    return int(value) if value is not None else None
+
+
+class Record:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+class TweetRecord(Record):
+    """ A tweet with the attributes read by the stream handlers, like Tweepy's Tweet; the rest stays in 'data' """
+    __slots__ = ('id', 'text', 'author_id', 'conversation_id', 'created_at', 'lang', 'possibly_sensitive',
+                 'public_metrics', 'attachments', 'entities')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.id = int(data['id'])
+        self.text = data.get('text')
+        self.author_id = to_int(data.get('author_id'))
+        self.conversation_id = to_int(data.get('conversation_id'))
+        self.created_at = parse_created(data.get('created_at'))
+        self.lang = data.get('lang')
+        self.possibly_sensitive = data.get('possibly_sensitive')
+        self.public_metrics = data.get('public_metrics')
+        self.attachments = data.get('attachments')
+        self.entities = data.get('entities')
+
+
+class UserRecord(Record):
+    __slots__ = ('id', 'name', 'username', 'profile_image_url', 'verified')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.id = int(data['id'])
+        self.name = data.get('name')
+        self.username = data.get('username')
+        self.profile_image_url = data.get('profile_image_url')
+        self.verified = data.get('verified')
+
+
+class MediaRecord(Record):
+    __slots__ = ('media_key', 'type', 'url', 'preview_image_url')
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.media_key = data.get('media_key')
+        self.type = data.get('type')
+        self.url = data.get('url')
+        self.preview_image_url = data.get('preview_image_url')
+
+
+INCLUDES = {'users': UserRecord, 'media': MediaRecord}     # Other includes (places, tweets, polls) stay dictionaries
+
+
+def parse_response(raw_data):
+    """
+    Decodes a line of the filtered stream into a Tweepy StreamResponse of records, which the stream handlers read
+    like Tweepy's objects (tweet.id, tweet.data, tweet['entities'], user.username, rule.tag...).
+    :param raw_data: The line, str or bytes
+    :return: The StreamResponse
+    """
+    data = loads(raw_data)
+    tweet = TweetRecord(data['data']) if 'data' in data else None
+    includes = {key: [INCLUDES[key](item) for item in items] if key in INCLUDES else items
+                for key, items in data.get('includes', {}).items()}
+    matching_rules = [StreamRule(id=rule['id'], tag=rule['tag']) for rule in data.get('matching_rules', [])]
+    return StreamResponse(tweet, includes, data.get('errors', []), matching_rules)
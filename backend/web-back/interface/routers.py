@@ -0,0 +1,112 @@
+import time
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+
+""" Database router sending the dashboard reads to a read replica, when one is configured """
+replica_allowed = ContextVar('replica_allowed', default=False)
+primary_pinned = ContextVar('primary_pinned', default=False)
+last_write = ContextVar('last_write', default=0.0)
+measured_lag = {'time': 0.0, 'lag': None}
+
+
+def replica_setting(name, default=None):
+    return getattr(settings, 'REPLICA', {}).get(name, default)
+
+
+def replica_reads(func):
+    """
+    Decorator for the read-only helpers that may read from the replica. Only the reads made while the function runs
+    are affected, and they still go to the primary if the replica lags or this context has written recently.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = replica_allowed.set(True)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            replica_allowed.reset(token)
+    return wrapper
+
+
+def primary_reads(func):
+    """
+    Decorator for the helpers whose reads must see writes made elsewhere, e.g. by another process of the ingest
+    worker's pool, which READ_AFTER_WRITE cannot know about since it only follows the writes of the current context.
+    Their reads go to the primary, the ones of the replica_reads helpers they call included.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        token = primary_pinned.set(True)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            primary_pinned.reset(token)
+    return wrapper
+
+
+def replica_lag(alias):
+    """
+    Gets the replication lag of the replica in seconds, measured at most every 'LAG_CHECK_INTERVAL' seconds.
+    On MySQL it is read from the replica status; other databases (e.g. two local SQLite files) are taken to be in
+    sync.
+    :param alias: The database alias of the replica
+    :return: The lag in seconds, or None if the replica is not replicating or cannot be reached
+    """
+    now = time.monotonic()
+    if now - measured_lag['time'] < replica_setting('LAG_CHECK_INTERVAL', 5):
+        return measured_lag['lag']
+    lag = 0
+    connection = connections[alias]
+    if connection.vendor == 'mysql':
+        try:
+            with connection.cursor() as cursor:
+                try:
+                    cursor.execute('SHOW REPLICA STATUS')
+                except Exception:
+                    cursor.execute('SHOW SLAVE STATUS')
+                row = cursor.fetchone()
+                columns = [column[0] for column in cursor.description or []]
+            status = dict(zip(columns, row)) if row else {}
+            lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+        except Exception as e:
+            print(f'Could not read the replica status: {e!r}')
+            lag = None
+    measured_lag.update(time=now, lag=lag)
+    return lag
+
+
+class ReplicaRouter:
+    """
+    Reads made inside a replica_reads helper go to the replica alias, unless:
+    - no replica is configured,
+    - the replica lags more than 'MAX_LAG' seconds, or its lag is unknown,
+    - the current context wrote to the primary less than 'READ_AFTER_WRITE' seconds ago,
+    - they are made inside a primary_reads helper (e.g. the ranking of the metrics just updated, or the popular
+      entities of the tweet just stored by another process).
+    All writes and all other reads go to the primary.
+    """
+    def db_for_read(self, model, **hints):
+        alias = replica_setting('ALIAS', 'replica')
+        if primary_pinned.get() or not replica_allowed.get() or alias not in settings.DATABASES:
+            return 'default'
+        if time.monotonic() - last_write.get() < replica_setting('READ_AFTER_WRITE', 10):
+            return 'default'
+        lag = replica_lag(alias)
+        if lag is None or lag > replica_setting('MAX_LAG', 5):
+            return 'default'
+        return alias
+
+    def db_for_write(self, model, **hints):
+        last_write.set(time.monotonic())
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        """ The replica gets its tables through replication """
+        return db != replica_setting('ALIAS', 'replica')
@@ -4,4 +4,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     path(r'ws/tweets', consumers.TweetConsumer.as_asgi()),
+    path(r'ws/tweets/<str:workspace>', consumers.TweetConsumer.as_asgi()),
 ]
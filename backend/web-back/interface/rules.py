@@ -0,0 +1,142 @@
+import asyncio
+
+from .monitor import sync_to_async
+from channels.layers import get_channel_layer
+from tweepy import StreamRule
+
+from .models import StreamRules
+
+
+""" Helper functions for Django ORM - to be fed into sync_to_async in async loops """
+def save_rule_diff(deleted, added, workspace):
+    """
+    Stores a change of the rule set: the deleted rules are set to inactive, and the added rules stored as active.
+    :param deleted: The ids of the deleted rules
+    :param added: List of dictionaries with the 'id', 'value' and 'tag' of the added rules
+    :param workspace: The name of the workspace the rules belong to
+    """
+    StreamRules.objects.filter(id__in=deleted).update(active=False)
+    for rule in added:
+        StreamRules(id=rule['id'], value=rule['value'], tag=rule['tag'], active=True, workspace=workspace).save()
+
+
+def rule_diff(active, edits, clear=False):
+    """
+    Computes the smallest change turning the active rules into the edited rule set. An edit replaces the rules with
+    its tag, and is skipped if the tag already has exactly that rule.
+    :param active: Dictionary of the active rules, id -> {'value', 'tag'}
+    :param edits: Dictionary of the edited rules, tag -> value
+    :param clear: Whether all rules are deleted before the edits
+    :return: List of rule ids to delete, and list of (value, tag) to add
+    """
+    by_tag = dict()
+    for id, rule in active.items():
+        by_tag.setdefault(rule['tag'], []).append(id)
+    if clear:
+        delete = list(active)
+    else:
+        delete = [id for tag in edits for id in by_tag.get(tag, [])
+                  if [active[i]['value'] for i in by_tag[tag]] != [edits[tag]]]
+    keep = set(active) - set(delete)
+    add = [(value, tag) for tag, value in edits.items()
+           if not any(active[id]['tag'] == tag and active[id]['value'] == value for id in keep)]
+    return delete, add
+
+
+class RuleManager:
+    def __init__(self, stream, reply, window=0.5):
+        """
+        Applies the rule edits of all the dashboards. The edits arriving within 'window' seconds of each other are
+        merged (the last edit of a tag wins), diffed against the cached active rules, and applied with at most one
+        delete and one add call. Only the changed rules are sent to the dashboards of the stream's workspace.
+        :param stream: The LiveStream, whose rules are managed
+        :param reply: Coroutine function replying to a command message, see IngestController.reply
+        :param window: Seconds to collect edits for
+        """
+        self.stream = stream
+        self.reply = reply
+        self.window = window
+        self.active = dict()        # id -> {'value', 'tag'}, the rules active on twitter
+        self.edits = dict()         # tag -> value
+        self.clear = False
+        self.messages = list()      # The commands waiting for the edits to be applied
+        self.pending = None
+        self.lock = asyncio.Lock()
+
+    async def load(self):
+        """ Gets the active rules from twitter into the cache, and sends them all to the dashboards """
+        rules = await self.stream.update_rules_from_twitter()
+        self.active = {str(rule.id): {'value': rule.value, 'tag': rule.tag} for rule in rules}
+
+    async def submit(self, message):
+        """
+        Adds the edits of a 'rulelist' or 'deleterules' command, to be applied at the end of the window.
+        Rules with an empty value are left as they are.
+        :param message: The command message
+        """
+        if message['command'] == 'deleterules':
+            self.clear = True
+            self.edits = dict()
+        else:
+            for rule in message['rules']:
+                if rule['value']:
+                    self.edits[rule['tag']] = rule['value']
+        self.messages.append(message)
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        async with self.lock:
+            # Edits submitted from here on wait for the next window
+            edits, clear, messages = self.edits, self.clear, self.messages
+            self.edits, self.clear, self.messages, self.pending = dict(), False, list(), None
+            try:
+                await self.apply(edits, clear, messages)
+            except Exception as e:
+                print(f'Failed to apply the rules: {e!r}')
+                for message in messages:
+                    await self.reply(message, f'Command failed: {e}', type='rulestatus')
+
+    async def apply(self, edits, clear, messages):
+        """
+        Applies the diff of the merged edits, stores it, and sends the changed rules to the dashboards.
+        A deleted rule is sent with an empty filter.
+        :param edits: Dictionary of tag -> value
+        :param clear: Whether all rules are deleted first
+        :param messages: The commands the edits came from, replied to with any errors
+        """
+        delete, add = rule_diff(self.active, edits, clear)
+        print(f'Rules: deleting {len(delete)}, adding {len(add)}')
+        deleted = {id: self.active[id] for id in delete}
+        if delete:
+            await self.stream.delete_rules(delete)
+            for id in delete:
+                del self.active[id]
+        added = list()
+        errors = list()
+        if add:
+            response = await self.stream.add_rules([StreamRule(value=value, tag=tag) for value, tag in add])
+            for rule in response.data or []:
+                self.active[str(rule.id)] = {'value': rule.value, 'tag': rule.tag}
+                added.append({'id': str(rule.id), 'value': rule.value, 'tag': rule.tag})
+            errors = [error.get('title', 'Error') + ': ' + str(error.get('value', '')) for error in response.errors]
+        workspace = self.stream.workspace
+        await sync_to_async(save_rule_diff)(list(deleted), added, workspace.name)
+
+        channel_layer = get_channel_layer()
+        readded = {rule['tag'] for rule in added}
+        for id, rule in deleted.items():
+            if rule['tag'] not in readded:
+                await channel_layer.group_send(workspace.group, {"type": "rule", "id": id, "filters": '',
+                                                                 "tag": str(rule['tag'])})
+        for rule in added:
+            await channel_layer.group_send(workspace.group, {"type": "rule", "id": rule['id'],
+                                                             "filters": rule['value'], "tag": str(rule['tag'])})
+        await workspace.snapshot.publish('rules', [{'id': id, 'filter': rule['value'], 'tag': str(rule['tag'])}
+                                                   for id, rule in self.active.items()])
+        for message in messages:
+            if errors:
+                await self.reply(message, 'Rule errors: ' + '; '.join(errors), type='rulestatus')
+            elif not self.active:
+                await self.reply(message, 'No rules stored in stream', type='rulestatus')
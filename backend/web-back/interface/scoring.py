@@ -0,0 +1,143 @@
+import numpy as np
+
+from .models import Tweet, TweetMetrics
+
+
+""" Engagement scoring of the tracked tweets, computed for all of them at once with NumPy """
+INTERVALS = {'30': 30, '60': 60, '180': 180}    # How many seconds back each interval compares against
+DEPTH = 8                                       # The number of updates loaded for each tweet
+
+
+def load_engagement(tweetids, depth=DEPTH):
+    """
+    Loads the stored metrics of the tracked tweets into matrices with one row per tweet and one column per update,
+    the most recent update first. Tweets with fewer updates are padded with NaN.
+    :param tweetids: The tweetids that are being tracked
+    :param depth: The number of updates to keep for each tweet
+    :return: Array of tweetids, matrix of summed engagement and matrix of update times (unix timestamps)
+    """
+    rows = list(TweetMetrics.objects.filter(tweetid__in=tweetids).order_by('tweetid', '-time').values_list(
+        'tweetid', 'time', 'retweet_count', 'reply_count', 'like_count', 'quote_count'))
+    if not rows:
+        return np.array([], dtype=object), np.empty((0, depth)), np.empty((0, depth))
+    ids, times, retweets, replies, likes, quotes = zip(*rows)
+    total = (np.array(retweets, dtype=float) + np.array(replies, dtype=float) + np.array(likes, dtype=float) +
+             np.array(quotes, dtype=float))
+    times = np.array([time.timestamp() for time in times])
+    # The rows are grouped by tweet, newest first, so the rank of an update is its offset in the group
+    unique, first, inverse = np.unique(np.array(ids, dtype=object), return_index=True, return_inverse=True)
+    rank = np.arange(len(rows)) - first[inverse]
+    keep = rank < depth
+    values = np.full((len(unique), depth), np.nan)
+    stamps = np.full((len(unique), depth), np.nan)
+    values[inverse[keep], rank[keep]] = total[keep]
+    stamps[inverse[keep], rank[keep]] = times[keep]
+    return unique, values, stamps
+
+
+def zscore(x):
+    """
+    Standardizes an array against its own mean and standard deviation. NaN entries are ignored and returned as 0.
+    """
+    valid = ~np.isnan(x)
+    if not valid.any():
+        return np.zeros_like(x)
+    std = x[valid].std()
+    z = np.zeros_like(x) if std == 0 else (x - x[valid].mean()) / std
+    return np.where(valid, z, 0.0)
+
+
+def engagement_scores(values, stamps, created, now):
+    """
+    Computes the engagement statistics of every tracked tweet in one pass over the matrices:
+    'velocity': engagements per minute since the previous update
+    'acceleration': change in velocity per minute, from the two previous updates
+    'rate': engagements per minute over the whole age of the tweet
+    'trending': the sum of the z-scores (against the other tracked tweets) of the log velocity, the log positive
+    acceleration and the log of the velocity over the rate. A tweet from a big account gets its usual high rate,
+    while a breakout has a velocity far above its own rate.
+    :param values: Matrix of summed engagement, from load_engagement
+    :param stamps: Matrix of update times, from load_engagement
+    :param created: Array of the creation times of the tweets (unix timestamps)
+    :param now: Unix timestamp of the latest update
+    :return: Dictionary of arrays, NaN where a tweet has too few updates
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        minutes = (stamps[:, :-1] - stamps[:, 1:]) / 60
+        speed = (values[:, :-1] - values[:, 1:]) / minutes
+        velocity = speed[:, 0]
+        acceleration = (speed[:, 0] - speed[:, 1]) / ((stamps[:, 0] - stamps[:, 2]) / 120)
+        age = np.maximum((now - created) / 60, 1)
+        rate = values[:, 0] / age
+        positive = np.maximum(velocity, 0)
+        trending = (zscore(np.log1p(positive)) + zscore(np.log1p(np.maximum(acceleration, 0))) +
+                    zscore(np.log((positive + 1) / (rate + 1))))
+    return {
+        'velocity': velocity,
+        'acceleration': acceleration,
+        'rate': rate,
+        'trending': np.where(np.isnan(velocity), np.nan, trending),
+    }
+
+
+def sample_back(values, stamps, seconds):
+    """
+    Gets for every tweet its engagement at the update nearest 'seconds' before its latest update. The updates are
+    picked by time rather than by position, since the engagement tracker stretches its ticks when the quota runs low.
+    :param values: Matrix of summed engagement, from load_engagement
+    :param stamps: Matrix of update times, from load_engagement
+    :param seconds: How far back to look
+    :return: Array of the engagement, NaN where no update is within half of 'seconds' of that time
+    """
+    if values.shape[1] < 2:
+        return np.full(len(values), np.nan)
+    with np.errstate(invalid='ignore'):
+        distance = np.abs(stamps[:, 1:] - (stamps[:, :1] - seconds))
+    distance = np.where(np.isnan(distance), np.inf, distance)
+    nearest = distance.argmin(axis=1)
+    rows = np.arange(len(values))
+    return np.where(distance[rows, nearest] <= seconds / 2, values[rows, nearest + 1], np.nan)
+
+
+def top(ids, scores, n, key='count', **extra):
+    """
+    Gets the tweets with the highest positive scores.
+    :param ids: Array of tweetids
+    :param scores: Array of scores, NaN for tweets without a score
+    :param n: The number of tweets to return
+    :param key: The name the score is given in the results
+    :param extra: Arrays of additional values to include, keyed by name
+    :return: List of dictionaries with the 'id' and score of the tweets, highest first
+    """
+    scores = np.where(np.isnan(scores), 0, scores)
+    if len(scores) > n:         # Only the n best are sorted
+        best = np.argpartition(-scores, n)[:n]
+        best = best[np.argsort(-scores[best], kind='stable')]
+    else:
+        best = np.argsort(-scores, kind='stable')
+    return [dict({'id': ids[i], key: round(float(scores[i]), 3)},
+                 **{k: round(float(v[i]), 3) for k, v in extra.items()}) for i in best if scores[i] > 0]
+
+
+def rank_engagement(timestamp, tweetids, n=5):
+    """
+    Ranks the tracked tweets by the engagement gained over each interval, from the update nearest that long ago (see
+    sample_back), and by the trending score. Tweets deleted or archived since their metrics were loaded are skipped.
+    :param timestamp: datetime object of the latest update
+    :param tweetids: The tweetids that are being tracked
+    :param n: The number of tweets in each list
+    :return: Dictionary of lists for each interval and for 'trending'
+    """
+    ids, values, stamps = load_engagement(tweetids)
+    created = dict(Tweet.objects.filter(id__in=list(ids)).values_list('id', 'created_at'))
+    known = np.array([created.get(i) is not None for i in ids], dtype=bool)
+    ids, values, stamps = ids[known], values[known], stamps[known]
+    created = np.array([created[i].timestamp() for i in ids])
+    res = dict()
+    for interval, seconds in INTERVALS.items():
+        gained = values[:, 0] - sample_back(values, stamps, seconds)
+        res[interval] = [dict(r, count=int(r['count'])) for r in top(ids, gained, n)]
+    scores = engagement_scores(values, stamps, created, timestamp.timestamp())
+    res['trending'] = top(ids, scores['trending'], n, key='score', velocity=scores['velocity'],
+                          acceleration=np.nan_to_num(scores['acceleration']), rate=scores['rate'])
+    return res
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+""" Last-known dashboard state, written by the producers and read by the REST endpoints """
+SNAPSHOT_KEYS = ('rules', 'hmc', 'tweetmetrics', 'tweets', 'status', 'trending', 'clusters')
+KEY_PREFIX = 'livetweets:snapshot:'
+
+
+def snapshot_setting(name, default=None):
+    """
+    Reads a value from the SNAPSHOT dictionary in the settings.
+    :param name: The name of the setting
+    :param default: Value returned if the setting is missing
+    :return: The value of the setting
+    """
+    return getattr(settings, 'SNAPSHOT', {}).get(name, default)
+
+
+def encode_entry(data):
+    """
+    Serializes a snapshot and computes its ETag, so that readers can serve the stored bytes as they are.
+    :param data: JSON serializable data
+    :return: Tuple of the serialized body and the (quoted) ETag
+    """
+    body = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    return body, etag
+
+
+class SnapshotStore:
+    def __init__(self, prefix=KEY_PREFIX):
+        """
+        The snapshot is stored in Redis when a host is configured, so that every worker serves the same state.
+        Without a host it is kept in this process only, which is enough for development and tests.
+        :param prefix: Prefix of the Redis keys, each workspace has its own (see workspaces.Workspace)
+        """
+        self.prefix = prefix
+        self.local = dict()
+        self.recent_tweets = deque(maxlen=snapshot_setting('RECENT_TWEETS', 20))
+        self.client = None
+        self.loop = None
+
+    def get_client(self):
+        """
+        Returns a Redis client bound to the running event loop, or None if no host is configured.
+        The client is recreated if the loop has changed, e.g. between management command runs.
+        """
+        host = snapshot_setting('HOST')
+        if host is None:
+            return None
+        loop = asyncio.get_event_loop()
+        if self.client is None or self.loop is not loop:
+            import redis.asyncio as redis
+            self.client = redis.Redis(host=host[0], port=host[1])
+            self.loop = loop
+        return self.client
+
+    async def publish(self, name, data):
+        """
+        Stores the latest state for a snapshot key.
+        :param name: One of SNAPSHOT_KEYS
+        :param data: JSON serializable data
+        """
+        body, etag = encode_entry(data)
+        entry = {'body': body, 'etag': etag, 'updated': str(time.time())}
+        client = self.get_client()
+        if client is None:
+            self.local[name] = entry
+            return
+        await client.hset(self.prefix + name, mapping=entry)
+
+    async def push_tweet(self, tweet):
+        """
+        Adds a tweet to the list of recent tweets and publishes the list, newest first.
+        :param tweet: Dictionary of the tweet as sent in the 'tweet' event
+        """
+        self.recent_tweets.appendleft(tweet)
+        await self.publish('tweets', list(self.recent_tweets))
+
+    async def get(self, name):
+        """
+        Gets the stored entry for a snapshot key.
+        :param name: One of SNAPSHOT_KEYS
+        :return: Tuple of the serialized body, the ETag and the unix time it was published at, or (None, None, None)
+        if nothing is stored yet
+        """
+        client = self.get_client()
+        if client is None:
+            entry = self.local.get(name)
+            if entry is None:
+                return None, None, None
+            return entry['body'], entry['etag'], float(entry['updated'])
+        body, etag, updated = await client.hmget(self.prefix + name, 'body', 'etag', 'updated')
+        if body is None:
+            return None, None, None
+        return body, etag.decode(), float(updated)
+
+    async def get_frame(self):
+        """
+        Builds a single websocket message holding every snapshot key, fetched in one round-trip.
+        The stored bodies are already serialized, so they are spliced into the message without being decoded.
+        :return: The message as a string, with 'type' set to 'snapshot'. Keys with nothing stored are null.
+        """
+        client = self.get_client()
+        if client is None:
+            bodies = [self.local[name]['body'] if name in self.local else None for name in SNAPSHOT_KEYS]
+        else:
+            pipe = client.pipeline(transaction=False)
+            for name in SNAPSHOT_KEYS:
+                pipe.hget(self.prefix + name, 'body')
+            bodies = await pipe.execute()
+        parts = ['"type":"snapshot"']
+        for name, body in zip(SNAPSHOT_KEYS, bodies):
+            parts.append('"%s":%s' % (name, body.decode() if body is not None else 'null'))
+        return '{%s}' % ','.join(parts)
+
+    def state(self):
+        """
+        :return: The state to checkpoint: the recent tweets, and the entries kept in this process (without a Redis host,
+        whose entries outlive the worker anyway)
+        """
+        return {'recent_tweets': list(self.recent_tweets),
+                'entries': {name: entry['body'].decode() for name, entry in self.local.items()}}
+
+    async def restore(self, state):
+        """
+        Restores a checkpointed state, so the next tweet is added to the recent tweets instead of replacing them.
+        :param state: Dictionary from state()
+        """
+        self.recent_tweets.extend(state['recent_tweets'][:self.recent_tweets.maxlen - len(self.recent_tweets)])
+        if self.get_client() is None:
+            for name, body in state['entries'].items():
+                if name not in self.local:
+                    await self.publish(name, json.loads(body))
+
+
+SNAPSHOT = SnapshotStore()
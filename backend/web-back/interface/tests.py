@@ -1,3 +1,1207 @@
-from django.test import TestCase
+import asyncio
+import csv
+import io
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import warnings
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from tweepy import StreamRule, Tweet as TweepyTweet, User as TweepyUser
+
+from .archive import archive_tweets, read_archive
+from .authors import AuthorMetricsCollector, save_user_metrics
+from .cards import CARDS, build_card
+from .checkpoint import CheckpointStore, decode_checkpoint, encode_checkpoint
+from .consumers import TweetConsumer
+from .cube import RESOLUTIONS, query_cube, roll_up, save_cube
+from .cooccurrence import CooccurrenceGraph, purge_cooccurrence, save_cooccurrence, stored_neighbours
+from .dedup import DuplicateIndex
+from .export import EXPORTS, export_chunks
+from .fakeapi import FakeTwitterApi
+from .geo import GeoCounter, query_geo, save_geo, tweet_point
+from .importer import TweetImporter, parse_lines
+from .ingest import STREAM_PROFILES, IngestController, StreamController
+from .jobs import JOBS, Job, JobScheduler
+from .layers import HybridChannelLayer
+from .livetweets import add_includes_to_db, save_metrics, store_tweet
+from .loadtest import PRECISION, LatencyHistogram
+from .management.commands.ingest import Command as IngestCommand
+from .monitor import MONITOR, LoopMonitor, sample_profile
+from .models import (Cooccurrence, GeoCube, Hashtag, Mention, Place, ReferencedTweet, StreamRules, TrackedTweet, Tweet,
+                     TweetMetrics, UserMetrics)
+from .ratelimit import METRICS, RULES, ApiScheduler, ScheduledClient, limit_key
+from .records import parse_response
+from .routers import ReplicaRouter, last_write, measured_lag, primary_reads, replica_reads
+from .routing import websocket_urlpatterns
+from .rules import RuleManager, rule_diff
+from .scoring import engagement_scores, rank_engagement, sample_back, top
+from .snapshot import SNAPSHOT_KEYS
+from .trending import CountMinSketch, SpaceSaving, TrendingEngine
+from .views import etag_matches
+from .workspaces import DEFAULT_WORKSPACE, WORKSPACES, get_workspace
+
+
+class EtagTests(SimpleTestCase):
+    def test_matches_any_etag_of_the_list(self):
+        self.assertTrue(etag_matches('"a", "b"', '"b"'))
+        self.assertFalse(etag_matches('"ab"', '"b"'))
+        self.assertFalse(etag_matches('', '"b"'))
+
+    def test_weak_and_wildcard(self):
+        self.assertTrue(etag_matches('W/"b"', '"b"'))
+        self.assertTrue(etag_matches('*', '"b"'))
+
+
+class SketchTests(SimpleTestCase):
+    def test_count_min_never_underestimates(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        for i in range(500):
+            sketch.add(f'item{i % 50}')
+        for i in range(50):
+            self.assertGreaterEqual(sketch.estimate(f'item{i}'), 10)
+        self.assertEqual(CountMinSketch(64, 4).estimate('missing'), 0)
+
+    def test_count_min_merge_adds_counts(self):
+        first, second = CountMinSketch(256, 4), CountMinSketch(256, 4)
+        first.add('tag', 3)
+        second.add('tag', 4)
+        first.merge(second)
+        self.assertEqual(first.estimate('tag'), 7)
+        with self.assertRaises(ValueError):
+            first.merge(CountMinSketch(128, 4))
+
+    def test_space_saving_keeps_heavy_hitters(self):
+        summary = SpaceSaving(capacity=5)
+        for i in range(100):
+            summary.add('heavy')
+            summary.add(f'rare{i}')
+        self.assertEqual(len(summary.counts), 5)
+        self.assertEqual(summary.top(1)[0][0], 'heavy')
+        self.assertGreaterEqual(summary.top(1)[0][1], 100)
+
+    def test_space_saving_merge_keeps_capacity(self):
+        first, second = SpaceSaving(capacity=3), SpaceSaving(capacity=3)
+        for item, count in (('a', 5), ('b', 4), ('c', 1)):
+            first.add(item, count)
+        for item, count in (('a', 2), ('d', 6), ('e', 3)):
+            second.add(item, count)
+        first.merge(second)
+        # The items missing from a full summary are counted as its smallest counter: 1 for 'd', 2 for 'b'
+        self.assertEqual(first.top(3), [('a', 7), ('d', 7), ('b', 6)])
+
+        streams = [[f'i{(i * i + offset) % 13}' for i in range(200)] for offset in (0, 5)]
+        first, second = SpaceSaving(capacity=4), SpaceSaving(capacity=4)
+        for summary, stream in zip((first, second), streams):
+            for item in stream:
+                summary.add(item)
+        first.merge(second)
+        true = Counter(streams[0] + streams[1])
+        self.assertEqual(len(first.counts), 4)
+        for item, count in first.counts.items():
+            self.assertGreaterEqual(count, true[item])
+
+    def test_trending_engine_round_trip(self):
+        engine = TrendingEngine(width=64, depth=2, capacity=10)
+        for i in range(30):
+            engine.add_tweet({'entities': {'hashtags': [{'tag': f'h{i % 3}'}]}}, now=1200 + i)
+        restored = TrendingEngine.from_bytes(engine.to_bytes())
+        self.assertEqual(restored.results(now=1230), engine.results(now=1230))
+        self.assertEqual(engine.top('hashtags', 1, now=1230)[0][1], 10)
+
+
+IN_MEMORY_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+def make_tweet(id, **fields):
+    """ Creates a Tweet with placeholder values for the fields a test does not care about """
+    values = dict(text='', author_id='1', conversation_id=id, created_at=datetime(2026, 1, 1, tzinfo=dt_timezone.utc),
+                  in_reply_to_user_id='', lang='en', possibly_sensitive=False, reply_settings='everyone', source='')
+    values.update(fields)
+    return Tweet.objects.create(id=id, **values)
+
+
+def tagged(*tags, mentions=()):
+    return {'entities': {'hashtags': [{'tag': tag} for tag in tags],
+                         'mentions': [{'username': username} for username in mentions]}}
+
+
+class CooccurrenceTests(TestCase):
+    def test_neighbours(self):
+        graph = CooccurrenceGraph(bucket_seconds=300, window=12, min_weight=1)
+        for _ in range(3):
+            graph.add_tweet(tagged('x', 'y'), now=3000)
+        graph.add_tweet(tagged('x', mentions=['bob']), now=3000)
+        self.assertEqual(graph.neighbours('#x', now=3000), [('#y', 3), ('@bob', 1)])
+        self.assertEqual(graph.neighbours('#y', now=3000), [('#x', 3)])
+        self.assertEqual(graph.neighbours('#x', now=3000 + 3600), [])
+
+    def test_closed_buckets_are_queued_and_light_edges_pruned(self):
+        graph = CooccurrenceGraph(bucket_seconds=300, window=12, min_weight=2)
+        graph.add_tweet(tagged('x', 'y'), now=3000)
+        graph.add_tweet(tagged('x', 'y'), now=3000)
+        graph.add_tweet(tagged('a', 'b'), now=3000)
+        graph.add_tweet(tagged('x', 'z'), now=3300)
+        self.assertEqual(sorted(graph.pop_pending()), [(10, '#a', '#b', 1), (10, '#x', '#y', 2)])
+        self.assertNotIn('#a', graph.adjacency)
+        self.assertEqual(graph.neighbours('#x', now=3300), [('#y', 2), ('#z', 1)])
+
+    def test_state_round_trip(self):
+        graph = CooccurrenceGraph(min_weight=1)
+        graph.add_tweet(tagged('x', 'y', 'z'), now=3000)
+        restored = CooccurrenceGraph(min_weight=1)
+        restored.restore(graph.state())
+        self.assertEqual(restored.neighbours('#x', now=3000), graph.neighbours('#x', now=3000))
+        restored.adjacency['#x']['#y'][10] += 1         # The two directions of an edge still share their buckets
+        self.assertEqual(restored.adjacency['#y']['#x'][10], 2)
+
+    def test_stored_neighbours_and_retention(self):
+        now = datetime(2026, 1, 31, tzinfo=dt_timezone.utc)
+        bucket = int(now.timestamp()) // 300
+        save_cooccurrence([(bucket, '#x', '#y', 4), (bucket, '#a', '#x', 2)], 300, DEFAULT_WORKSPACE)
+        save_cooccurrence([(bucket, '#x', '#z', 9)], 300, 'other')
+        Cooccurrence.objects.create(source='#x', target='#y', time=now - timedelta(days=40), weight=7)
+        self.assertEqual(stored_neighbours(DEFAULT_WORKSPACE, '#x', now - timedelta(hours=1)), [('#y', 4), ('#a', 2)])
+        purge_cooccurrence(now)
+        self.assertEqual(Cooccurrence.objects.count(), 3)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+    def test_neighbours_command(self):
+        graph = get_workspace(DEFAULT_WORKSPACE).cooccurrence
+        self.addCleanup(graph.restore, graph.state())
+        graph.add_tweet(tagged('cmd', 'other'))
+        graph.add_tweet(tagged('cmd', 'other'))
+
+        async def ask():
+            channel_layer = get_channel_layer()
+            reply_channel = await channel_layer.new_channel()
+            await IngestController().handle({'command': 'neighbours', 'node': '#cmd', 'reply_channel': reply_channel})
+            return await channel_layer.receive(reply_channel)
+
+        self.assertEqual(async_to_sync(ask)()['neighbours'], [('#other', 2)])
+
+
+class ScoringTests(TestCase):
+    def setUp(self):
+        self.now = datetime(2026, 1, 1, 12, tzinfo=dt_timezone.utc)
+        for tweetid, gains in (('1', (0, 5, 10, 20, 40, 60, 80)), ('2', (0, 1, 2, 3, 4, 5, 6))):
+            make_tweet(tweetid, created_at=self.now - timedelta(hours=1))
+            for update, total in enumerate(gains):
+                TweetMetrics.objects.create(tweetid_id=tweetid, time=self.now - timedelta(seconds=30 * (6 - update)),
+                                            retweet_count=0, reply_count=0, like_count=total, quote_count=0)
+
+    def test_rank_engagement(self):
+        results = rank_engagement(self.now, ['1', '2'])
+        self.assertEqual(results['30'], [{'id': '1', 'count': 20}, {'id': '2', 'count': 1}])
+        self.assertEqual(results['180'], [{'id': '1', 'count': 80}, {'id': '2', 'count': 6}])
+        self.assertEqual(results['trending'][0]['id'], '1')
+
+    def test_skips_tweets_deleted_since_loading(self):
+        from . import scoring
+        loaded = scoring.load_engagement(['1', '2'])
+        Tweet.objects.filter(id='2').delete()
+        with mock.patch.object(scoring, 'load_engagement', return_value=loaded):
+            results = rank_engagement(self.now, ['1', '2'])
+        self.assertEqual([result['id'] for result in results['30']], ['1'])
+
+    def test_save_metrics_is_one_insert(self):
+        make_tweet('3')
+        tweets = [TweepyTweet({'id': tweetid, 'text': '', 'edit_history_tweet_ids': [tweetid], 'public_metrics': {
+            'retweet_count': 1, 'reply_count': 2, 'like_count': likes, 'quote_count': 3}})
+            for tweetid, likes in (('1', 100), ('3', 7), ('4', 9))]     # '4' is not stored
+        with CaptureQueriesContext(connections['default']) as queries:
+            save_metrics(tweets, self.now + timedelta(seconds=30))
+        self.assertEqual(len(queries), 2)                   # The stored ids, then the insert
+        self.assertEqual(list(TweetMetrics.objects.filter(time=self.now + timedelta(seconds=30)).order_by(
+            'tweetid').values_list('tweetid', 'like_count', 'quote_count')), [('1', 100, 3), ('3', 7, 3)])
+        self.assertEqual(rank_engagement(self.now + timedelta(seconds=30), ['1', '2', '3'])['30'][0],
+                         {'id': '1', 'count': 26})
+
+
+class ScoringSpeedTests(SimpleTestCase):
+    def test_scores_50k_tweets(self):
+        """ Scoring and ranking 50k tracked tweets takes about 10-15 ms, a slow machine is allowed 0.2 s """
+        count = 50000
+        values = np.sort(np.random.RandomState(1).randint(0, 1000, (count, 8)), axis=1)[:, ::-1].astype(float)
+        stamps = 1e6 - np.arange(8) * 30 + np.zeros((count, 1))
+        ids = np.arange(count).astype(str).astype(object)
+        start = time.perf_counter()
+        scores = engagement_scores(values, stamps, np.full(count, 1e6 - 3600), 1e6)
+        best = top(ids, scores['trending'], 5)
+        self.assertLess(time.perf_counter() - start, 0.2)
+        self.assertEqual(len(best), 5)
+        self.assertEqual(best, sorted(best, key=lambda r: -r['count']))
+
+
+class SampleBackTests(SimpleTestCase):
+    def test_picks_updates_by_time(self):
+        """ With the ticks stretched to 60 seconds the 180 seconds interval is 3 updates back, not 6 """
+        values = np.array([[60.0, 40, 30, 20, 10, 0, np.nan, np.nan]])
+        stamps = 1e6 - np.array([[0.0, 60, 120, 180, 240, 300, np.nan, np.nan]])
+        self.assertEqual(sample_back(values, stamps, 180)[0], 20)
+        self.assertEqual(sample_back(values, stamps, 60)[0], 40)
+        self.assertTrue(np.isnan(sample_back(values, stamps, 30)[0]))     # No update within 15 seconds of it
+
+    def test_missing_updates(self):
+        values = np.array([[5.0, np.nan], [5.0, 1.0]])
+        stamps = np.array([[100.0, np.nan], [100.0, 70.0]])
+        np.testing.assert_array_equal(sample_back(values, stamps, 30), [np.nan, 1.0])
+
+
+class FakeApiTests(SimpleTestCase):
+    def run_against_fake_api(self, api, calls):
+        """ Serves the fake API, and runs calls(url, scheduler) with a scheduler of its own """
+        async def run():
+            runner, url = await api.start()
+            scheduler = ApiScheduler()
+            try:
+                with override_settings(RATELIMIT={'API_URL': url}):
+                    return await calls(url, scheduler)
+            finally:
+                await scheduler.close()
+                await runner.cleanup()
+        return async_to_sync(run)()
+
+    def test_scheduler_follows_the_rate_limit_headers(self):
+        api = FakeTwitterApi(limits={'GET /2/tweets': 2}, window=1)
+
+        async def calls(url, scheduler):
+            client = ScheduledClient('token', priority=METRICS)
+            client.scheduler = scheduler
+            responses = [await client.get_tweets(['1', '2'], tweet_fields=['public_metrics']) for _ in range(3)]
+            return responses, scheduler.limits[limit_key('GET /2/tweets', 'token')]
+
+        responses, limit = self.run_against_fake_api(api, calls)
+        self.assertEqual([tweet.id for tweet in responses[-1].data], [1, 2])
+        self.assertEqual(limit.limit, 2)
+        # The third call waited for the window to reset instead of being answered with 429
+        self.assertEqual(api.calls['GET /2/tweets'], 3)
+        self.assertEqual(api.rejected['GET /2/tweets'], 0)
+
+    def test_rate_limited_call_is_retried_after_the_reset(self):
+        api = FakeTwitterApi(limits={'GET /2/users': 1}, window=1)
+        api.rate_limit('GET /2/users')          # Another client used up the window
+
+        async def calls(url, scheduler):
+            client = ScheduledClient('token', priority=METRICS)
+            client.scheduler = scheduler
+            return await client.get_users(ids=['7'], user_fields=['public_metrics'])
+
+        response = self.run_against_fake_api(api, calls)
+        self.assertEqual(response.data[0].username, 'user7')
+        self.assertEqual(api.rejected['GET /2/users'], 1)
+
+    def test_rules_go_before_metric_polls(self):
+        order = list()
+
+        class Response:
+            headers = {}
+
+        async def request(name, release=None):
+            if release is not None:
+                await release.wait()
+            order.append(name)
+            return Response()
+
+        async def run():
+            scheduler = ApiScheduler(concurrency=1)
+            release = asyncio.Event()
+            first = asyncio.ensure_future(scheduler.call('GET /2/tweets', METRICS, request, 'first', release))
+            while not scheduler.running:
+                await asyncio.sleep(0)
+            queued = [asyncio.ensure_future(scheduler.call('GET /2/tweets', METRICS + 1, request, 'cold')),
+                      asyncio.ensure_future(scheduler.call('GET /2/tweets', METRICS, request, 'hot')),
+                      asyncio.ensure_future(scheduler.call('POST /2/tweets/search/stream/rules', RULES, request,
+                                                           'rules'))]
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(first, *queued)
+            await scheduler.close()
+
+        async_to_sync(run)()
+        self.assertEqual(order, ['first', 'rules', 'hot', 'cold'])
+
+
+class RuleDiffTests(SimpleTestCase):
+    active = {'1': {'value': '#a', 'tag': 'a'}, '2': {'value': '#b', 'tag': 'b'}}
+
+    def test_unchanged_rules_are_kept(self):
+        self.assertEqual(rule_diff(self.active, {'a': '#a'}), ([], []))
+
+    def test_edit_replaces_the_rules_of_its_tag(self):
+        self.assertEqual(rule_diff(self.active, {'a': '#c', 'd': '#d'}), (['1'], [('#c', 'a'), ('#d', 'd')]))
+
+    def test_duplicate_rules_of_a_tag_are_merged(self):
+        active = dict(self.active, **{'3': {'value': '#a', 'tag': 'a'}})
+        delete, add = rule_diff(active, {'a': '#a'})
+        self.assertEqual((sorted(delete), add), (['1', '3'], [('#a', 'a')]))
+
+    def test_clear(self):
+        delete, add = rule_diff(self.active, {'b': '#b'}, clear=True)
+        self.assertEqual((sorted(delete), add), (['1', '2'], [('#b', 'b')]))
+
+
+class FakeRuleStream:
+    """ Stands in for the LiveStream, recording the rule calls """
+    def __init__(self):
+        self.workspace = get_workspace(DEFAULT_WORKSPACE)
+        self.calls = list()
+        self.ids = iter(range(10, 100))
+
+    async def delete_rules(self, ids):
+        self.calls.append(('delete', sorted(ids)))
+
+    async def add_rules(self, rules):
+        self.calls.append(('add', [(rule.value, rule.tag) for rule in rules]))
+        data = [StreamRule(value=rule.value, tag=rule.tag, id=str(next(self.ids))) for rule in rules]
+        return mock.Mock(data=data, errors=[])
+
+
+class RuleManagerTests(TestCase):
+    def test_edits_within_the_window_are_applied_together(self):
+        stream = FakeRuleStream()
+
+        async def edit():
+            manager = RuleManager(stream, mock.AsyncMock(), window=0.01)
+            manager.active = {'1': {'value': '#a', 'tag': 'a'}}
+            await manager.submit({'command': 'rulelist', 'rules': [{'tag': 'a', 'value': '#b'}]})
+            await manager.submit({'command': 'rulelist', 'rules': [{'tag': 'a', 'value': '#c'},
+                                                                    {'tag': 'd', 'value': ''}]})
+            await manager.pending
+            return manager.active
+
+        active = async_to_sync(edit)()
+        self.assertEqual(stream.calls, [('delete', ['1']), ('add', [('#c', 'a')])])
+        self.assertEqual(active, {'10': {'value': '#c', 'tag': 'a'}})
+        self.assertEqual(set(StreamRules.objects.values_list('id', 'active')), {('10', True)})
+
+
+class CardTests(SimpleTestCase):
+    def test_consumer_caches_the_card_it_sends(self):
+        consumer = TweetConsumer()
+        consumer.workspace = get_workspace(DEFAULT_WORKSPACE)
+        consumer.send = mock.AsyncMock()
+        card = {'id': '42', 'text': 'Hello'}
+        async_to_sync(consumer.tweet)({'type': 'tweet', 'id': '42', 'filters': 'a', 'card': card})
+        self.addCleanup(CARDS.cards.pop, '42', None)
+        self.assertEqual(async_to_sync(CARDS.get)('42'), card)
+        response = self.client.get('/api/card/42')
+        self.assertEqual(response.json(), card)
+
+
+@override_settings(WORKSPACES={DEFAULT_WORKSPACE: {}, 'other': {}})
+class WorkspaceIsolationTests(TestCase):
+    def setUp(self):
+        self.addCleanup(WORKSPACES.pop, 'other', None)
+        self.minute = int(time.time()) // 60 * 60
+
+    def test_aggregators_are_per_workspace(self):
+        default, other = get_workspace(DEFAULT_WORKSPACE), get_workspace('other')
+        for name in ('cube', 'geo', 'cooccurrence', 'cards', 'snapshot', 'trending', 'dedup'):
+            self.assertIsNot(getattr(default, name), getattr(other, name), name)
+        self.assertIs(default.cards, CARDS)
+        self.assertNotEqual(default.cards.key_prefix, other.cards.key_prefix)
+
+    def test_cube_counts_and_api_are_filtered_by_workspace(self):
+        save_cube([(self.minute, 'a', 'en', '', False, 2)], DEFAULT_WORKSPACE)
+        save_cube([(self.minute, 'a', 'en', '', False, 5)], 'other')
+        self.assertEqual([bucket['count'] for bucket in query_cube('other')], [5])
+        self.assertEqual([bucket['count'] for bucket in self.client.get('/api/cube').json()['buckets']], [2])
+        response = self.client.get('/api/cube', {'workspace': 'other'})
+        self.assertEqual([bucket['count'] for bucket in response.json()['buckets']], [5])
+        self.assertEqual(self.client.get('/api/cube', {'workspace': 'missing'}).status_code, 404)
+
+    def test_thread_and_export_are_filtered_by_workspace(self):
+        make_tweet('1')
+        make_tweet('2', conversation_id='1', thread_path='1/2', workspace='other')
+        self.assertEqual([tweet['id'] for tweet in self.client.get('/api/thread/1').json()['tweets']], ['1'])
+        rows = ''.join(export_chunks('tweets', 'csv', workspace='other')).splitlines()
+        self.assertEqual([row.split(',')[0] for row in rows[1:]], ['2'])
+
+
+class JobTests(SimpleTestCase):
+    def test_missed_deadlines_are_skipped(self):
+        job = Job('job', None, 1)
+        job.deadline = 0.0
+        job.advance(3.5)
+        self.assertEqual((job.deadline, job.skipped), (4.0, 3))
+
+    def test_missed_deadlines_are_caught_up(self):
+        job = Job('job', None, 1, catch_up=True)
+        job.deadline = 0.0
+        job.advance(3.5)
+        self.assertEqual((job.deadline, job.skipped), (1.0, 0))
+
+    def run_jobs(self, seconds, *jobs):
+        """ Runs the jobs, as (name, func, interval, options), on a scheduler of their own for 'seconds' """
+        async def run():
+            scheduler = JobScheduler()
+            for name, func, interval, options in jobs:
+                scheduler.add(name, func, interval, **options)
+            await asyncio.sleep(seconds)
+            stats = scheduler.stats()
+            scheduler.stop()
+            return stats
+        return async_to_sync(run)()
+
+    def test_overrunning_job_never_overlaps(self):
+        running = list()
+
+        async def slow(catch_up):
+            running.append(catch_up)
+            await asyncio.sleep(0.1)
+            self.assertEqual(running.count(catch_up), 1)
+            running.remove(catch_up)
+
+        stats = self.run_jobs(0.55, ('skip', slow, 0.04, {'args': (False,)}),
+                              ('catch-up', slow, 0.04, {'args': (True,), 'catch_up': True}))
+        # The skipping job stays on the grid, the catching up one falls behind it
+        self.assertGreater(stats['skip']['skipped'], 0)
+        self.assertLess(stats['skip']['max_lateness'], 0.04)
+        self.assertEqual(stats['catch-up']['skipped'], 0)
+        self.assertGreater(stats['catch-up']['max_lateness'], 0.1)
+        self.assertEqual((stats['skip']['failures'], stats['catch-up']['failures']), (0, 0))
+
+    def test_failures_and_timeouts_do_not_stop_the_job(self):
+        async def fail():
+            raise ValueError('failed')
+
+        async def hang():
+            await asyncio.sleep(1)
+
+        stats = self.run_jobs(0.2, ('fail', fail, 0.05, {}), ('hang', hang, 0.05, {'timeout': 0.02}))
+        self.assertGreater(stats['fail']['failures'], 1)
+        self.assertEqual(stats['fail']['last_error'], "ValueError('failed')")
+        self.assertGreater(stats['hang']['timeouts'], 1)
+
+
+class DuplicateIndexTests(SimpleTestCase):
+    text = 'Breaking: the river has flooded the old town, stay away from the bridge https://t.co/abc'
+
+    def test_copies_join_the_cluster_of_the_first_tweet(self):
+        index = DuplicateIndex(ttl=60)
+        self.assertEqual(index.add('1', self.text, now=0), ('1', False))
+        self.assertEqual(index.add('2', 'RT @news: ' + self.text.replace('abc', 'xyz'), now=1), ('1', True))
+        self.assertEqual(index.add('3', 'Lovely weather for a walk in the park today', now=2), ('3', False))
+        self.assertEqual([(cluster['id'], cluster['size']) for cluster in index.top()], [('1', 2)])
+
+    def test_clusters_expire(self):
+        index = DuplicateIndex(ttl=60)
+        index.add('1', self.text, now=0)
+        self.assertEqual(index.add('2', self.text, now=100), ('2', False))
+
+    def test_round_trip(self):
+        index = DuplicateIndex(ttl=60)
+        index.add('1', self.text, now=0)
+        restored = DuplicateIndex(ttl=60)
+        restored.load(index.to_bytes(), now=1)
+        self.assertEqual(restored.add('2', self.text, now=2), ('1', True))
+
+
+class DuplicateStorageTests(TestCase):
+    def tweet(self, id):
+        return {'id': id, 'text': 'Copy #flood @news', 'author_id': '1', 'conversation_id': id,
+                'created_at': '2026-01-01T00:00:00.000Z', 'lang': 'en', 'possibly_sensitive': False,
+                'reply_settings': 'everyone', 'source': '', 'edit_history_tweet_ids': [id],
+                'entities': {'hashtags': [{'tag': 'flood'}], 'mentions': [{'username': 'news'}]}}
+
+    def test_duplicates_are_linked_but_not_counted(self):
+        store_tweet(self.tweet('1'))
+        store_tweet(self.tweet('2'), cluster_id='1')
+        duplicate = Tweet.objects.get(id='2')
+        self.assertEqual(list(duplicate.hashtags.values_list('hashtag', flat=True)), ['flood'])
+        self.assertEqual(list(duplicate.mentions.values_list('mention', flat=True)), ['news'])
+        self.assertEqual(Hashtag.objects.get().count, 1)
+        self.assertEqual(Mention.objects.get().count, 1)
+        self.assertEqual(list(TrackedTweet.objects.values_list('tweetid', flat=True)), ['1'])
+
+
+class LatencyHistogramTests(SimpleTestCase):
+    def test_percentiles_are_within_the_precision(self):
+        histogram = LatencyHistogram()
+        for _ in range(999):
+            histogram.record(0.001)
+        histogram.record(1)
+        self.assertLessEqual(0.001, histogram.percentile(50))
+        self.assertLess(histogram.percentile(99.9), 0.001 * PRECISION ** 2)     # Not the slow sample's bucket
+        self.assertLessEqual(1, histogram.percentile(100))
+        self.assertLess(histogram.percentile(100), PRECISION ** 2)
+
+    def test_merge_and_empty(self):
+        self.assertIsNone(LatencyHistogram().percentile(99))
+        fast, slow = LatencyHistogram(), LatencyHistogram()
+        fast.record(0.001)
+        slow.record(0.1)
+        merged = LatencyHistogram(fast.counts)
+        merged.merge(slow.counts)
+        self.assertEqual(merged.total(), 2)
+        self.assertLess(merged.percentile(50), 0.002)
+        self.assertLessEqual(0.1, merged.percentile(51))
+
+
+class PolledEndpointTests(SimpleTestCase):
+    def test_collector_is_not_an_engagement_tracker(self):
+        from .authors import AuthorMetricsCollector
+        from .livetweets import EngagementTracker
+        collector = AuthorMetricsCollector('token')
+        self.assertNotIsInstance(collector, EngagementTracker)
+        self.assertFalse(hasattr(collector, 'engagement_update'))
+        self.assertEqual(collector.interval(60), 60)      # No rate limit known yet
+        self.assertEqual(EngagementTracker('token').interval(30), 30)
+
+
+def metric_user(id):
+    return TweepyUser({'id': str(id), 'name': f'User {id}', 'username': f'user{id}', 'public_metrics': {
+        'followers_count': 1, 'following_count': 2, 'tweet_count': 3, 'listed_count': 4}})
+
+
+class FakeUsersClient:
+    """ Answers get_users like the scheduled client, failing the lookups of the ids in 'failing' """
+    lookups = list()
+    failing = set()
+
+    def __init__(self, bearer_token, priority=None):
+        pass
+
+    async def get_users(self, ids, user_fields=None):
+        self.lookups.append(list(ids))
+        if self.failing & set(ids):
+            raise ConnectionError('lookup failed')
+        return mock.Mock(data=[metric_user(id) for id in ids])
+
+
+class AuthorMetricsTests(TestCase):
+    def test_due_forgets_expired_authors(self):
+        collector = AuthorMetricsCollector('token', ttl=900)
+        collector.refreshed = {'1': 100.0, '2': 500.0}
+        with mock.patch('interface.authors.time.monotonic', return_value=1000.0):
+            self.assertEqual(collector.due(['1', '2', '3']), ['1', '3'])
+        self.assertEqual(collector.refreshed, {'2': 500.0})
+
+    def test_collect_batches_lookups_and_keeps_failed_batches_due(self):
+        authors = [str(i) for i in range(1, 251)]
+        collector = AuthorMetricsCollector('token')
+        FakeUsersClient.lookups, FakeUsersClient.failing = [], {'150'}
+        with mock.patch('interface.authors.get_recent_author_ids', return_value=authors), \
+                mock.patch('interface.authors.ScheduledClient', FakeUsersClient):
+            async_to_sync(collector.collect)()
+        self.assertEqual([len(ids) for ids in FakeUsersClient.lookups], [100, 100, 50])
+        self.assertEqual(collector.calls, 3)
+        self.assertEqual(collector.due(authors), authors[100:200])
+        self.assertEqual(UserMetrics.objects.count(), 150)
+
+    def test_save_user_metrics_is_one_insert(self):
+        users = [metric_user(id) for id in range(1, 51)]
+        with CaptureQueriesContext(connections['default']) as queries:
+            save_user_metrics(users, datetime(2026, 1, 1, tzinfo=dt_timezone.utc))
+        inserts = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)                   # The missing users, then the metrics
+        self.assertIn('interface_usermetrics', inserts[1])
+        self.assertEqual(UserMetrics.objects.filter(followers_count=1).count(), 50)
+
+
+def dump_line(id, created_at='2026-01-01T00:00:00.000Z', **fields):
+    return json.dumps(dict(id=id, created_at=created_at, text=f'Tweet {id}', author_id='7', **fields)).encode()
+
+
+class ImporterTests(TestCase):
+    def test_parse_lines(self):
+        response = json.dumps({'data': {'id': '1', 'created_at': '2026-01-01T00:00:00.000Z',
+                                        'entities': {'hashtags': [{'tag': 'x'}]}},
+                               'includes': {'users': [{'id': '7', 'name': 'Bob', 'username': 'bob'}]},
+                               'matching_rules': [{'id': '10', 'tag': 'a'}, {'id': '11', 'tag': 'b'}]}).encode()
+        reply = dump_line('2', conversation_id='1', referenced_tweets=[{'type': 'replied_to', 'id': '1'}])
+        rows = parse_lines([response, reply, b'not json', b'{"id": "3"}', b''], filters_default='dump')
+        self.assertEqual(rows['errors'], 2)
+        self.assertEqual([(tweet['id'], tweet['filters'], tweet['parent']) for tweet in rows['tweets']],
+                         [('1', 'a, b', None), ('2', 'dump', '1')])
+        self.assertEqual(rows['hashtags'], [('1', 'x')])
+        self.assertEqual(rows['references'][0][:3], ('2', '1', 'replied_to'))
+        self.assertEqual(len(rows['tweets'][0]['cube']), 2)       # Counted once for each rule tag
+        self.assertEqual([user['id'] for user in rows['users']], ['7'])
+
+    def test_load_threads_across_chunks_and_skips_stored_tweets(self):
+        importer = TweetImporter(batch_size=2)
+        importer.load(parse_lines([dump_line('1', entities={'hashtags': [{'tag': 'x'}]})]))
+        chunk = parse_lines([dump_line('2', conversation_id='1', referenced_tweets=[{'type': 'replied_to', 'id': '1'}],
+                                       entities={'hashtags': [{'tag': 'x'}, {'tag': 'x'}]}),
+                             dump_line('3', conversation_id='1', referenced_tweets=[{'type': 'replied_to', 'id': '2'}]),
+                             dump_line('1')])
+        importer.load(chunk)
+        importer.load(chunk)
+        importer.finish()
+        self.assertEqual(dict(Tweet.objects.values_list('id', 'thread_path')), {'1': '1', '2': '1/2', '3': '1/2/3'})
+        self.assertEqual((importer.stats['tweets'], importer.stats['skipped']), (3, 4))
+        self.assertEqual(Hashtag.objects.get(hashtag='x').count, 2)
+        self.assertEqual(ReferencedTweet.objects.filter(tweetid='1', type='replied_to').count(), 1)
+
+
+class CubeTests(TestCase):
+    day = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+
+    def setUp(self):
+        minute = int(self.day.timestamp())
+        self.cells = [(minute + 36000, 'a', 'en', '', False, 1), (minute + 36060, 'a', 'en', '', False, 2),
+                      (minute + 36060, 'b', 'fr', '', True, 4), (minute + 41400, 'a', 'en', '', False, 8),
+                      (minute + 86700, 'a', 'en', '', False, 16)]
+
+    def test_roll_up_sums_the_minutes_in_each_bucket(self):
+        counts = roll_up(self.cells, ('tag', 'lang'))
+        hour, next_day = self.day + timedelta(hours=10), self.day + timedelta(days=1)
+        self.assertEqual(counts[(('resolution', 60), ('bucket', hour + timedelta(minutes=1)), ('tag', 'a'),
+                                 ('lang', 'en'))], 2)
+        self.assertEqual(counts[(('resolution', 3600), ('bucket', hour), ('tag', 'a'), ('lang', 'en'))], 3)
+        self.assertEqual(counts[(('resolution', 86400), ('bucket', self.day), ('tag', 'a'), ('lang', 'en'))], 11)
+        self.assertEqual(counts[(('resolution', 86400), ('bucket', next_day), ('tag', 'a'), ('lang', 'en'))], 16)
+        for resolution in RESOLUTIONS:
+            self.assertEqual(sum(count for cell, count in counts.items() if cell[0] == ('resolution', resolution)),
+                             31)
+
+    def test_query_cube_per_resolution(self):
+        save_cube(self.cells, DEFAULT_WORKSPACE)
+        save_cube(self.cells[:1], DEFAULT_WORKSPACE)             # Flushed again, added to the stored cells
+        save_cube(self.cells, 'other')
+        buckets = {resolution: [(cell['bucket'], cell['tag'], cell['count'])
+                                for cell in query_cube(DEFAULT_WORKSPACE, resolution)]
+                   for resolution in RESOLUTIONS}
+        hour = self.day + timedelta(hours=10)
+        self.assertEqual(buckets[60][:3], [(hour, 'a', 2), (hour + timedelta(minutes=1), 'a', 2),
+                                           (hour + timedelta(minutes=1), 'b', 4)])
+        self.assertEqual(buckets[3600], [(hour, 'a', 4), (hour, 'b', 4), (hour + timedelta(hours=1), 'a', 8),
+                                         (self.day + timedelta(days=1), 'a', 16)])
+        self.assertEqual(buckets[86400], [(self.day, 'a', 12), (self.day, 'b', 4),
+                                          (self.day + timedelta(days=1), 'a', 16)])
+        # The start is widened to its bucket, the end is exclusive
+        self.assertEqual(query_cube(DEFAULT_WORKSPACE, 3600, start=hour + timedelta(minutes=30),
+                                    end=self.day + timedelta(days=1), by=(), lang='en'),
+                         [{'bucket': hour, 'count': 4}, {'bucket': hour + timedelta(hours=1), 'count': 8}])
+        self.assertEqual(query_cube(DEFAULT_WORKSPACE, 86400, by=('lang', 'possibly_sensitive'), tag='b'),
+                         [{'bucket': self.day, 'lang': 'fr', 'possibly_sensitive': True, 'count': 4}])
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        for i, filters in enumerate(('a', 'a, b', 'ab', 'b, a', 'a')):
+            make_tweet(f'1{i}', text=f'Tweet, "{i}"\nsecond line', filters=filters)
+
+    def test_ndjson_is_read_in_keyset_chunks(self):
+        with CaptureQueriesContext(connections['default']) as queries:
+            chunks = list(export_chunks('tweets', 'ndjson', chunk_size=2, workspace=DEFAULT_WORKSPACE))
+        self.assertEqual([chunk.count('\n') for chunk in chunks], [2, 2, 1])
+        rows = [json.loads(line) for chunk in chunks for line in chunk.splitlines()]
+        self.assertEqual([row['id'] for row in rows], ['10', '11', '12', '13', '14'])
+        self.assertEqual(rows[0]['text'], 'Tweet, "0"\nsecond line')
+        self.assertEqual(len(queries), 4)                   # One per chunk, and the empty one ending the export
+        self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+
+    def test_csv_chunks_and_tag_filter(self):
+        chunks = list(export_chunks('tweets', 'csv', chunk_size=2, workspace=DEFAULT_WORKSPACE, tag='a'))
+        self.assertEqual(len(chunks), 3)                    # The header, then two chunks of the four tagged 'a'
+        rows = list(csv.reader(io.StringIO(''.join(chunks))))
+        self.assertEqual(rows[0], list(EXPORTS['tweets']))
+        self.assertEqual([(row[0], row[1], row[-1]) for row in rows[1:]],
+                         [('10', 'Tweet, "0"\nsecond line', 'a'), ('11', 'Tweet, "1"\nsecond line', 'a, b'),
+                          ('13', 'Tweet, "3"\nsecond line', 'b, a'), ('14', 'Tweet, "4"\nsecond line', 'a')])
+
+
+class ArchiveTests(TestCase):
+    def test_archives_references_thread_cluster_and_place(self):
+        created = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+        make_tweet('1', created_at=created)
+        make_tweet('2', created_at=created, conversation_id='1', thread_path='1/2', cluster_id='2', place_id='p1')
+        ReferencedTweet.objects.create(tweetid='1', type='replied_to', source_id='2', conversation_id='1',
+                                       created_at=created)
+        ReferencedTweet.objects.create(tweetid='9', type='quoted', source_id='2', conversation_id='1',
+                                       created_at=created)
+        with tempfile.TemporaryDirectory() as path:
+            self.assertEqual(archive_tweets(created + timedelta(days=1), path=path), 2)
+            self.assertFalse(ReferencedTweet.objects.exists())
+            rows = {row['id']: row for row in read_archive(path=path).to_pylist()}
+        self.assertEqual(rows['2']['referenced_tweets'],
+                         [{'type': 'replied_to', 'id': '1'}, {'type': 'quoted', 'id': '9'}])
+        self.assertEqual((rows['2']['thread_path'], rows['2']['cluster_id'], rows['2']['place_id']), ('1/2', '2', 'p1'))
+        self.assertEqual(rows['1']['referenced_tweets'], [])
+        self.assertEqual(rows['1']['workspace'], DEFAULT_WORKSPACE)
+
+    def test_partitions_by_date_and_pushes_filters_down(self):
+        for id, created, lang in (('1', datetime(2026, 1, 1, 10), 'en'), ('2', datetime(2026, 1, 2, 9), 'fr'),
+                                  ('3', datetime(2026, 1, 2, 15), 'en'), ('4', datetime(2026, 1, 3, 8), 'en')):
+            make_tweet(id, created_at=created.replace(tzinfo=dt_timezone.utc), lang=lang)
+        with tempfile.TemporaryDirectory() as path:
+            self.assertEqual(archive_tweets(datetime(2026, 1, 3, tzinfo=dt_timezone.utc), chunk_size=2, path=path), 3)
+            self.assertEqual(list(Tweet.objects.values_list('id', flat=True)), ['4'])
+            self.assertEqual(sorted(os.listdir(path)), ['date=2026-01-01', 'date=2026-01-02'])
+            for name in os.listdir(os.path.join(path, 'date=2026-01-01')):     # Not opened by the reads below
+                with open(os.path.join(path, 'date=2026-01-01', name), 'wb') as file:
+                    file.write(b'not parquet')
+
+            def ids(**filters):
+                return sorted(read_archive(path=path, columns=['id'], **filters).column('id').to_pylist())
+
+            self.assertEqual(ids(start=date(2026, 1, 2)), ['2', '3'])
+            self.assertEqual(ids(start=datetime(2026, 1, 2, 12, tzinfo=dt_timezone.utc)), ['3'])
+            self.assertEqual(ids(start=date(2026, 1, 2), end=datetime(2026, 1, 2, 12, tzinfo=dt_timezone.utc)), ['2'])
+            self.assertEqual(ids(start=date(2026, 1, 2), lang='en'), ['3'])
+            self.assertEqual(read_archive(path=path, start=date(2026, 1, 2), columns=['id']).column_names, ['id'])
+
+
+@replica_reads
+def read_rule_tag():
+    return StreamRules.objects.get(id='1').tag
+
+
+@primary_reads
+def read_rule_tag_pinned():
+    return read_rule_tag()
+
+
+class ReplicaRouterTests(TestCase):
+    """ Two SQLite databases stand for the primary and the replica, holding different versions of a rule """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        replica = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory.name, 'replica.sqlite3')}
+        databases = dict(connections.settings, replica=replica)
+        connections.settings['replica'] = connections.configure_settings({'default': replica, 'replica': replica})[
+            'replica']
+        self.addCleanup(connections.settings.pop, 'replica')
+        self.addCleanup(self.drop_replica)
+        overridden = override_settings(DATABASES=databases, REPLICA={'ALIAS': 'replica', 'READ_AFTER_WRITE': 10})
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')             # Only the router reads the overridden DATABASES
+            overridden.enable()
+        self.addCleanup(overridden.disable)
+        with connections['replica'].schema_editor() as editor:
+            editor.create_model(StreamRules)
+        StreamRules.objects.using('replica').create(id='1', value='#x', tag='replica', active=True)
+        StreamRules.objects.create(id='1', value='#x', tag='primary', active=True)
+        measured_lag.update(time=0.0, lag=None)
+        last_write.set(0.0)
+
+    @staticmethod
+    def drop_replica():
+        connections['replica'].close()
+        del connections['replica']
+
+    def test_replica_reads_go_to_the_replica(self):
+        self.assertEqual(read_rule_tag(), 'replica')
+        self.assertEqual(StreamRules.objects.get(id='1').tag, 'primary')     # Outside a replica_reads helper
+
+    def test_reads_after_a_write_go_to_the_primary(self):
+        StreamRules.objects.filter(id='1').update(active=True)
+        self.assertEqual(read_rule_tag(), 'primary')
+
+    def test_primary_reads_are_pinned(self):
+        self.assertEqual(read_rule_tag_pinned(), 'primary')
+
+    def test_lagging_replica_is_skipped(self):
+        measured_lag.update(time=time.monotonic(), lag=60)
+        self.assertEqual(read_rule_tag(), 'primary')
+        measured_lag.update(time=time.monotonic(), lag=None)
+        self.assertEqual(read_rule_tag(), 'primary')
+
+    def test_no_migrations_on_the_replica(self):
+        self.assertFalse(ReplicaRouter().allow_migrate('replica', 'interface'))
+        self.assertTrue(ReplicaRouter().allow_migrate('default', 'interface'))
+
+
+@skipUnless(fakeredis, 'fakeredis is not installed')
+class HybridChannelLayerTests(SimpleTestCase):
+    """ Each layer stands for a worker, and two fake Redis servers for the shards """
+    def setUp(self):
+        self.hosts = list()
+        for _ in range(2):
+            server = fakeredis.TcpFakeServer(('127.0.0.1', 0))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            self.hosts.append(server.server_address)
+
+    def layer(self):
+        return HybridChannelLayer(hosts=self.hosts)
+
+    def test_group_inbox_and_named_channels_across_workers(self):
+        async def run():
+            first, second = self.layer(), self.layer()
+            try:
+                local, remote = await first.new_channel(), await second.new_channel()
+                await first.group_add('tweet', local)
+                await second.group_add('tweet', remote)
+                await first.group_send('tweet', {'type': 'tweet', 'id': '1'})
+                received = [await asyncio.wait_for(first.receive(local), 2),
+                            await asyncio.wait_for(second.receive(remote), 2)]
+                await first.send(remote, {'type': 'reply'})
+                received.append(await asyncio.wait_for(second.receive(remote), 2))
+                await first.send('ingest', {'type': 'control'})
+                received.append(await asyncio.wait_for(second.receive('ingest'), 2))
+                return received, first.stats()
+            finally:
+                await first.flush()
+                await second.flush()
+
+        received, stats = async_to_sync(run)()
+        self.assertEqual(received, [{'type': 'tweet', 'id': '1'}, {'type': 'tweet', 'id': '1'}, {'type': 'reply'},
+                                    {'type': 'control'}])
+        self.assertEqual((stats['delivered'], stats['published']), (1, 1))
+
+    def test_group_without_other_members_skips_redis_until_one_joins(self):
+        async def run():
+            first, second = self.layer(), self.layer()
+            try:
+                local = await first.new_channel()
+                await first.group_add('tweet', local)
+                for _ in range(2):
+                    await first.group_send('tweet', {'type': 'tweet'})
+                skipped = first.stats().get('skipped', 0)
+                await second.group_add('tweet', await second.new_channel())
+                for _ in range(20):                 # Until the join announcement is read
+                    if 'tweet' not in first.states[asyncio.get_event_loop()].alone:
+                        break
+                    await asyncio.sleep(0.05)
+                await first.group_send('tweet', {'type': 'tweet'})
+                return skipped, first.stats()
+            finally:
+                await first.flush()
+                await second.flush()
+
+        skipped, stats = async_to_sync(run)()
+        self.assertEqual(skipped, 1)
+        self.assertEqual((stats['published'], stats['skipped']), (2, 1))
+
+    def test_states_of_closed_loops_are_evicted(self):
+        layer = self.layer()
+
+        async def deliver():
+            channel = await layer.new_channel()
+            await layer.send(channel, {'type': 'ping'})
+            return await layer.receive(channel)
+
+        for _ in range(3):
+            async_to_sync(deliver)()
+        self.assertLessEqual(len(layer.states), 1)
+        self.assertEqual(layer.stats()['delivered'], 3)
+
+
+class CheckpointTests(SimpleTestCase):
+    def test_encode_decode_round_trip(self):
+        sections = [({'workspace': 'default', 'tracking_since': None}, b'trending', b''),
+                    ({'workspace': 'other', 'snapshot': {'tweets': ['1']}},)]
+        created, decoded = decode_checkpoint(encode_checkpoint(sections, now=1234.5))
+        self.assertEqual((created, decoded), (1234.5, sections))
+        with self.assertRaises(ValueError):
+            decode_checkpoint(b'CKPX' + encode_checkpoint(sections)[4:])
+        with self.assertRaises(ValueError):
+            decode_checkpoint(b'')
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = CheckpointStore(path=os.path.join(directory, 'checkpoint'))
+            self.assertIsNone(asyncio.run(store.load()))
+            asyncio.run(store.save(b'data'))
+            self.assertEqual(asyncio.run(store.load()), b'data')
+            self.assertEqual(os.listdir(directory), ['checkpoint'])
+
+
+class IngestCommandTests(SimpleTestCase):
+    def test_sigterm_cancels_the_controller(self):
+        stopped = list()
+
+        class Controller:
+            async def run(self):
+                try:
+                    await asyncio.sleep(60)
+                finally:
+                    stopped.append(True)
+
+        async def serve():
+            asyncio.get_event_loop().call_later(0.05, os.kill, os.getpid(), signal.SIGTERM)
+            await command.serve(Controller())
+
+        command = IngestCommand(stdout=io.StringIO())
+        asyncio.run(asyncio.wait_for(serve(), 5))
+        self.assertEqual(stopped, [True])
+        self.assertIn('stopped', command.stdout.getvalue())
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+class MonitorTests(TestCase):
+    def test_stall_is_recorded_with_its_handler_and_call(self):
+        monitor = LoopMonitor(interval=0.01, threshold=0.05)
+
+        async def run():
+            monitor.start()
+            await asyncio.sleep(0.05)
+            block_loop(0.3)
+            await asyncio.sleep(0.05)
+            monitor.stop()
+
+        asyncio.run(run())
+        stalls = [stall for stall in monitor.stalls if stall['call'].startswith('block_loop (tests.py:')]
+        self.assertEqual(len(stalls), 1)
+        self.assertGreaterEqual(stalls[0]['duration'], 0.05)
+        self.assertIn('test_stall_is_recorded_with_its_handler_and_call (tests.py:', stalls[0]['handler'])
+        self.assertGreater(monitor.stats()['lag']['max'], 0.05)
+
+    def test_sample_profile_returns_folded_stacks(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=spin, args=(stop,), name='spinner')
+        thread.start()
+        try:
+            folded = sample_profile(0.1, interval=0.01, thread_id=thread.ident)
+        finally:
+            stop.set()
+            thread.join()
+        stack, count = folded.splitlines()[0].rsplit(' ', 1)
+        self.assertTrue(stack.startswith('spinner;'))
+        self.assertIn(';spin (tests.py:', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_views_are_staff_only(self):
+        for path in ('/api/monitor', '/api/profile?seconds=0'):
+            self.assertEqual(self.client.get(path).status_code, 403)
+        self.client.force_login(get_user_model().objects.create_user('viewer', password='x'))
+        for path in ('/api/monitor', '/api/profile?seconds=0'):
+            self.assertEqual(self.client.get(path).status_code, 403)
+
+
+STREAM_LINE = json.dumps({
+    'data': {'id': '20', 'text': 'Hello #x', 'author_id': '7', 'conversation_id': '20', 'lang': 'en',
+             'created_at': '2026-01-01T10:03:00.000Z', 'possibly_sensitive': False,
+             'public_metrics': {'retweet_count': 1, 'reply_count': 0, 'like_count': 2, 'quote_count': 0},
+             'attachments': {'media_keys': ['3_1', '3_missing']}, 'geo': {'place_id': 'p1'},
+             'entities': {'hashtags': [{'tag': 'x'}]}, 'referenced_tweets': [{'type': 'quoted', 'id': '19'}]},
+    'includes': {'users': [{'id': '7', 'name': 'Bob', 'username': 'bob', 'verified': True}],
+                 'media': [{'media_key': '3_1', 'type': 'photo', 'url': 'https://pbs.twimg.com/1.jpg'}],
+                 'places': [{'id': 'p1', 'full_name': 'Paris, France', 'country_code': 'FR'}]},
+    'matching_rules': [{'id': '10', 'tag': 'a'}, {'id': '11', 'tag': 'b'}],
+}).encode()
+
+
+class RecordTests(SimpleTestCase):
+    def test_full_line(self):
+        response = parse_response(STREAM_LINE)
+        tweet = response.data
+        self.assertEqual((tweet.id, tweet.author_id, tweet.conversation_id), (20, 7, 20))
+        self.assertEqual(tweet.created_at, datetime(2026, 1, 1, 10, 3, tzinfo=dt_timezone.utc))
+        self.assertEqual(tweet['entities'], {'hashtags': [{'tag': 'x'}]})
+        self.assertEqual(tweet.data['geo'], {'place_id': 'p1'})
+        user, = response.includes['users']
+        self.assertEqual((user.id, user.username, user.verified, user.profile_image_url), (7, 'bob', True, None))
+        self.assertEqual(response.includes['media'][0].media_key, '3_1')
+        self.assertEqual(response.includes['places'],
+                         [{'id': 'p1', 'full_name': 'Paris, France', 'country_code': 'FR'}])
+        self.assertEqual([(rule.id, rule.tag) for rule in response.matching_rules], [('10', 'a'), ('11', 'b')])
+        self.assertEqual(response.errors, [])
+
+    def test_errors_only_line(self):
+        errors = [{'title': 'operational-disconnect', 'detail': 'This stream has been disconnected'}]
+        response = parse_response(json.dumps({'errors': errors}))
+        self.assertIsNone(response.data)
+        self.assertEqual((response.includes, response.errors, response.matching_rules), ({}, errors, []))
+
+    def test_orjson_and_json_give_the_same_result(self):
+        results = list()
+        for loads in (orjson.loads, json.loads) if orjson else (json.loads,):
+            with mock.patch('interface.records.loads', loads):
+                response = parse_response(STREAM_LINE)
+            results.append((build_card(response.data, response.includes, 'a, b'), response.data.data,
+                            response.includes['places'], [tuple(rule) for rule in response.matching_rules]))
+        self.assertEqual(results[0], results[-1])
+
+    def test_build_card_on_records(self):
+        response = parse_response(STREAM_LINE)
+        card = build_card(response.data, response.includes, 'a, b')
+        self.assertEqual(card['id'], '20')
+        self.assertEqual(card['created_at'], '2026-01-01T10:03:00+00:00')
+        self.assertEqual(card['referenced_tweets'], [{'type': 'quoted', 'id': '19'}])
+        self.assertEqual(card['author'], {'id': '7', 'name': 'Bob', 'username': 'bob', 'profile_image_url': None,
+                                          'verified': True})
+        self.assertEqual(card['media'], [{'type': 'photo', 'url': 'https://pbs.twimg.com/1.jpg',
+                                          'preview_image_url': None}])
+        self.assertEqual((card['filters'], card['conversation_id'], card['public_metrics']['like_count']),
+                         ('a, b', '20', 2))
+
+
+class StreamProfileTests(SimpleTestCase):
+    def setUp(self):
+        self.ingest = mock.Mock(reply=mock.AsyncMock())
+        with mock.patch.object(JOBS, 'add'):            # No snapshot jobs
+            self.controller = StreamController(self.ingest, get_workspace(DEFAULT_WORKSPACE))
+        self.controller.STREAM = mock.Mock()
+
+    def test_unknown_profile_replies_with_an_error(self):
+        message = {'command': 'startstream', 'profile': 'everything'}
+        async_to_sync(self.controller.handle)(message)
+        self.ingest.reply.assert_awaited_once_with(
+            message, f"Unknown field profile everything, use one of {', '.join(STREAM_PROFILES)}")
+        self.controller.STREAM.filter.assert_not_called()
+        self.assertIsNone(self.controller.profile)
+
+    def test_profile_sets_the_stream_fields(self):
+        async_to_sync(self.controller.handle)({'command': 'startstream', 'profile': 'minimal'})
+        self.controller.STREAM.filter.assert_called_once_with(**STREAM_PROFILES['minimal'])
+        self.assertEqual(self.controller.profile, 'minimal')
+
+
+PARIS = {'id': 'p1', 'full_name': 'Paris, France', 'country_code': 'FR', 'geo': {'bbox': [2.0, 48.5, 3.0, 49.5]}}
+
+
+class GeoTests(TestCase):
+    def setUp(self):
+        self.now = datetime.now(dt_timezone.utc).replace(second=0, microsecond=0)
+
+    def located(self, **geo):
+        return {'id': '1', 'created_at': self.now.isoformat(), 'geo': geo}
+
+    def test_exact_coordinates_before_the_place_center(self):
+        places = {'p1': PARIS}
+        exact = self.located(place_id='p1', coordinates={'type': 'Point', 'coordinates': [2.29, 48.86]})
+        self.assertEqual(tweet_point(exact, places), (2.29, 48.86))
+        self.assertEqual(tweet_point(self.located(place_id='p1'), places), (2.5, 49.0))
+        self.assertIsNone(tweet_point(self.located(place_id='unknown'), places))
+        self.assertIsNone(tweet_point({'id': '1'}, places))
+
+    def test_cells_are_floored_and_one_per_tag(self):
+        counter = GeoCounter(degrees=0.5)
+        tweet = self.located(coordinates={'type': 'Point', 'coordinates': [-0.1, -33.9]})
+        minute = int(self.now.timestamp())
+        self.assertEqual(counter.cells(tweet, {}, 'a, b'), [(minute, 'a', -1, -68, '', ''),
+                                                            (minute, 'b', -1, -68, '', '')])
+        self.assertEqual(counter.cells(self.located(place_id='p1'), {'p1': PARIS}),
+                         [(minute, '', 5, 98, 'FR', 'p1')])
+        counter.add_tweet(tweet, {}, 'a')
+        counter.add_tweet(tweet, {}, 'a')
+        counter.add_tweet({'id': '2', 'created_at': self.now.isoformat()}, {}, 'a')        # No location
+        self.assertEqual(counter.flush(), [(minute, 'a', -1, -68, '', '', 2)])
+        self.assertEqual(counter.flush(), [])
+
+    def test_save_rolls_up_and_query_groups_by_region(self):
+        minute = int(self.now.timestamp())
+        save_geo([(minute, 'a', 4, 48, 'FR', 'p1', 2), (minute - 60, 'a', 4, 48, 'FR', 'p1', 1),
+                  (minute, 'a', -1, -34, 'AU', 'p2', 5)], DEFAULT_WORKSPACE)
+        save_geo([(minute, 'a', 4, 48, 'FR', 'p1', 7)], 'other')
+        self.assertEqual(set(GeoCube.objects.filter(workspace=DEFAULT_WORKSPACE).values_list('resolution', flat=True)),
+                         set(RESOLUTIONS))
+        self.assertEqual(GeoCube.objects.get(workspace=DEFAULT_WORKSPACE, resolution=86400, place='p1').count, 3)
+        start = self.now - timedelta(minutes=5)
+        with override_settings(GEO={'GRID_DEGREES': 1.0}):
+            self.assertEqual(query_geo(DEFAULT_WORKSPACE, 60, start, by=('cell',)), [
+                {'cell_x': -1, 'cell_y': -34, 'count': 5, 'bounds': [-1.0, -34.0, 0.0, -33.0]},
+                {'cell_x': 4, 'cell_y': 48, 'count': 3, 'bounds': [4.0, 48.0, 5.0, 49.0]},
+            ])
+        self.assertEqual(query_geo('other', 60, start, by=('country',)), [{'country_code': 'FR', 'count': 7}])
+        response = self.client.get('/api/geo', {'by': 'country', 'minutes': 5})
+        self.assertEqual(response.json()['regions'], [{'country_code': 'AU', 'count': 5},
+                                                      {'country_code': 'FR', 'count': 3}])
+        self.assertEqual(self.client.get('/api/geo', {'by': 'continent'}).status_code, 400)
+
+    def test_places_are_stored_with_their_bounds(self):
+        add_includes_to_db([], [], [PARIS])
+        add_includes_to_db([], [], [dict(PARIS, full_name='Paris')])            # Updated
+        place = Place.objects.get(id='p1')
+        self.assertEqual((place.full_name, place.country_code), ('Paris', 'FR'))
+        self.assertEqual((place.west, place.south, place.east, place.north), (2.0, 48.5, 3.0, 49.5))
+
+
+@override_settings(SNAPSHOT={'HOST': None})
+class SnapshotViewTests(SimpleTestCase):
+    def setUp(self):
+        snapshot = get_workspace(DEFAULT_WORKSPACE).snapshot
+        self.addCleanup(setattr, snapshot, 'local', snapshot.local)
+        snapshot.local = dict()
+
+    def test_etag_and_last_modified(self):
+        with mock.patch('interface.snapshot.time.time', return_value=1767225600.5):
+            async_to_sync(get_workspace(DEFAULT_WORKSPACE).snapshot.publish)('rules', [{'id': '1', 'value': '#a'}])
+        response = self.client.get('/api/rules')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), [{'id': '1', 'value': '#a'}])
+        self.assertEqual(response['Last-Modified'], 'Thu, 01 Jan 2026 00:00:00 GMT')
+        response = self.client.get('/api/rules', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Last-Modified'], 'Thu, 01 Jan 2026 00:00:00 GMT')
+        self.assertFalse(self.client.get('/api/popular').has_header('Last-Modified'))     # Nothing published yet
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, SNAPSHOT={'HOST': None},
+                   WORKSPACES={DEFAULT_WORKSPACE: {}, 'small': {'MAX_CLIENTS': 1}})
+class ConsumerTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(MONITOR, 'start')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(WORKSPACES.pop, 'small', None)
+        snapshot = get_workspace(DEFAULT_WORKSPACE).snapshot
+        self.addCleanup(setattr, snapshot, 'local', snapshot.local)
+        snapshot.local = dict()
+
+    @staticmethod
+    def communicator(path):
+        return WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+
+    def test_first_message_is_the_snapshot(self):
+        async def run():
+            snapshot = get_workspace(DEFAULT_WORKSPACE).snapshot
+            await snapshot.publish('rules', [{'id': '1', 'value': '#a', 'tag': 'a'}])
+            await snapshot.publish('trending', {'hashtags': {'1': []}})
+            communicator = self.communicator('/ws/tweets')
+            connected, _ = await communicator.connect()
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return connected, frame
+
+        connected, frame = async_to_sync(run)()
+        self.assertTrue(connected)
+        self.assertEqual(list(frame), ['type'] + list(SNAPSHOT_KEYS))
+        self.assertEqual(frame['type'], 'snapshot')
+        self.assertEqual(frame['rules'], [{'id': '1', 'value': '#a', 'tag': 'a'}])
+        self.assertEqual(frame['trending'], {'hashtags': {'1': []}})
+        self.assertEqual([name for name in SNAPSHOT_KEYS if frame[name] is None],
+                         ['hmc', 'tweetmetrics', 'tweets', 'status', 'clusters'])
+
+    def test_unknown_and_full_workspaces_are_refused(self):
+        async def run():
+            unknown, _ = await self.communicator('/ws/tweets/missing').connect()
+            first = self.communicator('/ws/tweets/small')
+            admitted, _ = await first.connect()
+            refused, _ = await self.communicator('/ws/tweets/small').connect()
+            await first.disconnect()
+            again = self.communicator('/ws/tweets/small')
+            readmitted, _ = await again.connect()
+            await again.disconnect()
+            return unknown, admitted, refused, readmitted
+
+        self.assertEqual(async_to_sync(run)(), (False, True, False, True))
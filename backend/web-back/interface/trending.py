@@ -0,0 +1,300 @@
+import json
+import struct
+import time
+from array import array
+from hashlib import blake2b
+
+
+""" Sliding-window trending hashtags and mentions, counted with fixed-size sketches """
+KINDS = ('hashtags', 'mentions')
+WINDOWS = (1, 5, 60)            # In buckets, i.e. minutes with the default bucket size
+HEADER = struct.Struct('<4sHIIIH')
+MAGIC = b'TRND'
+VERSION = 1
+
+
+class CountMinSketch:
+    def __init__(self, width=512, depth=4):
+        """
+        A Count-Min sketch: estimates the count of any item in a fixed amount of memory. The estimates are never
+        too low, and too high by at most a small fraction of the total count.
+        :param width: Counters per row
+        :param depth: Number of rows, each with its own hash
+        """
+        self.width = width
+        self.depth = depth
+        self.table = array('q', bytes(8 * width * depth))
+
+    def indexes(self, item):
+        """
+        Gets the counter index of an item in every row. The hash is stable across processes, so sketches built in
+        different workers can be merged.
+        :param item: The item as a string
+        :return: List of indexes into the table, one per row
+        """
+        digest = blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [row * self.width + (h1 + row * h2) % self.width for row in range(self.depth)]
+
+    def add(self, item, count=1):
+        for i in self.indexes(item):
+            self.table[i] += count
+
+    def estimate(self, item):
+        return min(self.table[i] for i in self.indexes(item))
+
+    def merge(self, other):
+        """
+        Adds the counters of another sketch of the same size to this one.
+        :param other: CountMinSketch
+        """
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('Cannot merge sketches of different sizes')
+        for i, value in enumerate(other.table):
+            if value:
+                self.table[i] += value
+
+
+class SpaceSaving:
+    def __init__(self, capacity=100):
+        """
+        The Space-Saving summary: keeps the heavy hitters of a stream in at most 'capacity' counters.
+        Any item occurring more than total/capacity times is guaranteed to be kept.
+        :param capacity: The maximum number of items kept
+        """
+        self.capacity = capacity
+        self.counts = dict()
+
+    def add(self, item, count=1):
+        """
+        Counts an item. When the summary is full the smallest item is replaced, and the newcomer inherits its count.
+        :param item: The item as a string
+        :param count: How many times the item occurred
+        """
+        if item in self.counts or len(self.counts) < self.capacity:
+            self.counts[item] = self.counts.get(item, 0) + count
+            return
+        smallest = min(self.counts, key=self.counts.get)
+        self.counts[item] = self.counts.pop(smallest) + count
+
+    def merge(self, other):
+        """
+        Adds the counters of another summary to this one, keeping the 'capacity' largest. An item missing from a full
+        summary may have been counted up to its smallest counter before being replaced, so it is counted as that much,
+        which keeps the merged counts from ever being too low.
+        :param other: SpaceSaving
+        """
+        floor, other_floor = self.floor(), other.floor()
+        for item in other.counts.keys() - self.counts.keys():
+            self.counts[item] = floor
+        for item in self.counts:
+            self.counts[item] += other.counts.get(item, other_floor)
+        if len(self.counts) > self.capacity:
+            top = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:self.capacity]
+            self.counts = dict(top)
+
+    def floor(self):
+        """
+        :return: The most an item missing from the summary may have occurred, the smallest counter once it is full
+        """
+        return min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+
+    def top(self, n):
+        return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+class Bucket:
+    def __init__(self, width, depth, capacity):
+        """
+        The counts for one time bucket: a sketch and a summary per kind.
+        """
+        self.sketches = {kind: CountMinSketch(width, depth) for kind in KINDS}
+        self.summaries = {kind: SpaceSaving(capacity) for kind in KINDS}
+
+    def add(self, kind, item, count=1):
+        self.sketches[kind].add(item, count)
+        self.summaries[kind].add(item, count)
+
+    def merge(self, other):
+        for kind in KINDS:
+            self.sketches[kind].merge(other.sketches[kind])
+            self.summaries[kind].merge(other.summaries[kind])
+
+
+class TrendingEngine:
+    def __init__(self, bucket_seconds=60, windows=WINDOWS, width=512, depth=4, capacity=100):
+        """
+        Counts hashtags and mentions in rotating time buckets, so that the counts of any recent window can be
+        summed from the buckets it covers. Twice the longest window is kept, for the growth rate.
+        Memory is bounded by the number of buckets and the size of the sketches, not by the vocabulary.
+        :param bucket_seconds: The length of a bucket in seconds
+        :param windows: The window lengths, in buckets
+        :param width: Width of the Count-Min sketches
+        :param depth: Depth of the Count-Min sketches
+        :param capacity: Counters kept by the Space-Saving summaries
+        """
+        self.bucket_seconds = bucket_seconds
+        self.windows = windows
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity
+        self.keep = 2 * max(windows)
+        self.buckets = dict()
+
+    def bucket(self, now):
+        """
+        Gets the bucket for a point in time, creating it and dropping the expired buckets if it is new.
+        :param now: Unix timestamp
+        :return: Bucket
+        """
+        index = int(now // self.bucket_seconds)
+        if index not in self.buckets:
+            self.buckets[index] = Bucket(self.width, self.depth, self.capacity)
+            for old in [i for i in self.buckets if i <= index - self.keep]:
+                del self.buckets[old]
+        return self.buckets[index]
+
+    def add_tweet(self, tweet, now=None):
+        """
+        Counts the hashtags and mentions of a tweet.
+        :param tweet: The tweet from Tweepy, or its data dictionary
+        :param now: Unix timestamp to count the tweet at, defaults to the current time
+        """
+        entities = tweet['entities'] if 'entities' in tweet else None
+        if not entities:
+            return
+        bucket = self.bucket(time.time() if now is None else now)
+        for hashtag in entities.get('hashtags', []):
+            bucket.add('hashtags', hashtag['tag'])
+        for mention in entities.get('mentions', []):
+            bucket.add('mentions', mention['username'])
+
+    def window(self, length, now, offset=0):
+        """
+        Gets the buckets of a window.
+        :param length: The window length in buckets
+        :param now: Unix timestamp of the end of the window
+        :param offset: How many buckets before 'now' the window ends
+        :return: List of the buckets in the window that hold any counts
+        """
+        end = int(now // self.bucket_seconds) - offset
+        return [self.buckets[i] for i in range(end - length + 1, end + 1) if i in self.buckets]
+
+    def top(self, kind, length, n=10, now=None):
+        """
+        Gets the most frequent items of a window, by merging the summaries of its buckets.
+        :param kind: 'hashtags' or 'mentions'
+        :param length: The window length in buckets
+        :param n: How many items to return
+        :param now: Unix timestamp of the end of the window, defaults to the current time
+        :return: List of (item, count) tuples, largest first
+        """
+        now = time.time() if now is None else now
+        summary = SpaceSaving(self.capacity)
+        for bucket in self.window(length, now):
+            summary.merge(bucket.summaries[kind])
+        return summary.top(n)
+
+    def rising(self, kind, length, n=10, now=None, min_count=3):
+        """
+        Gets the items growing fastest: the count in the window compared to the count in the window before it.
+        The counts of the previous window are estimated with the Count-Min sketches, so items that were not heavy
+        hitters then are still scored correctly.
+        :param kind: 'hashtags' or 'mentions'
+        :param length: The window length in buckets
+        :param n: How many items to return
+        :param now: Unix timestamp of the end of the window, defaults to the current time
+        :param min_count: Items counted fewer times in the window are ignored
+        :return: List of (item, count, growth) tuples, fastest growing first
+        """
+        now = time.time() if now is None else now
+        previous = self.window(length, now, offset=length)
+        scored = list()
+        for item, count in self.top(kind, length, self.capacity, now):
+            if count < min_count:
+                continue
+            before = sum(bucket.sketches[kind].estimate(item) for bucket in previous)
+            scored.append((item, count, round((count + 1) / (before + 1), 2)))
+        return sorted(scored, key=lambda t: t[2], reverse=True)[:n]
+
+    def results(self, n=10, now=None):
+        """
+        Collects the top and rising items of every window, in the format sent to the dashboard.
+        :param n: How many items to return for each list
+        :param now: Unix timestamp, defaults to the current time
+        :return: Dictionary keyed by window length
+        """
+        now = time.time() if now is None else now
+        res = dict()
+        for length in self.windows:
+            res[str(length)] = {
+                'hashtags': [{'hashtag': i, 'count': c} for i, c in self.top('hashtags', length, n, now)],
+                'mentions': [{'mention': i, 'count': c} for i, c in self.top('mentions', length, n, now)],
+                'rising_hashtags': [{'hashtag': i, 'count': c, 'growth': g}
+                                    for i, c, g in self.rising('hashtags', length, n, now)],
+                'rising_mentions': [{'mention': i, 'count': c, 'growth': g}
+                                    for i, c, g in self.rising('mentions', length, n, now)],
+            }
+        return res
+
+    def merge(self, other):
+        """
+        Adds the counts of an engine from another worker, bucket by bucket.
+        :param other: TrendingEngine with the same bucket and sketch sizes
+        """
+        if (self.bucket_seconds, self.width, self.depth) != (other.bucket_seconds, other.width, other.depth):
+            raise ValueError('Cannot merge trending engines of different sizes')
+        for index, bucket in other.buckets.items():
+            if index not in self.buckets:
+                self.buckets[index] = Bucket(self.width, self.depth, self.capacity)
+            self.buckets[index].merge(bucket)
+        latest = max(self.buckets, default=0)
+        for old in [i for i in self.buckets if i <= latest - self.keep]:
+            del self.buckets[old]
+
+    def to_bytes(self):
+        """
+        Serializes the engine, e.g. to share it with other workers: a header, the summaries as JSON, and the raw
+        sketch counters of every bucket.
+        :return: bytes
+        """
+        indexes = sorted(self.buckets)
+        summaries = [{kind: self.buckets[i].summaries[kind].counts for kind in KINDS} for i in indexes]
+        meta = json.dumps({'windows': list(self.windows), 'capacity': self.capacity,
+                           'indexes': indexes, 'summaries': summaries}).encode()
+        parts = [HEADER.pack(MAGIC, VERSION, self.bucket_seconds, self.width, self.depth, len(KINDS)),
+                 struct.pack('<I', len(meta)), meta]
+        for i in indexes:
+            for kind in KINDS:
+                parts.append(self.buckets[i].sketches[kind].table.tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Restores an engine serialized with to_bytes.
+        :param data: bytes
+        :return: TrendingEngine
+        """
+        magic, version, bucket_seconds, width, depth, kinds = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION or kinds != len(KINDS):
+            raise ValueError('Not a trending engine of a supported version')
+        offset = HEADER.size
+        (length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        meta = json.loads(data[offset:offset + length])
+        offset += length
+        engine = cls(bucket_seconds, tuple(meta['windows']), width, depth, meta['capacity'])
+        size = 8 * width * depth
+        for index, summaries in zip(meta['indexes'], meta['summaries']):
+            bucket = Bucket(width, depth, meta['capacity'])
+            for kind in KINDS:
+                bucket.summaries[kind].counts = summaries[kind]
+                bucket.sketches[kind].table = array('q', data[offset:offset + size])
+                offset += size
+            engine.buckets[index] = bucket
+        return engine
+
+
+TRENDING = TrendingEngine()
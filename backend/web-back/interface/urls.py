@@ -2,4 +2,19 @@ from django.urls import path, include
 from .views import *
 
 urlpatterns = [
-]
\ No newline at end of file
+    path('popular', popular, name='popular'),
+    path('engagement', engagement, name='engagement'),
+    path('rules', rules, name='rules'),
+    path('tweets', tweets, name='tweets'),
+    path('trending', trending, name='trending'),
+    path('clusters', clusters, name='clusters'),
+    path('export/<str:kind>', export, name='export'),
+    path('thread/<str:conversation_id>', thread, name='thread'),
+    path('referenced', referenced, name='referenced'),
+    path('card/<str:tweet_id>', card, name='card'),
+    path('cube', cube, name='cube'),
+    path('geo', geo, name='geo'),
+    path('cooccurrence', cooccurrence, name='cooccurrence'),
+    path('monitor', monitor, name='monitor'),
+    path('profile', profile, name='profile'),
+]
@@ -3,16 +3,335 @@ from django.shortcuts import render
 # Create your views here.
 
 from django.shortcuts import render, HttpResponse
+import asyncio
+from datetime import datetime, timedelta
+from channels.layers import get_channel_layer
+from django.http import (Http404, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotAllowed,
+                         HttpResponseNotModified, JsonResponse, StreamingHttpResponse)
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_datetime, parse_date
+from django.utils.http import http_date, parse_etags
+from .conversations import get_thread, get_top_referenced
+from .cooccurrence import stored_neighbours
+from .cube import DIMENSIONS, RESOLUTIONS, query_cube
+from .export import EXPORTS, FORMATS, export_chunks
+from .geo import DIMENSIONS as GEO_DIMENSIONS, GROUPS, query_geo
+from .ingest import INGEST_CHANNEL
+from .jobs import JOBS
+from .monitor import MONITOR, sample_profile, sync_to_async
+from .snapshot import encode_entry, snapshot_setting
+from .workspaces import DEFAULT_WORKSPACE, get_workspace, workspace_stats
+
+""" What the snapshot endpoints return before the producers have published anything """
+EMPTY_SNAPSHOTS = {
+    'hmc': {'hashtags': [], 'mentions': [], 'contexts': []},
+    'tweetmetrics': {'30': [], '60': [], '180': [], 'trending': []},
+    'rules': [],
+    'tweets': [],
+    'trending': {},
+    'clusters': [],
+}
 
 
 async def index(request):
     return render(request, 'index.html')
 
 
+def etag_matches(header, etag):
+    """
+    Compares an ETag with an If-None-Match header the way HTTP does: weakly (nginx weakens the ETags of the responses
+    it compresses), against every ETag in the list, and '*' matching any.
+    :param header: The If-None-Match header, may be empty
+    :param etag: The quoted ETag of the current version
+    :return: Whether the client already has the current version
+    """
+    etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(header)]
+    return '*' in etags or etag in etags
+
+
+def request_workspace(request):
+    """
+    :param request: The HTTP request
+    :return: The Workspace of the 'workspace' query parameter, or the default workspace
+    """
+    workspace = get_workspace(request.GET.get('workspace', DEFAULT_WORKSPACE))
+    if workspace is None:
+        raise Http404('Unknown workspace')
+    return workspace
+
+
+async def snapshot_response(request, name):
+    """
+    Serves the stored snapshot as it is, with an ETag, the time it was published as Last-Modified and a short
+    max-age so that nginx and the browsers can answer repeated requests without reaching the workers.
+    The snapshot is the one of the 'workspace' query parameter, or of the default workspace.
+    :param request: The HTTP request
+    :param name: The snapshot key to serve
+    :return: The snapshot as JSON, or 304 if the client already has the current version
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    workspace = request_workspace(request)
+    body, etag, updated = await workspace.snapshot.get(name)
+    if body is None:
+        body, etag = encode_entry(EMPTY_SNAPSHOTS[name])
+    if etag_matches(request.headers.get('If-None-Match', ''), etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    if updated is not None:
+        response['Last-Modified'] = http_date(updated)
+    patch_cache_control(response, public=True, max_age=snapshot_setting('MAX_AGE', 5))
+    return response
+
+
+async def popular(request):
+    """ The current top hashtags, mentions and contexts """
+    return await snapshot_response(request, 'hmc')
+
+
 async def engagement(request):
-    return HttpResponse(request.POST['test'])
+    """ The tweets with the most engagement for each interval """
+    return await snapshot_response(request, 'tweetmetrics')
+
+
+async def rules(request):
+    """ The rules active on the stream """
+    return await snapshot_response(request, 'rules')
+
+
+async def tweets(request):
+    """ The most recent tweets received from the stream """
+    return await snapshot_response(request, 'tweets')
+
+
+async def trending(request):
+    """ The top and fastest growing hashtags and mentions in the last 1, 5 and 60 minutes """
+    return await snapshot_response(request, 'trending')
+
+
+async def clusters(request):
+    """ The largest clusters of near-duplicate tweets seen in the last hour """
+    return await snapshot_response(request, 'clusters')
+
+
+def parse_time(value):
+    """
+    Parses a datetime or date from a query parameter.
+    :param value: The parameter, e.g. '2022-07-17' or '2022-07-17T12:00:00+02:00'
+    :return: Aware datetime, or None if the parameter is empty. Dates are read as midnight in the current time zone.
+    """
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None and parse_date(value) is not None:
+        parsed = datetime.combine(parse_date(value), datetime.min.time())
+    if parsed is None:
+        raise ValueError(f'Invalid time: {value}')
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+async def stream_chunks(chunks):
+    """
+    Runs a synchronous export generator, fetching each chunk in the thread used for the database.
+    :param chunks: Generator from export_chunks
+    """
+    while True:
+        chunk = await sync_to_async(next)(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def export(request, kind):
+    """
+    Streams an export of tweets, metrics or entity counts. The first bytes are sent as soon as the first chunk is
+    read, and the memory used does not depend on the size of the export.
+    Query parameters: 'start' and 'end' (ISO date or datetime), 'tag', 'lang', 'format' ('ndjson' or 'csv') and
+    'workspace' (default the default workspace).
+    :param request: The HTTP request
+    :param kind: 'tweets', 'metrics', 'hashtags', 'mentions' or 'contexts'
+    :return: StreamingHttpResponse
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    if kind not in EXPORTS:
+        raise Http404(f'No export named {kind}')
+    workspace = request_workspace(request)
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return HttpResponseBadRequest(f'Unknown format: {fmt}')
+    try:
+        start = parse_time(request.GET.get('start'))
+        end = parse_time(request.GET.get('end'))
+    except ValueError as error:
+        return HttpResponseBadRequest(str(error))
+    chunks = export_chunks(kind, fmt, workspace=workspace.name, start=start, end=end, tag=request.GET.get('tag'),
+                           lang=request.GET.get('lang'))
+    response = StreamingHttpResponse(stream_chunks(chunks), content_type=FORMATS[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{kind}.{fmt}"'
+    return response
+
+
+async def thread(request, conversation_id):
+    """ The stored tweets of a conversation in the 'workspace', in thread order """
+    workspace = request_workspace(request)
+    return JsonResponse({'conversation_id': conversation_id,
+                         'tweets': await sync_to_async(get_thread)(conversation_id, workspace.name)})
+
+
+async def referenced(request):
+    """
+    The tweets referenced most in the last 'minutes' (default 60) minutes by the tweets of the 'workspace'.
+    'type' is 'quoted' (default), 'replied_to' or 'retweeted'.
+    """
+    workspace = request_workspace(request)
+    ref_type = request.GET.get('type', 'quoted')
+    if ref_type not in ('quoted', 'replied_to', 'retweeted'):
+        return HttpResponseBadRequest(f'Unknown reference type: {ref_type}')
+    try:
+        minutes = int(request.GET.get('minutes', 60))
+    except ValueError:
+        return HttpResponseBadRequest('minutes must be an integer')
+    since = timezone.now() - timedelta(minutes=minutes)
+    return JsonResponse({'type': ref_type, 'tweets': await sync_to_async(get_top_referenced)(since, workspace.name,
+                                                                                              ref_type)})
+
+
+async def card(request, tweet_id):
+    """ The card of a streamed tweet, from the card cache of the 'workspace' """
+    data = await request_workspace(request).cards.get(tweet_id)
+    if data is None:
+        raise Http404('Card not cached')
+    return JsonResponse(data)
+
+
+def is_staff(request):
+    return request.user.is_authenticated and request.user.is_staff
+
+
+async def monitor(request):
+    """
+    Staff only: the event loop lag, the recent stalls and the sync_to_async waits of this worker, the durations
+    and lateness of its jobs, the clients of its workspaces, and the messages of its channel layer
+    """
+    if not await sync_to_async(is_staff)(request):
+        return HttpResponseForbidden()
+    MONITOR.start()
+    layer = get_channel_layer()
+    return JsonResponse(dict(MONITOR.stats(), jobs=JOBS.stats(), workspaces=workspace_stats(),
+                             channel_layer=layer.stats() if hasattr(layer, 'stats') else None))
+
+
+async def profile(request):
+    """
+    Staff only: samples the stacks of a running worker for 'seconds' (default 5, at most 30), and returns them in the
+    folded format of flame graph tools. 'worker=ingest' profiles the ingest worker instead of this one.
+    """
+    if not await sync_to_async(is_staff)(request):
+        return HttpResponseForbidden()
+    try:
+        seconds = min(float(request.GET.get('seconds', 5)), 30)
+    except ValueError:
+        return HttpResponseBadRequest('seconds must be a number')
+    if request.GET.get('worker') == 'ingest':
+        channel_layer = get_channel_layer()
+        reply_channel = await channel_layer.new_channel()
+        await channel_layer.send(INGEST_CHANNEL, {'type': 'control', 'command': 'profile', 'seconds': seconds,
+                                                  'reply_channel': reply_channel})
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(reply_channel), seconds + 10)
+        except asyncio.TimeoutError:
+            return HttpResponse('The ingest worker did not answer', status=504)
+        folded = message['folded']
+    else:
+        folded = await asyncio.get_event_loop().run_in_executor(None, sample_profile, seconds)
+    return HttpResponse(folded, content_type='text/plain')
+
 
+async def cooccurrence(request):
+    """
+    The 'n' hashtags and mentions (default 10) co-occurring most with a 'node' (a hashtag prefixed with '#' or a
+    mention prefixed with '@') in the last 'minutes' (default 60). Within the window the ingest worker keeps in memory
+    the answer comes from the graph of the 'workspace', longer ranges are summed from its stored edges.
+    """
+    workspace = request_workspace(request)
+    node = request.GET.get('node', '')
+    if not node.startswith(('#', '@')) or len(node) < 2:
+        return HttpResponseBadRequest('node must be a hashtag prefixed with # or a mention prefixed with @')
+    try:
+        n = min(int(request.GET.get('n', 10)), 100)
+        minutes = int(request.GET.get('minutes', 60))
+    except ValueError:
+        return HttpResponseBadRequest('n and minutes must be integers')
+    if minutes <= workspace.cooccurrence.minutes():
+        channel_layer = get_channel_layer()
+        reply_channel = await channel_layer.new_channel()
+        await channel_layer.send(INGEST_CHANNEL, {'type': 'control', 'command': 'neighbours', 'node': node, 'n': n,
+                                                  'minutes': minutes, 'workspace': workspace.name,
+                                                  'reply_channel': reply_channel})
+        try:
+            message = await asyncio.wait_for(channel_layer.receive(reply_channel), 5)
+        except asyncio.TimeoutError:
+            return HttpResponse('The ingest worker did not answer', status=504)
+        neighbours = message['neighbours']
+    else:
+        since = timezone.now() - timedelta(minutes=minutes)
+        neighbours = await sync_to_async(stored_neighbours)(workspace.name, node, since, n)
+    return JsonResponse({'node': node, 'minutes': minutes,
+                         'neighbours': [{'node': neighbour, 'weight': weight} for neighbour, weight in neighbours]})
 
 
+async def cube(request):
+    """
+    Tweet counts per bucket over the last 'minutes' (default 60), from the pre-aggregated cube.
+    'resolution' is the bucket size in seconds (60, 3600 or 86400), 'by' a comma separated list of the dimensions to
+    break the counts down by (default 'tag'), and 'tag', 'lang', 'source' and 'possibly_sensitive' filter the counts.
+    The counts are the ones of the 'workspace'.
+    """
+    workspace = request_workspace(request)
+    try:
+        resolution = int(request.GET.get('resolution', 60))
+        minutes = int(request.GET.get('minutes', 60))
+    except ValueError:
+        return HttpResponseBadRequest('resolution and minutes must be integers')
+    if resolution not in RESOLUTIONS:
+        return HttpResponseBadRequest(f'resolution must be one of {RESOLUTIONS}')
+    by = [dimension for dimension in request.GET.get('by', 'tag').split(',') if dimension]
+    if any(dimension not in DIMENSIONS for dimension in by):
+        return HttpResponseBadRequest(f'by must be a list of {DIMENSIONS}')
+    equals = {dimension: request.GET[dimension] for dimension in DIMENSIONS if dimension in request.GET}
+    if 'possibly_sensitive' in equals:
+        equals['possibly_sensitive'] = equals['possibly_sensitive'].lower() in ('1', 'true')
+    start = timezone.now() - timedelta(minutes=minutes)
+    buckets = await sync_to_async(query_cube)(workspace.name, resolution, start, None, by, **equals)
+    return JsonResponse({'resolution': resolution, 'by': by, 'buckets': buckets})
 
 
+async def geo(request):
+    """
+    Tweet counts per region over the last 'minutes' (default 60), from the pre-aggregated geo grid.
+    'resolution' is the bucket size in seconds (60, 3600 or 86400) the minutes are rounded to, 'by' a comma separated
+    list of 'cell', 'country', 'place' and 'tag' (default 'cell'), and 'tag', 'country_code' and 'place' filter the
+    counts, e.g. ?tag=hashtagsfilter&by=cell. Cells come with their [west, south, east, north] 'bounds'.
+    The counts are the ones of the 'workspace'.
+    """
+    workspace = request_workspace(request)
+    try:
+        resolution = int(request.GET.get('resolution', 60))
+        minutes = int(request.GET.get('minutes', 60))
+    except ValueError:
+        return HttpResponseBadRequest('resolution and minutes must be integers')
+    if resolution not in RESOLUTIONS:
+        return HttpResponseBadRequest(f'resolution must be one of {RESOLUTIONS}')
+    by = [group for group in request.GET.get('by', 'cell').split(',') if group]
+    if any(group not in GROUPS for group in by):
+        return HttpResponseBadRequest(f'by must be a list of {tuple(GROUPS)}')
+    equals = {dimension: request.GET[dimension] for dimension in GEO_DIMENSIONS if dimension in request.GET}
+    start = timezone.now() - timedelta(minutes=minutes)
+    regions = await sync_to_async(query_geo)(workspace.name, resolution, start, None, by, **equals)
+    return JsonResponse({'resolution': resolution, 'by': by, 'regions': regions})
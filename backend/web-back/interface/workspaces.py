@@ -0,0 +1,129 @@
+import re
+import time
+
+from django.conf import settings
+
+from .cards import CARDS, KEY_PREFIX as CARD_PREFIX, card_cache
+from .cooccurrence import COOCCURRENCE, CooccurrenceGraph
+from .cube import CUBE, TweetCounter
+from .dedup import DEDUP, duplicate_index
+from .geo import GEO, GeoCounter
+from .snapshot import SNAPSHOT, SnapshotStore, KEY_PREFIX
+from .trending import TRENDING, TrendingEngine
+
+
+""" Workspaces: isolated monitoring sessions, each with its own stream, rules, tracker, aggregates and groups """
+DEFAULT_WORKSPACE = 'default'
+NAME = re.compile(r'^[a-z0-9][a-z0-9_-]{0,31}$')     # Also valid in channel layer group names
+LIMITS = ('MAX_TRACKED', 'MAX_TWEETS_PER_SECOND', 'MAX_CLIENTS', 'MAX_PENDING')
+
+
+def workspace_setting(workspace, name, default=None):
+    """
+    Reads a setting of a workspace from WORKSPACES, falling back to WORKSPACE_LIMITS for the limits.
+    :param workspace: The name of the workspace
+    :param name: The name of the setting, e.g. 'BEARER_TOKEN' or one of LIMITS
+    :param default: Value returned if the setting is missing
+    """
+    value = getattr(settings, 'WORKSPACES', {}).get(workspace, {}).get(name)
+    if value is None:
+        value = getattr(settings, 'WORKSPACE_LIMITS', {}).get(name, default)
+    return value
+
+
+class Workspace:
+    def __init__(self, name):
+        """
+        The state of one workspace in this process: its snapshot, trending engine, duplicate index, cube and geo
+        counters, co-occurrence graph and card cache. The default workspace keeps the state the app had before
+        workspaces (the 'tweet' group, and the SNAPSHOT, TRENDING, DEDUP, CUBE, GEO, COOCCURRENCE and CARDS
+        singletons), so its clients and endpoints are unchanged.
+        The limits stop one busy workspace from starving the others on the same workers: MAX_TRACKED tweets polled
+        for engagement, MAX_TWEETS_PER_SECOND handled from the stream, MAX_CLIENTS websockets per web worker, and
+        MAX_PENDING responses stored at the same time by the ingest worker.
+        The tweets over MAX_TWEETS_PER_SECOND are dropped, not queued: they are counted in the cube and the geo grid,
+        but not stored, broadcast or counted anywhere else. Their number is in the 'dropped' stats.
+        :param name: The name of the workspace, a key of WORKSPACES
+        """
+        self.name = name
+        self.bearer_token = workspace_setting(name, 'BEARER_TOKEN')
+        self.limits = {limit: workspace_setting(name, limit) for limit in LIMITS}
+        if name == DEFAULT_WORKSPACE:
+            self.group = 'tweet'
+            self.snapshot = SNAPSHOT
+            self.trending = TRENDING
+            self.dedup = DEDUP
+            self.cube = CUBE
+            self.geo = GEO
+            self.cooccurrence = COOCCURRENCE
+            self.cards = CARDS
+        else:
+            self.group = f'tweet.{name}'
+            self.snapshot = SnapshotStore(f'{KEY_PREFIX}{name}:')
+            self.trending = TrendingEngine()
+            self.dedup = duplicate_index()
+            self.cube = TweetCounter()
+            self.geo = GeoCounter()
+            self.cooccurrence = CooccurrenceGraph()
+            self.cards = card_cache(f'{CARD_PREFIX}{name}:')
+        self.clients = 0
+        self.admitted = 0
+        self.dropped = 0
+        self.allowance = float(self.limits['MAX_TWEETS_PER_SECOND'] or 0)
+        self.checked = time.monotonic()
+
+    def join(self):
+        """
+        Counts a websocket client in, unless the workspace has MAX_CLIENTS already.
+        :return: Whether the client may connect
+        """
+        if self.limits['MAX_CLIENTS'] and self.clients >= self.limits['MAX_CLIENTS']:
+            return False
+        self.clients += 1
+        return True
+
+    def leave(self):
+        self.clients = max(self.clients - 1, 0)
+
+    def admit(self, now=None):
+        """
+        Takes a tweet from the budget of MAX_TWEETS_PER_SECOND, a token bucket holding a second of tweets.
+        A tweet over the budget is dropped for good, and counted in 'dropped'.
+        :param now: time.monotonic() of the tweet, defaults to now
+        :return: Whether the tweet is handled, or dropped
+        """
+        rate = self.limits['MAX_TWEETS_PER_SECOND']
+        if rate:
+            now = time.monotonic() if now is None else now
+            self.allowance = min(float(rate), self.allowance + max(now - self.checked, 0) * rate)
+            self.checked = now
+            if self.allowance < 1:
+                self.dropped += 1
+                return False
+            self.allowance -= 1
+        self.admitted += 1
+        return True
+
+    def stats(self):
+        return {'clients': self.clients, 'admitted': self.admitted, 'dropped': self.dropped, 'limits': self.limits}
+
+
+WORKSPACES = dict()
+
+
+def get_workspace(name):
+    """
+    Gets the state of a workspace in this process, creating it on first use.
+    :param name: The name of the workspace
+    :return: The Workspace, or None if no workspace of that name is configured
+    """
+    if name not in WORKSPACES:
+        if not NAME.match(name or '') or name not in getattr(settings, 'WORKSPACES', {DEFAULT_WORKSPACE: {}}):
+            return None
+        WORKSPACES[name] = Workspace(name)
+    return WORKSPACES[name]
+
+
+def workspace_stats():
+    """ :return: Dictionary of the stats of the workspaces used in this process """
+    return {name: workspace.stats() for name, workspace in WORKSPACES.items()}